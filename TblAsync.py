@@ -0,0 +1,156 @@
+#!  /usr/bin/env python3
+#! -*- coding: utf-8 -*-
+
+# asyncioのイベントループ上で動かすTblSystem
+# * thread_id0の処理はrun()コルーチンでイベントループ上で実行する(それ以外のthread_idは従来通り別スレッド)
+# * submit(cls, hdl)はどのスレッドからも呼べ、hdlの完了を待つawaitableを返す
+#     結果はhdlそのもの。ERRORで完了しても例外にはしないので、hdl.statusで確認する
+# * Offloadでexecutorを省略すると、AsyncTblSystemのexecutorで実行する
+
+import time
+import asyncio
+import threading
+import concurrent.futures
+from TblSystem import *
+
+class AsyncWakeup:
+	# thread_id0のwakeup(threading.Event)の代わり
+	# どのスレッドからsetしても、イベントループ上のwaitを起こす
+	def __init__ (self):
+		self.loop = None
+		self.ident = None
+		self.event = None
+
+	def bind (self, loop):
+		# runを実行するイベントループに結び付ける
+		self.loop = loop
+		self.ident = threading.get_ident()
+		self.event = asyncio.Event()
+
+	def set (self):
+		loop = self.loop
+		if loop is None:
+			return
+		if threading.get_ident() == self.ident:
+			self.event.set()
+			return
+		try:
+			loop.call_soon_threadsafe(self.event.set)
+		except RuntimeError:
+			# イベントループが終了した後の通知は捨てる
+			pass
+
+	def clear (self):
+		if self.event is not None:
+			self.event.clear()
+
+	async def wait (self, timeout = None):
+		try:
+			await asyncio.wait_for(self.event.wait(), timeout)
+		except asyncio.TimeoutError:
+			pass
+
+class AsyncWaitInfo:
+	# submitしたHdlの完了でfutureを完了させる
+	def __init__ (self, future, hdl):
+		self.future = future
+		self.hdl = hdl
+		self.remain = 1
+
+	def wake (self, th):
+		# 完了したスレッドから呼ばれる。concurrent.futures.Futureはどのスレッドからでも完了させられる
+		self.future.set_result(self.hdl)
+
+class AsyncTblSystem (TblSystem):
+	# Offloadで使うスレッドの数
+	POOL_SIZE = 4
+
+	def __init__ (self, num_threads, schedule = TblSystem.SCHEDULE.EVENT, executor = None, **kwargs):
+		if TblSystem.SCHEDULE.SIMULATION == schedule:
+			raise RuntimeError("AsyncTblSystem doesn't support {0}".format(schedule))
+		super().__init__(num_threads, schedule, **kwargs)
+		self.loop = None
+		# 外部からの要求。どのスレッドからも投入されるので、stepでrx_queueへ振り分ける
+		self.submissions = self.new_queue(growable = True, multi_producer = True)
+		self.executor = executor if executor is not None\
+				else concurrent.futures.ThreadPoolExecutor(max_workers = AsyncTblSystem.POOL_SIZE)
+
+		# thread_id0はイベントループ上で待つので、wakeupを差し替える
+		th = self.threads[0]
+		th.wakeup = AsyncWakeup()
+		if TblSystem.SCHEDULE.EVENT == schedule:
+			self.rx_queues[0].notify = th.wakeup.set
+			self.interceptors[0].notify = th.wakeup.set
+			th.completions.notify = th.wakeup.set
+			for txq in self.tx_queues:
+				txq.notify = th.wakeup.set
+			for ch in th.channels:
+				ch.notify = th.wakeup.set
+			self.submissions.notify = th.wakeup.set
+
+	def submit (self, cls, hdl):
+		# clsの処理にhdlを要求する。hdlが完了するとhdlを結果として完了するawaitableを返す
+		# イベントループの外から呼んだときはconcurrent.futures.Futureを返す
+		if cls not in self.transport:
+			raise RuntimeError("{0} is not registered.".format(cls))
+		future = concurrent.futures.Future()
+		future.set_running_or_notify_cancel()
+		hdl.waiters = [AsyncWaitInfo(future, hdl)]
+		self.submissions.enqueue(RequestInfo(cls, hdl))
+		try:
+			loop = asyncio.get_running_loop()
+		except RuntimeError:
+			return future
+		return asyncio.wrap_future(future, loop = loop)
+
+	def is_idle (self):
+		return self.submissions.is_empty() and super().is_idle()
+
+	def step (self):
+		# 外部からの要求を担当スレッドのrx_queueへ振り分ける
+		submissions = self.submissions
+		while True:
+			req = submissions.seek()
+			if not req:
+				break
+			rxq = self.queue_of(req.cls)
+			if rxq.is_full():
+				break
+			submissions.dequeue()
+			rxq.enqueue(req)
+		super().step()
+
+	def cyclic_call (self):
+		# イベントループを持たない呼出元向け
+		asyncio.run(self.run())
+
+	async def run (self):
+		# thread_id0の処理をイベントループ上で実行する。stopで戻る
+		# 1回のstepの長さはquantum_steps、quantum_secで抑える
+		th = self.threads[0]
+		wakeup = th.wakeup
+		self.loop = asyncio.get_running_loop()
+		wakeup.bind(self.loop)
+		self.attach()
+		th.looping = True
+		try:
+			if TblSystem.SCHEDULE.EVENT == self.schedule:
+				while th.running:
+					wakeup.clear()
+					self.step()
+					if self.is_idle():
+						await wakeup.wait(th.timeout())
+					else:
+						# 処理が残っていても他のタスクに順番を譲る
+						await asyncio.sleep(0)
+			else:
+				prev = time.time()
+				while th.running:
+					self.step()
+					now = time.time()
+					await asyncio.sleep(max(TblSystemTh.SEC - (now - prev), 0))
+					prev = now
+		finally:
+			th.looping = False
+			if not th.running:
+				th.shutdown()
@@ -0,0 +1,355 @@
+#!  /usr/bin/env python3
+#! -*- coding: utf-8 -*-
+
+# thread_idごとにOSプロセスを割り当てるTblSystem
+# * thread_id0は呼出元のプロセスで実行し、それ以外はforkした子プロセスで実行する
+# * プロセス間は共有メモリ上のリング(ShmRing)で接続する
+#     rx_rings[k]: 親 -> 子k
+#     tx_rings[k]: 子k -> 親 (他の子宛てのメッセージは親が転送する)
+# * 別プロセスへ送ったHdlは送信元のHandleTableに残し、完了の通知で状態を書き戻す
+
+import struct
+import pickle
+import itertools
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from TblSystem import *
+
+class ShmRing:
+	# 共有メモリ上の単一生産者/単一消費者のバイト列リング
+	# 先頭HEADERバイトにhead、tail(単調増加のバイト位置)を置き、以降に[長さ(4byte)][データ]を並べる
+	HEADER = 64
+	WRAP = 0xFFFFFFFF
+	def __init__ (self, size, notify = None):
+		self.shm = shared_memory.SharedMemory(create = True, size = ShmRing.HEADER + size)
+		self.size = size
+		self.notify = notify
+		self.m_next = 0
+		struct.pack_into("<QQ", self.shm.buf, 0, 0, 0)
+
+	def close (self):
+		self.shm.close()
+		self.shm.unlink()
+
+	def is_empty (self):
+		head, tail = struct.unpack_from("<QQ", self.shm.buf, 0)
+		return head == tail
+
+	def is_full (self):
+		head, tail = struct.unpack_from("<QQ", self.shm.buf, 0)
+		return self.size - (tail - head) < 4
+
+	def write (self, data):
+		buf = self.shm.buf
+		head, tail = struct.unpack_from("<QQ", buf, 0)
+		need = 4 + len(data)
+		pos = tail % self.size
+		# 末尾に収まらなければ先頭へ折り返す
+		skip = self.size - pos if pos + need > self.size else 0
+		if tail + skip + need - head > self.size:
+			return False
+		if skip:
+			if skip >= 4:
+				struct.pack_into("<I", buf, ShmRing.HEADER + pos, ShmRing.WRAP)
+			pos = 0
+		struct.pack_into("<I", buf, ShmRing.HEADER + pos, len(data))
+		buf[ShmRing.HEADER + pos + 4: ShmRing.HEADER + pos + need] = data
+		# データを書いてからtailを進める
+		struct.pack_into("<Q", buf, 8, tail + skip + need)
+		if self.notify:
+			self.notify()
+		return True
+
+	def peek (self):
+		# 先頭のメッセージを取り出さずに返す。consumeで取り出す
+		buf = self.shm.buf
+		head, tail = struct.unpack_from("<QQ", buf, 0)
+		if head == tail:
+			return None
+		pos = head % self.size
+		if self.size - pos < 4 or ShmRing.WRAP == struct.unpack_from("<I", buf, ShmRing.HEADER + pos)[0]:
+			head += self.size - pos
+			pos = 0
+		length = struct.unpack_from("<I", buf, ShmRing.HEADER + pos)[0]
+		self.m_next = head + 4 + length
+		return bytes(buf[ShmRing.HEADER + pos + 4: ShmRing.HEADER + pos + 4 + length])
+
+	def consume (self):
+		struct.pack_into("<Q", self.shm.buf, 0, self.m_next)
+
+class HandleTable:
+	# 別プロセスへ送ったHdlを完了まで保持する
+	def __init__ (self):
+		self.m_hdls = {}
+		self.m_ids = itertools.count()
+
+	def export (self, hdl):
+		hid = next(self.m_ids)
+		self.m_hdls[hid] = hdl
+		return hid
+
+	def pop (self, hid, *default):
+		# defaultを渡せば、ないhidにはそれを返す
+		return self.m_hdls.pop(hid, *default)
+
+class RemoteQueue:
+	# 別プロセスの処理へのキュー。enqueueでRequestInfoを直列化してリングに書き込む
+	def __init__ (self, tblsystem, ring, dst, kind):
+		self.tblsystem = tblsystem
+		self.ring = ring
+		self.dst = dst
+		self.kind = kind
+
+	def is_full (self):
+		return self.ring.is_full()
+
+	def is_empty (self):
+		return self.ring.is_empty()
+
+	def enqueue (self, req):
+		tblsystem = self.tblsystem
+		hid = tblsystem.handles.export(req.hdl)
+		payload = pickle.dumps((req.cls, tblsystem.node, hid, req.hdl, req.stp.__name__ if req.stp else None)\
+				, pickle.HIGHEST_PROTOCOL)
+		if not self.ring.write(ProcessTblSystem.HEAD.pack(self.kind, self.dst) + payload):
+			tblsystem.handles.pop(hid)
+			return False
+		return True
+
+class RemoteWaitInfo:
+	# 別プロセスから受け取ったHdlの完了を送信元へ返す
+	def __init__ (self, tblsystem, origin, hid, hdl):
+		self.tblsystem = tblsystem
+		self.origin = origin
+		self.hid = hid
+		self.hdl = hdl
+		self.remain = 1
+
+	def wake (self, th):
+		self.tblsystem.reply(self.origin, self.hid, self.hdl)
+
+class ProcessTblSystem (TblSystem):
+	RING_SIZE = 1 << 20
+	# メッセージヘッダ (種別, 宛先thread_id)
+	HEAD = struct.Struct("<BH")
+	class KIND:
+		REQ = 0
+		INT = 1
+		FIN = 2
+
+	def __init__ (self, num_threads, schedule = TblSystem.SCHEDULE.CYCLIC, ring_size = RING_SIZE, **kwargs):
+		# ルーティングは親プロセスが担当する
+		kwargs["routing"] = TblSystem.ROUTING.CENTRAL
+		# 処理の実体はOSプロセスをまたいで移せない
+		kwargs["placement"] = TblSystem.PLACEMENT.STATIC
+		if TblSystem.SCHEDULE.SIMULATION == schedule:
+			raise RuntimeError("ProcessTblSystem doesn't support {0}".format(schedule))
+		super().__init__(num_threads, schedule, **kwargs)
+		# このOSプロセスが担当するthread_id
+		self.node = 0
+		self.handles = HandleTable()
+		self.stop_event = multiprocessing.Event()
+		self.rx_rings = [None] + [ShmRing(ring_size) for _ in range(1, num_threads)]
+		self.tx_rings = [None] + [ShmRing(ring_size) for _ in range(1, num_threads)]
+		self.pending = {}
+		self.workers = []
+		# thread_id0のループ(cyclic_call)を実行しているスレッドと、ループを抜けたことの通知
+		# リングはループを抜けてから閉じる
+		self.m_loop_thread = None
+		self.m_loop_done = threading.Event()
+		self.m_closed = False
+
+		if TblSystem.SCHEDULE.EVENT == schedule:
+			# プロセスをまたいで起床させるため、multiprocessing.Eventに差し替える
+			wakeups = [multiprocessing.Event() for _ in range(0, num_threads)]
+			for pidx in range(0, num_threads):
+				self.threads[pidx].wakeup = wakeups[pidx]
+				self.rx_queues[pidx].notify = wakeups[pidx].set
+				self.interceptors[pidx].notify = wakeups[pidx].set
+				self.threads[pidx].completions.notify = wakeups[pidx].set
+				self.tx_queues[pidx].notify = wakeups[0].set
+				if 0 != pidx:
+					self.rx_rings[pidx].notify = wakeups[pidx].set
+					self.tx_rings[pidx].notify = wakeups[0].set
+
+	def regist_process (self, process_cls, thread_id, cycle_msec, priority = 0):
+		# 要求を盗み合うdequeはOSプロセスをまたいで共有できない
+		if not isinstance(thread_id, int):
+			raise RuntimeError("ProcessTblSystem doesn't support replicated Process({0})".format(process_cls))
+		return super().regist_process(process_cls, thread_id, cycle_msec, priority)
+
+	def new_value (self, init):
+		# fork前に共有メモリ上に確保する
+		return multiprocessing.Value("i", init, lock = False)
+
+	def discard (self, req):
+		# 捨てた要求のHdlは、このOSプロセスのスレッドで異常終了させる
+		self.threads[self.node].completions.enqueue((req.hdl, None))
+
+	def ring_to (self, dst):
+		# 親からは宛先の子のrx_ring、子からは自分のtx_ringへ書き込む
+		return self.rx_rings[dst] if 0 == self.node else self.tx_rings[self.node]
+
+	def routes (self, thread_id):
+		if thread_id not in self.route_tables:
+			routes = {}
+			for pinfo in self.processes:
+				if pinfo.thread_id == self.node:
+					# 同じプロセス内の処理へは直接投入する
+					routes[pinfo.cls] = self.rx_queues[self.node]
+				else:
+					routes[pinfo.cls] = RemoteQueue(self, self.ring_to(pinfo.thread_id), pinfo.thread_id, ProcessTblSystem.KIND.REQ)
+			self.route_tables[thread_id] = routes
+		return self.route_tables[thread_id]
+
+	def interceptor (self, cls):
+		pmgr = self.processes.get(cls)
+		if not pmgr:
+			raise RuntimeError("{0} is not registered.".format(cls))
+		if pmgr.thread_id == self.node:
+			return self.interceptors[pmgr.thread_id]
+		return RemoteQueue(self, self.ring_to(pmgr.thread_id), pmgr.thread_id, ProcessTblSystem.KIND.INT)
+
+	def reply (self, origin, hid, hdl):
+		# 完了したHdlを送信元へ返す
+		data = ProcessTblSystem.HEAD.pack(ProcessTblSystem.KIND.FIN, origin)\
+				+ pickle.dumps((hid, hdl), pickle.HIGHEST_PROTOCOL)
+		pending = self.pending.setdefault(origin, [])
+		if pending or not self.ring_to(origin).write(data):
+			# 完了通知は失わないように、リングが空くまで保留する
+			pending.append(data)
+
+	def flush (self):
+		for dst, pending in self.pending.items():
+			ring = self.ring_to(dst)
+			while pending and ring.write(pending[0]):
+				pending.pop(0)
+
+	def establish (self):
+		# 親でスレッドや処理を生成する前に子プロセスをforkする
+		ctx = multiprocessing.get_context("fork")
+		for pidx in range(1, len(self.threads)):
+			worker = ctx.Process(target = self.worker_main, args = (pidx,))
+			worker.start()
+			self.workers.append(worker)
+		self.establish_node(0)
+
+	def establish_node (self, node):
+		self.node = node
+		th = self.threads[node]
+		assignments = self.processes.assignments(node)
+		for pmgr in assignments:
+			th.regist_process(self, pmgr.cls, pmgr.priority)
+		th.establish(self, node)
+		for pmgr in assignments:
+			self.start(node, pmgr)
+
+	def worker_main (self, node):
+		self.establish_node(node)
+		th = self.threads[node]
+		th.attach()
+		running = lambda: not self.stop_event.is_set()
+		if TblSystem.SCHEDULE.EVENT == self.schedule:
+			event_caller(self.worker_step, self.worker_is_idle, th.wakeup, running, self.worker_timeout)
+		else:
+			cyclic_caller(self.worker_step, TblSystemTh.SEC, running)
+		# 子プロセスの処理はここで後始末する
+		th.shutdown()
+
+	def worker_step (self):
+		self.flush()
+		self.pump(self.rx_rings[self.node])
+		self.threads[self.node].step()
+		# ErrorProcessはthread_id0のプロセスにいるので、このプロセスで数えたまま残った回数はここで送る
+		if self.error_pending:
+			self.flush_errors()
+
+	def worker_timeout (self):
+		# 数えたまま残ったSetErrorがあれば、送れるようになる頃に起床する
+		timeout = self.threads[self.node].timeout()
+		if self.error_pending and (timeout is None or timeout > ErrorProcess.INTERVAL_SEC):
+			return ErrorProcess.INTERVAL_SEC
+		return timeout
+
+	def worker_is_idle (self):
+		return not any(self.pending.values()) and self.rx_rings[self.node].is_empty() and self.threads[self.node].is_idle()
+
+	def pump (self, ring):
+		# リングのメッセージを自分宛てなら配送し、他の子宛てなら転送する
+		while True:
+			data = ring.peek()
+			if data is None:
+				return
+			kind, dst = ProcessTblSystem.HEAD.unpack_from(data)
+			if dst != self.node:
+				if not self.rx_rings[dst].write(data):
+					# 転送先が満杯なら次のstepで再試行する
+					return
+			elif not self.deliver(kind, data[ProcessTblSystem.HEAD.size:]):
+				return
+			ring.consume()
+
+	def deliver (self, kind, payload):
+		th = self.threads[self.node]
+		if ProcessTblSystem.KIND.FIN == kind:
+			hid, result = pickle.loads(payload)
+			hdl = self.handles.pop(hid)
+			state = result.__getstate__()
+			status = state.pop("status")
+			for name, value in state.items():
+				setattr(hdl, name, value)
+			complete_hdl(hdl, status, th)
+			return True
+		cls, origin, hid, hdl, stp = pickle.loads(payload)
+		hdl.waiters = [RemoteWaitInfo(self, origin, hid, hdl)]
+		prc = th.processes[cls]
+		req = RequestInfo(cls, hdl, getattr(prc, stp) if stp else None)
+		if ProcessTblSystem.KIND.INT == kind:
+			return self.interceptors[self.node].enqueue(req) is not False
+		return self.rx_queues[self.node].enqueue(req) is not False
+
+	def step (self):
+		self.flush()
+		for ring in self.tx_rings[1:]:
+			self.pump(ring)
+		super().step()
+
+	def is_idle (self):
+		return not any(self.pending.values()) and all(map(lambda ring: ring.is_empty(), self.tx_rings[1:])) and super().is_idle()
+
+	def cyclic_call (self):
+		self.m_loop_thread = threading.current_thread()
+		self.m_loop_done.clear()
+		try:
+			super().cyclic_call()
+		finally:
+			self.m_loop_done.set()
+			if self.stop_event.is_set():
+				# ループの中からstopされた場合は、ここで閉じる
+				self.close()
+
+	def stop (self):
+		self.stop_event.set()
+		for th in self.threads:
+			th.running = False
+			th.wakeup.set()
+		for worker in self.workers:
+			worker.join()
+		loop_thread = self.m_loop_thread
+		if loop_thread is threading.current_thread() and not self.m_loop_done.is_set():
+			# ループの中から呼ばれた。リングはループを抜けたcyclic_callが閉じる
+			return
+		if loop_thread is not None:
+			# 別スレッドのループがリングを読み終えるのを待つ
+			self.m_loop_done.wait()
+		self.close()
+
+	def close (self):
+		if self.m_closed:
+			return
+		self.m_closed = True
+		# ループを回さずに止めた場合も、thread_id0の処理を後始末する
+		self.threads[0].shutdown()
+		for ring in self.rx_rings[1:] + self.tx_rings[1:]:
+			ring.close()
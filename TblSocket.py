@@ -0,0 +1,399 @@
+#!  /usr/bin/env python3
+#! -*- coding: utf-8 -*-
+
+# ソケットで他のTblSystem(ノード)とつなぐTblSystem
+# * regist_processでnodeを指定した処理は、そのノードで実行する
+# * ノードはTCP((ホスト, ポート))かUnixドメインソケット(パス)で待ち受ける
+# * 送信先のノードごとに接続を1本張り、以降の要求で使い回す
+# * 通信は1本の通信スレッドが行い、溜まったメッセージをまとめて書き込む
+# * 他のノードへ送ったHdlは送信元のHandleTableに残し、完了の通知で状態を書き戻す
+#     受け取ったメッセージの配送と完了の書き戻しはthread_id0のstepで行う
+# * Hdlはpickleで送るので、信頼できるノードとだけつなぐこと
+
+import os
+import time
+import errno
+import struct
+import pickle
+import socket
+import selectors
+import threading
+from TblSystem import *
+from TblMultiProcess import HandleTable
+
+class SocketPeer:
+	# 他のノードとの接続1本分
+	def __init__ (self, tblsystem, node = None, sock = None):
+		# 接続先のノード名 (受け付けた接続ならNone)
+		self.node = node
+		self.sock = sock
+		# 接続の完了を待っている間は、その期限 (perf_counter)。接続済みならNone
+		self.connecting = None
+		# 送信待ちのメッセージ (hid, バイト列)。どのスレッドからも投入される
+		self.outbox = RingQueue(growable = True, multi_producer = True, notify = tblsystem.poke)
+		self.wbuf = bytearray()
+		self.rbuf = bytearray()
+		# この接続で送って完了を待っている要求のhid (切断したらERRORにする)
+		self.hids = set()
+		# hidsへの追加と送信待ちへの投入を、切断時の取り出しと排他する
+		#   (間に切断が入ると、ERRORにした要求を再接続後に送ってしまう)
+		self.lock = threading.Lock()
+
+class SocketQueue:
+	# 他のノードの処理へのキュー。enqueueでRequestInfoを直列化して接続の送信待ちに入れる
+	def __init__ (self, tblsystem, peer, kind):
+		self.tblsystem = tblsystem
+		self.peer = peer
+		self.kind = kind
+
+	def is_full (self):
+		return False
+
+	def is_empty (self):
+		return self.peer.outbox.is_empty()
+
+	def enqueue (self, req):
+		tblsystem = self.tblsystem
+		hid = tblsystem.handles.export(req.hdl)
+		payload = pickle.dumps((req.cls, req.stp.__name__ if req.stp else None, req.hdl), pickle.HIGHEST_PROTOCOL)
+		peer = self.peer
+		with peer.lock:
+			peer.hids.add(hid)
+			return peer.outbox.enqueue((hid, SocketTblSystem.FRAME.pack(len(payload), self.kind, hid) + payload))
+
+class SocketWaitInfo:
+	# 他のノードから受け取ったHdlの完了を送信元へ返す
+	def __init__ (self, tblsystem, peer, hid, hdl):
+		self.tblsystem = tblsystem
+		self.peer = peer
+		self.hid = hid
+		self.hdl = hdl
+		self.remain = 1
+
+	def wake (self, th):
+		self.tblsystem.reply(self.peer, self.hid, self.hdl)
+
+class SocketTblSystem (TblSystem):
+	# メッセージの枠 (ペイロード長, 種別, hid)
+	FRAME = struct.Struct("<IBQ")
+	class KIND:
+		REQ = 0
+		INT = 1
+		FIN = 2
+		# 送れなかった要求 (通信スレッドからthread_id0への通知のみ)
+		ERR = 3
+	# 接続の完了を待つ時間
+	CONNECT_SEC = 3.0
+	# 1回のrecvで読むバイト数
+	RECV_SIZE = 1 << 16
+
+	def __init__ (self, num_threads, schedule = TblSystem.SCHEDULE.CYCLIC, name = None, address = None, nodes = None, **kwargs):
+		if TblSystem.SCHEDULE.SIMULATION == schedule:
+			raise RuntimeError("SocketTblSystem doesn't support {0}".format(schedule))
+		# このノードの名前と待ち受けるアドレス (Noneなら要求を受け付けない)
+		self.name = name
+		self.address = address
+		# ノード名 -> アドレス
+		self.nodes = dict(nodes) if nodes else {}
+		# 他のノードで実行する処理のクラス -> ノード名 (標準機能の登録より先に用意する)
+		self.remotes = {}
+		# 接続を張るノード名 -> SocketPeer
+		self.peers = {}
+		super().__init__(num_threads, schedule, **kwargs)
+		self.handles = HandleTable()
+		# 受け付けた接続
+		self.accepted = []
+		# 通信スレッドが受け取ったメッセージ (SocketPeer, 種別, hid, ペイロード)
+		self.inbox = RingQueue(growable = True, multi_producer = True)
+		if TblSystem.SCHEDULE.EVENT == schedule:
+			self.inbox.notify = self.threads[0].wakeup.set
+		self.m_selector = selectors.DefaultSelector()
+		# 通信スレッドを起こすためのソケット対
+		self.m_wake_r, self.m_wake_w = socket.socketpair()
+		self.m_wake_r.setblocking(False)
+		self.m_wake_w.setblocking(False)
+		self.m_poked = False
+		self.m_listener = None
+		self.m_io_thread = None
+		self.m_io_running = False
+
+	def regist_process (self, process_cls, thread_id, cycle_msec, priority = 0, node = None):
+		# nodeが他のノードなら、要求をそのノードへ送る (thread_id以降はそのノードで決める)
+		if node is None or node == self.name:
+			if process_cls in self.remotes:
+				raise RuntimeError("Duplicate Resistoration. Process({0})".format(process_cls))
+			return super().regist_process(process_cls, thread_id, cycle_msec, priority)
+		if process_cls in self.processes or process_cls in self.remotes:
+			raise RuntimeError("Duplicate Resistoration. Process({0})".format(process_cls))
+		if node not in self.nodes:
+			raise RuntimeError("Node({0}) has no address".format(node))
+		self.remotes[process_cls] = node
+		if node not in self.peers:
+			self.peers[node] = SocketPeer(self, node)
+
+	def routes (self, thread_id):
+		if thread_id not in self.route_tables:
+			routes = super().routes(thread_id)
+			for cls, node in self.remotes.items():
+				routes[cls] = SocketQueue(self, self.peers[node], SocketTblSystem.KIND.REQ)
+		return self.route_tables[thread_id]
+
+	def interceptor (self, cls):
+		node = self.remotes.get(cls)
+		if node is not None:
+			return SocketQueue(self, self.peers[node], SocketTblSystem.KIND.INT)
+		return super().interceptor(cls)
+
+	def reply (self, peer, hid, hdl):
+		# 完了したHdlを送信元へ返す。どのスレッドからも呼ばれる
+		payload = pickle.dumps(hdl, pickle.HIGHEST_PROTOCOL)
+		peer.outbox.enqueue((None, SocketTblSystem.FRAME.pack(len(payload), SocketTblSystem.KIND.FIN, hid) + payload))
+
+	def poke (self):
+		# 送信待ちが空でなくなったら通信スレッドを起こす
+		if self.m_poked:
+			return
+		self.m_poked = True
+		try:
+			self.m_wake_w.send(b"\0")
+		except OSError:
+			pass
+
+	def establish (self):
+		if self.address is not None:
+			self.m_listener = self.listen(self.address)
+			self.m_selector.register(self.m_listener, selectors.EVENT_READ, None)
+		self.m_selector.register(self.m_wake_r, selectors.EVENT_READ, self.m_wake_r)
+		self.m_io_running = True
+		self.m_io_thread = threading.Thread(target = self.io_main, daemon = True)
+		self.m_io_thread.start()
+		super().establish()
+
+	def listen (self, address):
+		if isinstance(address, str):
+			if os.path.exists(address):
+				os.unlink(address)
+			sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		else:
+			sock = socket.socket(socket.AF_INET6 if ":" in address[0] else socket.AF_INET, socket.SOCK_STREAM)
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		sock.bind(address)
+		sock.listen()
+		sock.setblocking(False)
+		# ポート0を指定したときに割り当てられたアドレス
+		self.address = sock.getsockname()
+		return sock
+
+	def connect (self, address):
+		# 接続を始めるだけで完了は待たない (通信スレッドを止めると他のノードとの通信も止まる)
+		#   完了は書き込めるようになったことで知る
+		if isinstance(address, str):
+			sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		else:
+			sock = socket.socket(socket.AF_INET6 if ":" in address[0] else socket.AF_INET, socket.SOCK_STREAM)
+		sock.setblocking(False)
+		err = sock.connect_ex(address)
+		if err not in (0, errno.EINPROGRESS, errno.EAGAIN, errno.EWOULDBLOCK):
+			sock.close()
+			raise OSError(err, os.strerror(err))
+		return sock
+
+	def connected (self, peer):
+		# 書き込めるようになった接続中のソケットの結果を確かめる
+		sock = peer.sock
+		if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+			self.disconnect(peer)
+			return
+		peer.connecting = None
+		if sock.family != socket.AF_UNIX:
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.m_selector.modify(sock, selectors.EVENT_READ, peer)
+
+	def timeout (self):
+		# 接続中のものがあれば、最も早い期限までにselectから戻る
+		deadlines = [peer.connecting for peer in self.peers.values() if peer.connecting is not None]
+		if not deadlines:
+			return None
+		return max(0.0, min(deadlines) - time.perf_counter())
+
+	def io_main (self):
+		# 通信スレッド: 接続の受付、送信待ちの書き込み、受信したメッセージの取り出し
+		selector = self.m_selector
+		while self.m_io_running:
+			for key, mask in selector.select(self.timeout()):
+				if key.data is None:
+					self.accept()
+				elif key.data is self.m_wake_r:
+					try:
+						while self.m_wake_r.recv(4096):
+							pass
+					except BlockingIOError:
+						pass
+					# 読み捨ててから戻す。この後のflushより後に投入されたものは改めて起こされる
+					self.m_poked = False
+				elif key.data.connecting is not None:
+					self.connected(key.data)
+				elif mask & selectors.EVENT_READ:
+					self.receive(key.data)
+			now = time.perf_counter()
+			for peer in list(self.peers.values()):
+				if peer.connecting is not None and peer.connecting <= now:
+					# 期限までに接続できなかった
+					self.disconnect(peer)
+			for peer in list(self.peers.values()) + self.accepted:
+				self.flush(peer)
+
+	def accept (self):
+		try:
+			sock, _ = self.m_listener.accept()
+		except BlockingIOError:
+			return
+		sock.setblocking(False)
+		if sock.family != socket.AF_UNIX:
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		peer = SocketPeer(self, sock = sock)
+		self.accepted.append(peer)
+		self.m_selector.register(sock, selectors.EVENT_READ, peer)
+
+	def flush (self, peer):
+		# 送信待ちをまとめてwbufへ移し、書き込めるだけ書き込む
+		outbox = peer.outbox
+		frames = []
+		while True:
+			item = outbox.seek()
+			if item is None:
+				break
+			outbox.dequeue()
+			frames.append(item[1])
+		if frames:
+			peer.wbuf += b"".join(frames)
+		if not peer.wbuf:
+			return
+		if peer.sock is None:
+			if peer.node is None:
+				# 閉じた受付側の接続への完了通知は捨てる
+				peer.wbuf.clear()
+				return
+			try:
+				peer.sock = self.connect(self.nodes[peer.node])
+			except OSError:
+				self.disconnect(peer)
+				return
+			peer.connecting = time.perf_counter() + SocketTblSystem.CONNECT_SEC
+			self.m_selector.register(peer.sock, selectors.EVENT_WRITE, peer)
+		if peer.connecting is not None:
+			# 接続が済むまで書き込まない
+			return
+		try:
+			sent = peer.sock.send(peer.wbuf)
+		except BlockingIOError:
+			sent = 0
+		except OSError:
+			self.disconnect(peer)
+			return
+		del peer.wbuf[:sent]
+		# 書き切れなければ、書き込めるようになったら続きを書く
+		self.m_selector.modify(peer.sock, selectors.EVENT_READ | (selectors.EVENT_WRITE if peer.wbuf else 0), peer)
+
+	def receive (self, peer):
+		try:
+			data = peer.sock.recv(SocketTblSystem.RECV_SIZE)
+		except BlockingIOError:
+			return
+		except OSError:
+			data = b""
+		if not data:
+			self.disconnect(peer)
+			return
+		rbuf = peer.rbuf
+		rbuf += data
+		size = SocketTblSystem.FRAME.size
+		pos = 0
+		while len(rbuf) - pos >= size:
+			length, kind, hid = SocketTblSystem.FRAME.unpack_from(rbuf, pos)
+			if len(rbuf) - pos - size < length:
+				break
+			if SocketTblSystem.KIND.FIN == kind:
+				peer.hids.discard(hid)
+			self.inbox.enqueue((peer, kind, hid, bytes(rbuf[pos + size: pos + size + length])))
+			pos += size + length
+		del rbuf[:pos]
+
+	def disconnect (self, peer):
+		# 接続を閉じ、完了を待っていた要求をERRORにする。次の要求で接続し直す
+		if peer.sock is not None:
+			self.m_selector.unregister(peer.sock)
+			peer.sock.close()
+			peer.sock = None
+		peer.connecting = None
+		peer.wbuf.clear()
+		peer.rbuf.clear()
+		with peer.lock:
+			while peer.outbox.seek() is not None:
+				peer.outbox.dequeue()
+			hids = list(peer.hids)
+			peer.hids.clear()
+		for hid in hids:
+			self.inbox.enqueue((peer, SocketTblSystem.KIND.ERR, hid, b""))
+		if peer.node is None and peer in self.accepted:
+			self.accepted.remove(peer)
+
+	def deliver (self, peer, kind, hid, payload):
+		# 受け取ったメッセージをthread_id0で処理する。投入先が満杯ならFalse
+		th = self.threads[0]
+		if SocketTblSystem.KIND.FIN == kind or SocketTblSystem.KIND.ERR == kind:
+			hdl = self.handles.pop(hid, None)
+			if hdl is None:
+				# 既に完了させた要求への通知は捨てる
+				return True
+			if SocketTblSystem.KIND.ERR == kind:
+				complete_hdl(hdl, TblStatus.ERROR, th)
+				return True
+			state = pickle.loads(payload).__getstate__()
+			status = state.pop("status")
+			for name, value in state.items():
+				setattr(hdl, name, value)
+			complete_hdl(hdl, status, th)
+			return True
+		cls, stp, hdl = pickle.loads(payload)
+		if cls not in self.transport:
+			# このノードにない処理への要求
+			hdl.status = TblStatus.ERROR
+			self.reply(peer, hid, hdl)
+			return True
+		dst = self.transport[cls]
+		queue = self.interceptors[dst] if SocketTblSystem.KIND.INT == kind else self.queue_of(cls)
+		if queue.is_full():
+			return False
+		hdl.waiters = [SocketWaitInfo(self, peer, hid, hdl)]
+		prc = self.threads[dst].processes.get(cls)
+		queue.enqueue(RequestInfo(cls, hdl, getattr(prc, stp) if stp and prc else None))
+		return True
+
+	def is_idle (self):
+		return self.inbox.is_empty() and super().is_idle()
+
+	def step (self):
+		inbox = self.inbox
+		while True:
+			msg = inbox.seek()
+			if msg is None or not self.deliver(*msg):
+				break
+			inbox.dequeue()
+		super().step()
+
+	def stop (self):
+		super().stop()
+		self.m_io_running = False
+		self.m_wake_w.send(b"\0")
+		if self.m_io_thread is not None:
+			self.m_io_thread.join()
+		for peer in list(self.peers.values()) + self.accepted:
+			if peer.sock is not None:
+				peer.sock.close()
+		if self.m_listener is not None:
+			self.m_listener.close()
+			if isinstance(self.address, str):
+				os.unlink(self.address)
+		self.m_wake_r.close()
+		self.m_wake_w.close()
@@ -1,231 +1,1361 @@
 #!  /usr/bin/env python3
 #! -*- coding: utf-8 -*-
 
+import os
 import sys
 import time
+import json
+import mmap
+import heapq
+import random
+import struct
+import itertools
+import collections
 import threading
+import concurrent.futures
 from enum import Enum
 
 def find_if (pred, collection):
 	return next(filter(pred, collection), None)
 
 class ProcessInfo:
-	def __init__ (self, cls, thread_id, cycle_msec):
+	def __init__ (self, cls, thread_id, cycle_msec, priority = 0):
 		self.cls = cls
 		self.thread_id = thread_id
 		self.cycle_msec = cycle_msec
+		self.priority = priority
+		# ProcessRegistryに登録した順の番号
+		self.process_id = None
+		# 複製した処理なら、レプリカを置くthread_idの並び (thread_idは先頭)
+		self.replicas = None
+
+class ProcessRegistry:
+	# TblSystemに登録した処理(ProcessInfo)の索引
+	# クラス、番号(process_id)、担当スレッドのどれからでも走査せずに引ける
+	# 処理が持つHdlのクラスにも登録順に番号(hdl_id)を振る
+	#   (番号は最初に引いたときにまとめて振り、登録のたびにクラスを走査しない)
+	def __init__ (self):
+		self.m_infos = []
+		self.m_classes = {}
+		# thread_id -> {クラス: ProcessInfo}
+		self.m_assignments = {}
+		# Hdlのクラスの一覧と、クラス -> hdl_id (Noneなら未作成)
+		self.m_hdl_classes = None
+		self.m_hdl_ids = None
+
+	def __iter__ (self):
+		return iter(self.m_infos)
+
+	def __len__ (self):
+		return len(self.m_infos)
+
+	def __contains__ (self, cls):
+		return cls in self.m_classes
+
+	def add (self, pinfo):
+		pinfo.process_id = len(self.m_infos)
+		self.m_infos.append(pinfo)
+		self.m_classes[pinfo.cls] = pinfo
+		for thread_id in pinfo.replicas or (pinfo.thread_id,):
+			self.m_assignments.setdefault(thread_id, {})[pinfo.cls] = pinfo
+		self.m_hdl_classes = None
+		self.m_hdl_ids = None
+		return pinfo.process_id
+
+	def get (self, cls):
+		return self.m_classes.get(cls)
+
+	def by_id (self, process_id):
+		return self.m_infos[process_id]
+
+	def assignments (self, thread_id):
+		# thread_idに割り当てた処理 (登録順)
+		return list(self.m_assignments.get(thread_id, {}).values())
+
+	def move (self, cls, thread_id):
+		pinfo = self.m_classes[cls]
+		del self.m_assignments[pinfo.thread_id][cls]
+		pinfo.thread_id = thread_id
+		self.m_assignments.setdefault(thread_id, {})[cls] = pinfo
+
+	def index_hdls (self):
+		# 入れ子で定義したHdlのクラスに番号を振る (dirの順なので登録順が同じなら番号も同じ)
+		self.m_hdl_classes = []
+		self.m_hdl_ids = {}
+		for pinfo in self.m_infos:
+			for name in dir(pinfo.cls):
+				value = getattr(pinfo.cls, name)
+				if isinstance(value, type) and issubclass(value, BaseHdl) and value not in self.m_hdl_ids:
+					self.m_hdl_ids[value] = len(self.m_hdl_classes)
+					self.m_hdl_classes.append(value)
+
+	def hdl_id (self, hdl_cls):
+		if self.m_hdl_ids is None:
+			self.index_hdls()
+		return self.m_hdl_ids[hdl_cls]
+
+	def hdl_cls (self, hdl_id):
+		if self.m_hdl_classes is None:
+			self.index_hdls()
+		return self.m_hdl_classes[hdl_id]
 
 class ProcessingInfo:
+	# FEEDではRequestInfoの代わりにそのままキューへ戻し、作り直さずに再開する
+	__slots__ = ("prc", "hdl", "stp", "cls", "t")
 	def __init__ (self, prc, hdl, stp):
 		self.prc = prc
 		self.hdl = hdl
 		self.stp = stp
+		self.cls = type(prc)
+		self.t = None
+
+class PeriodicInfo:
+	# TblSystemThが周期実行する処理のMainHdlと、次に起動する予定の時刻
+	def __init__ (self, prc, hdl, period, due):
+		self.prc = prc
+		self.cls = type(prc)
+		self.hdl = hdl
+		self.period = period
+		self.due = due
+		# 前の周期の実行が終わっていないか、遅れて起動できなかった周期の数
+		self.misses = 0
+		# 予定の時刻から起動までの遅れ
+		self.jitter = StepStats()
+
+class SharedValue:
+	# スレッド間で共有する値 (multiprocessing.Valueと同じくvalueで読み書きする)
+	def __init__ (self, value):
+		self.value = value
+
+class Clock:
+	# 実時間の時計
+	virtual = False
+	def __init__ (self):
+		self.time = time.time
+		self.perf_counter = time.perf_counter
+
+class VirtualClock:
+	# シミュレーションモードの仮想時計。実行できる処理がなくなったときにadvanceで次の期限まで進める
+	virtual = True
+	def __init__ (self, start = 0.0):
+		self.start = start
+		self.now = start
+
+	def time (self):
+		return self.now
+
+	def perf_counter (self):
+		return self.now - self.start
+
+	def advance (self, until):
+		if until > self.now:
+			self.now = until
 
 class RequestInfo:
-	def __init__ (self, cls, hdl):
+	def __init__ (self, cls, hdl, stp = None):
 		self.cls = cls
 		self.hdl = hdl
+		# FEEDで戻ってきた要求は中断したステップから再開する
+		self.stp = stp
+		# 計測中のみ、Requestした時刻(time.perf_counter())
+		self.t = None
+		# トレース中のみ、SENDとADMITを結ぶ番号 (0なら結ばない)
+		self.flow = 0
+
+def histogram_bucket (sec):
+	# マイクロ秒の2のべき乗ごとに区切る (0: <1us, 1: <2us, 2: <4us, ...)
+	return int(sec * 1e6).bit_length()
+
+class StepStats:
+	# テーブルのステップ関数ごとの計測値
+	def __init__ (self):
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.hist = {}
+		self.rcs = {}
+
+	def add (self, sec, tag = None):
+		self.count += 1
+		self.total += sec
+		if sec > self.max:
+			self.max = sec
+		bucket = histogram_bucket(sec)
+		self.hist[bucket] = self.hist.get(bucket, 0) + 1
+		if tag is not None:
+			self.rcs[tag] = self.rcs.get(tag, 0) + 1
+
+	def dump (self):
+		return {"count": self.count, "total_sec": self.total, "max_sec": self.max\
+				, "hist_usec": {1 << bucket: n for bucket, n in sorted(list(self.hist.items()))}\
+				, "rc": {tag.name: n for tag, n in list(self.rcs.items())}}
+
+class Stats:
+	# TblSystemThごとの計測値。書き込みは担当スレッドだけが行う
+	def __init__ (self):
+		self.steps = {}
+		self.latencies = {}
+		self.high_water = {}
+		# 計測中の要求 id(Hdl) -> (クラス, Requestした時刻)
+		self.started = {}
+
+	def step (self, prc, stp, sec, tag):
+		key = (type(prc), getattr(stp, "__func__", stp))
+		stats = self.steps.get(key)
+		if stats is None:
+			stats = self.steps[key] = StepStats()
+		stats.add(sec, tag)
+
+	def admit (self, req):
+		if req.t is not None and req.stp is None:
+			self.started[id(req.hdl)] = (req.cls, req.t)
+
+	def complete (self, hdl):
+		started = self.started.pop(id(hdl), None)
+		if started is not None:
+			cls, begin = started
+			stats = self.latencies.get(cls)
+			if stats is None:
+				stats = self.latencies[cls] = StepStats()
+			stats.add(time.perf_counter() - begin)
+
+	def sample (self, name, queue):
+		depth = len(queue)
+		if depth > self.high_water.get(name, 0):
+			self.high_water[name] = depth
+
+	def dump (self):
+		return {"steps": [dict(process = cls.__name__, step = stp.__name__, **stats.dump()) for (cls, stp), stats in list(self.steps.items())]\
+				, "latency": [dict(process = cls.__name__, **stats.dump()) for cls, stats in list(self.latencies.items())]\
+				, "high_water": dict(self.high_water)}
+
+class Tracer:
+	# TblSystemThごとのトレース。固定長のレコードをリングバッファに上書きしながら記録する
+	# 書き込みは担当スレッドだけが行う
+	# (種別, RCのタグ, thread_id, 処理の名前, ステップの名前(SENDでは送信先), 時刻, 実行時間, id(Hdl)(SEND、ADMITでは要求の番号))
+	RECORD = struct.Struct("<BbHHHdfQ")
+	SIZE = 1 << 16
+	# 要求の番号。プールで再利用したHdlはidが同じになるので、Requestごとに振る
+	m_flows = itertools.count(1)
+	class KIND:
+		STEP = 0
+		# 要求を受け付けた
+		ADMIT = 1
+		# 要求を送った
+		SEND = 2
+
+	def __init__ (self, thread_id, clock, classes = None, size = SIZE):
+		self.thread_id = thread_id
+		self.clock = clock
+		# 記録する処理のクラス (Noneなら全て)
+		self.classes = classes
+		self.size = size
+		self.buffer = bytearray(size * Tracer.RECORD.size)
+		# 記録した件数の累計 (size件を超えた分は古いものから上書きする)
+		self.count = 0
+		# 関数やクラス -> 名前の番号
+		self.m_ids = {}
+		self.names = []
+
+	def name_id (self, key, name):
+		nid = self.m_ids.get(key)
+		if nid is None:
+			nid = self.m_ids[key] = len(self.names)
+			self.names.append(name)
+		return nid
+
+	def record (self, kind, tag, cls, key, name, t, sec, hid):
+		Tracer.RECORD.pack_into(self.buffer, (self.count % self.size) * Tracer.RECORD.size\
+				, kind, tag, self.thread_id, self.name_id(cls, cls.__name__), self.name_id(key, name), t, sec, hid)
+		self.count += 1
+
+	def step (self, cls, stp, rc, hdl, begin, sec):
+		if self.classes is not None and cls not in self.classes:
+			return
+		# シミュレーションモードでは時刻を仮想時計から読む
+		t = self.clock.perf_counter() - sec if self.clock.virtual else begin
+		key = getattr(stp, "__func__", stp)
+		self.record(Tracer.KIND.STEP, RC.tag_of(rc).value, cls, key, key.__qualname__, t, sec, id(hdl))
+
+	def admit (self, cls, flow):
+		if self.classes is not None and cls not in self.classes:
+			return
+		self.record(Tracer.KIND.ADMIT, 0, cls, cls, cls.__name__, self.clock.perf_counter(), 0.0, flow)
+
+	def send (self, src, dst, req):
+		# 番号は記録しない処理からの要求にも振り、受け付け側が記録する処理なら矢印の終点だけ残る
+		req.flow = next(Tracer.m_flows)
+		if self.classes is not None and src not in self.classes:
+			return
+		self.record(Tracer.KIND.SEND, 0, src, dst, dst.__name__, self.clock.perf_counter(), 0.0, req.flow)
+
+	def records (self):
+		# 残っているレコードを古い順に返す
+		buffer = bytes(self.buffer)
+		count = self.count
+		for idx in range(max(count - self.size, 0), count):
+			yield Tracer.RECORD.unpack_from(buffer, (idx % self.size) * Tracer.RECORD.size)
+
+	def events (self, pid = 0):
+		# Chrome/Perfettoのトレースイベントにする (時刻はマイクロ秒)
+		# SENDからADMITへの矢印は要求の番号で対応付け、ADMITの後に始まるステップに結ぶ
+		names = list(self.names)
+		events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": self.thread_id\
+				, "args": {"name": "TblSystemTh{0}".format(self.thread_id)}}]
+		for kind, tag, thread_id, prc, name, t, sec, hid in self.records():
+			if Tracer.KIND.STEP == kind:
+				events.append({"name": names[name], "cat": names[prc], "ph": "X", "ts": t * 1e6, "dur": sec * 1e6\
+						, "pid": pid, "tid": thread_id, "args": {"rc": RC._tag(tag).name, "hdl": hid}})
+			elif Tracer.KIND.SEND == kind:
+				events.append({"name": "request", "cat": names[name], "ph": "s", "id": hid, "ts": t * 1e6\
+						, "pid": pid, "tid": thread_id, "args": {"from": names[prc]}})
+			elif hid:
+				events.append({"name": "request", "cat": names[prc], "ph": "f", "id": hid, "ts": t * 1e6\
+						, "pid": pid, "tid": thread_id})
+		return events
 
 def nop (hdl):
 	return RC.FIN()
 
 class RC:
+	# FEED、FIN、PENDは共有の結果を返し、OKは次のステップ関数をそのまま返す(ステップごとに生成しない)
+	# 結果を調べるときはRC.tag_of(rc)を使う
+	__slots__ = ("tag", "eid", "next", "hdls")
 	class _tag (Enum):
 		ERROR = -1
 		OK = 0
 		FEED = 1
 		FIN = 2
+		# 処理側がHdlを保持し、後で完了させる
+		PEND = 3
+		# 子Hdlの完了を待ち、完了したら同じステップを再実行する
+		WAIT = 4
 
-	def __init__ (self, tag, eid, next_step):
+	def __init__ (self, tag, eid, next_step, hdls = ()):
 		self.tag = tag
 		self.eid = eid
 		self.next = next_step
+		self.hdls = hdls
 
 	def ERORR (eid):
 		return RC(RC._tag.ERROR, eid, nop)
 
 	def OK (next_step):
-		return RC(RC._tag.OK, 0, next_step)
+		return next_step
 
 	def FEED ():
-		return RC(RC._tag.FEED, 0, nop)
+		return RC_FEED
 
 	def FIN ():
-		return RC(RC._tag.FIN, 0, nop)
+		return RC_FIN
+
+	def PEND ():
+		return RC_PEND
+
+	def WAIT (*hdls):
+		return RC(RC._tag.WAIT, 0, nop, hdls)
+
+	def tag_of (rc):
+		return rc.tag if rc.__class__ is RC else RC._tag.OK
 
-def cyclic_caller (task, cyclic_sec):
+RC_FEED = RC(RC._tag.FEED, 0, nop)
+RC_FIN = RC(RC._tag.FIN, 0, nop)
+RC_PEND = RC(RC._tag.PEND, 0, nop)
+
+class WaitInfo:
+	# Hdlのwaitersの更新と完了の判定を排他する
+	lock = threading.Lock()
+	def __init__ (self, cls, hdl, stp, remain):
+		self.cls = cls
+		self.hdl = hdl
+		self.stp = stp
+		self.remain = remain
+
+	def wake (self, th):
+		# 待っていた処理を中断したステップから再開させる
+		th.send(RequestInfo(self.cls, self.hdl, self.stp))
+
+def wait_hdls (hdls, cls, hdl, stp):
+	# hdlsの完了待ちに登録する。全て完了済みならTrueを返す
+	info = WaitInfo(cls, hdl, stp, len(hdls))
+	with WaitInfo.lock:
+		for child in hdls:
+			if child.is_done():
+				info.remain -= 1
+			else:
+				if child.waiters is None:
+					child.waiters = []
+				child.waiters.append(info)
+		if 0 == info.remain:
+			return True
+	return False
+
+def complete_hdl (hdl, status, th):
+	# statusの書き換えとwaitersの確認は、wait_hdlsの確認と登録の間に割り込まないようロックの中で行う
+	# (ロックの外でwaitersがNoneと判断すると、直後に登録された待ちを起こせない)
+	with WaitInfo.lock:
+		hdl.status = status
+		waiters = hdl.waiters
+		if waiters is None:
+			return
+		hdl.waiters = None
+		ready = []
+		for info in waiters:
+			info.remain -= 1
+			if 0 == info.remain:
+				ready.append(info)
+	for info in ready:
+		info.wake(th)
+
+def wait_until (cond, timeout = None):
+	# condが成り立つまで待つ。timeout秒(Noneなら無期限)で成り立たなければFalse
+	end = None if timeout is None else time.perf_counter() + timeout
+	while not cond():
+		if end is not None and time.perf_counter() >= end:
+			return False
+		time.sleep(Queue.BLOCK_SEC)
+	return True
+
+def check_block (overflow, timeout):
+	# BLOCKで無期限に待つと、消費側が投入側を待っているときに抜けられない
+	if Queue.OVERFLOW.BLOCK == overflow and timeout is None:
+		raise RuntimeError("{0} requires a timeout".format(overflow))
+
+def cyclic_caller (task, cyclic_sec, running = lambda: True):
 	prev = time.time()
-	while True:
+	while running():
 		task()
 		now = time.time()
 		time.sleep(max(cyclic_sec - (now - prev), 0))
 		prev = now
 
+def event_caller (task, is_idle, wakeup, running = lambda: True, timeout = lambda: None):
+	while running():
+		# clearしてからtaskを実行するので、実行中に投入された要求で起床できる
+		wakeup.clear()
+		task()
+		if is_idle():
+			# タイマーの期限があればそこまでに起床する
+			wakeup.wait(timeout())
+
 class TblSystemTh:
 	SEC = 0.001
-	def __init__ (self, tx_queue, rx_queue, interceptor):
-		self.processing_stack = Queue()
+	# 1回のstepで受け付ける要求の数
+	ADMIT = 1
+	def __init__ (self, tx_queue, rx_queue, interceptor, processing_stack = None):
+		self.processing_stack = processing_stack if processing_stack is not None else Queue()
 		self.IF = tx_queue
 		self.request = rx_queue
 		self.interceptor = interceptor
 		self.processes = {}
-
-	def regist_process (self, tblsystem, cls):
+		# 直接ルーティングモードでの送信元スレッドごとの受信チャネル
+		self.channels = []
+		# 要求を受け付けるキュー(rx_queueとchannels)と、次に確認する位置
+		self.sources = []
+		self.source_idx = 0
+		# 送信先クラス -> 投入先キュー
+		self.routes = {}
+		# イベント駆動モードで要求の投入を待つ
+		self.wakeup = threading.Event()
+		self.running = False
+		# ループを実行中か。実行中のスレッドの処理はループを抜けてから後始末する
+		self.looping = False
+		# tickを持つ処理と、その次の期限
+		self.tickers = []
+		self.deadline = None
+		# 別スレッドに任せた処理の完了 (Hdl, concurrent.futures.Future)
+		self.completions = RingQueue(growable = True, multi_producer = True)
+		# 計測しないときはNone
+		self.stats = None
+		# トレースしないときはNone
+		self.tracer = None
+		# establishでprocessesから作る
+		self.dispatch = {}
+		# 優先度を指定した処理のクラス -> 優先度 (大きいほど先に受け付ける)
+		self.priorities = {}
+		# 1回のstepで実行するステップ数と時間の上限 (Noneなら無制限)
+		self.quantum_steps = None
+		self.quantum_sec = None
+		self.admit = TblSystemTh.ADMIT
+		# 上限に達して処理を次のstepへ回した回数
+		self.quantum_exceeded = 0
+		# 負荷分散モードでの処理クラスごとの実行時間の累計 (分散しないときはNone)
+		self.loads = None
+		# 他のスレッドへ移す指示 (クラス, 移動先thread_id)
+		self.orders = []
+		# 他のスレッドから移ってきた処理 (クラス, 処理, 優先度, PeriodicInfo)
+		self.adoptions = RingQueue(growable = True, multi_producer = True)
+		# 処理を他のスレッドへ移したことがあるか
+		self.migrated = False
+		self.tblsystem = None
+		self.thread_id = None
+		# 送信先が満杯で送れなかった要求。次のstepで送り直す
+		self.deferred = []
+		# タイマーの期限の基準 (シミュレーションモードでは仮想時計)
+		self.clock = Clock()
+		# 周期実行する処理 (予定の時刻, 順番, PeriodicInfo)のヒープと、クラス -> PeriodicInfo
+		self.periodic = []
+		self.periodics = {}
+		self.m_seq = itertools.count()
+		# このスレッドにレプリカを置いた処理のReplicaQueue
+		self.replicas = []
+
+	def regist_process (self, tblsystem, cls, priority = 0):
 		if cls in self.processes:
 			raise RuntimeError("{0} has registered with a TblSystemTh".format(cls))
 		self.processes[cls] = cls(self.IF)
+		if priority:
+			self.priorities[cls] = priority
 
-	def establish (self, tblsystem):
+	def establish (self, tblsystem, thread_id):
+		self.tblsystem = tblsystem
+		self.thread_id = thread_id
+		self.clock = tblsystem.clock
+		if TblSystem.PLACEMENT.BALANCED == tblsystem.placement:
+			self.loads = {}
+		self.routes = tblsystem.routes(thread_id)
 		self.err_interceptor = tblsystem.interceptor(ErrorProcess)
-		def _seterr (eid, msg):
-			if self.err_interceptor.is_full():
-				raise RuntimeError("TblSystemTh insert Error, but ErrorQueue is full")
-			else:
-			 	self.err_interceptor.enqueue(ErrorProcess.SetErrorHdl(eid, msg))
-		self.SetError = _seterr
+		self.SetError = ErrorProcess.setter(self.err_interceptor, "TblSystemTh{0}".format(thread_id), self.clock, tblsystem.error_pending)
 
-		for _, prc in self.processes.items():
+		for cls, prc in self.processes.items():
 			prc.establish(tblsystem)
-
-
-	def cyclic_call (self):
-		cyclic_caller(self.step, TblSystemTh.SEC)
+			if cls in tblsystem.replicas:
+				# レプリカはtransportのスレッドではなく、このスレッドの送信先と完了の通知先を使う
+				prc.bind(tblsystem, thread_id)
+
+		self.tickers = [prc for prc in self.processes.values() if type(prc).tick is not BaseTblProcess.tick]
+		# クラス -> (処理, Hdlのクラス -> テーブル先頭)
+		self.dispatch = {cls: (prc, prc.tables) for cls, prc in self.processes.items()}
+		self.replicas = [rq for rq in tblsystem.replicas.values() if thread_id in rq.thread_ids]
+		self.sources = [self.request] + self.channels + [rq.source(thread_id) for rq in self.replicas]
+		self.running = True
+
+	def schedule (self, cls, hdl, cycle_msec):
+		# clsのMainHdlのテーブルをcycle_msecごとに起動する。最初はすぐに起動する
+		info = PeriodicInfo(self.processes[cls], hdl, cycle_msec / 1000.0, self.clock.time())
+		self.periodics[cls] = info
+		heapq.heappush(self.periodic, (info.due, next(self.m_seq), info))
+		# 最初のstepの前でも起床の期限に入れる
+		self.deadline = info.due if self.deadline is None else min(self.deadline, info.due)
+
+	def release (self):
+		# 予定の時刻が来た処理のMainHdlを起動する
+		# 次の予定は前の予定から周期だけ進め、起動の遅れを持ち越さない
+		now = self.clock.time()
+		periodic = self.periodic
+		while periodic and periodic[0][0] <= now:
+			due, _, info = heapq.heappop(periodic)
+			if self.periodics.get(info.cls) is not info:
+				# 他のスレッドへ移った処理
+				continue
+			hdl = info.hdl
+			if TblStatus.INIT != hdl.status and not hdl.is_done():
+				# 前の周期の実行が終わっていない
+				info.misses += 1
+			else:
+				info.jitter.add(now - due)
+				hdl.status = TblStatus.RUN
+				self.processing_stack.push(ProcessingInfo(info.prc, hdl, info.prc.tables[type(hdl)]))
+				if self.tracer is not None:
+					self.tracer.admit(info.cls, 0)
+			info.due = due + info.period
+			if info.due <= now:
+				# 1周期以上遅れたら、過ぎた周期はまとめて飛ばして数える
+				skipped = int((now - info.due) / info.period) + 1
+				info.misses += skipped
+				info.due += skipped * info.period
+			heapq.heappush(periodic, (info.due, next(self.m_seq), info))
+
+	def migrate (self, cls, dst):
+		# clsの処理をdstのスレッドへ移す。処理を実行していないstepの先頭で呼ぶ
+		tblsystem = self.tblsystem
+		prc = self.processes.pop(cls)
+		del self.dispatch[cls]
+		priority = self.priorities.pop(cls, 0)
+		periodic = self.periodics.pop(cls, None)
+		if prc in self.tickers:
+			self.tickers.remove(prc)
+		self.migrated = True
+		# 移動先で実行される前に、送信先と完了の通知先を移動先のものにしておく
+		prc.bind(tblsystem, dst)
+		dst_th = tblsystem.threads[dst]
+		dst_th.adoptions.enqueue((cls, prc, priority, periodic))
+		# 受け入れを登録してからルーティングを切り替える
+		# 切替前にこのスレッドへ届いた要求はforwardで移動先へ送り直す
+		tblsystem.relocate(cls, self.thread_id, dst)
+		dst_th.wakeup.set()
+
+	def adopt (self):
+		# 他のスレッドから移ってきた処理を登録する
+		while True:
+			item = self.adoptions.seek()
+			if item is None:
+				return
+			self.adoptions.dequeue()
+			cls, prc, priority, periodic = item
+			self.processes[cls] = prc
+			self.dispatch[cls] = (prc, prc.tables)
+			if priority:
+				self.priorities[cls] = priority
+			if periodic is not None:
+				# 周期の予定はそのまま引き継ぐ
+				self.periodics[cls] = periodic
+				heapq.heappush(self.periodic, (periodic.due, next(self.m_seq), periodic))
+			if type(prc).tick is not BaseTblProcess.tick:
+				self.tickers.append(prc)
+
+	def entry (self, cls):
+		# 移ってくる途中の処理なら受け入れてから探す。他のスレッドへ移った処理ならNone
+		entry = self.dispatch.get(cls)
+		if entry is None:
+			self.adopt()
+			entry = self.dispatch.get(cls)
+		return entry
+
+	def forward (self, req, interrupt = False):
+		# 他のスレッドへ移った処理への要求を移動先へ送り直す
+		if interrupt:
+			self.tblsystem.interceptor(req.cls).enqueue(req)
+		else:
+			self.send(req)
+
+	def send (self, req):
+		# 処理の再開など、失ってはいけない要求を送る。送信先が満杯なら保留して次のstepで送り直す
+		if self.deferred or not self.routes[req.cls].enqueue(req):
+			self.deferred.append(req)
+
+	def resend (self):
+		deferred = self.deferred
+		while deferred:
+			if not self.routes[deferred[0].cls].enqueue(deferred[0]):
+				return
+			deferred.pop(0)
+
+	def is_idle (self):
+		return self.request.is_empty() and self.interceptor.is_empty() and self.completions.is_empty()\
+				and self.processing_stack.is_empty() and not self.deferred and all(map(lambda ch: ch.is_empty(), self.channels))\
+				and all(map(lambda rq: rq.is_empty(), self.replicas))
+
+	def timeout (self):
+		if self.deadline is None:
+			return None
+		return max(self.deadline - self.clock.time(), 0)
+
+	def attach (self):
+		# 呼出元のスレッドがこのスレッドの受信キューを読むことを記録する
+		# そのキューへの投入は、満杯でもBLOCKで待たずに失敗させる
+		ident = threading.get_ident()
+		for queue in [self.request, self.interceptor] + self.channels:
+			queue.consumer = ident
+
+	def cyclic_call (self, schedule):
+		self.attach()
+		self.looping = True
+		try:
+			if TblSystem.SCHEDULE.EVENT == schedule:
+				event_caller(self.step, self.is_idle, self.wakeup, lambda: self.running, self.timeout)
+			else:
+				cyclic_caller(self.step, TblSystemTh.SEC, lambda: self.running)
+		finally:
+			self.looping = False
+			if not self.running:
+				self.shutdown()
+
+	def shutdown (self):
+		# 停止したスレッドの処理の後始末をする。何度呼ばれてもよい
+		for prc in {id(prc): prc for prc in self.processes.values()}.values():
+			prc.shutdown()
+
+	def tick (self):
+		# 期限の来たタイマーを処理し、次の期限を求める
+		deadlines = [dl for dl in map(lambda prc: prc.tick(), self.tickers) if dl is not None]
+		if self.periodic:
+			deadlines.append(self.periodic[0][0])
+		self.deadline = min(deadlines) if deadlines else None
+
+	def complete_offloaded (self):
+		# 別スレッドで完了した処理のHdlをこのスレッドで完了させる
+		while True:
+			done = self.completions.seek()
+			if done is None:
+				break
+			self.completions.dequeue()
+			hdl, future = done
+			# futureがNoneなら、キューから捨てられた要求
+			status = TblStatus.ERROR if future is None or future.exception() is not None else TblStatus.FIN
+			self.complete(hdl, status)
+
+	def complete (self, hdl, status):
+		if self.stats is not None:
+			self.stats.complete(hdl)
+		complete_hdl(hdl, status, self)
+		if hdl.RELEASE_ON_FIN and TblStatus.FIN == status:
+			hdl.release()
+
+	def sample (self, stats):
+		stats.sample("tx_queue", self.IF)
+		stats.sample("rx_queue", self.request)
+		stats.sample("interceptor", self.interceptor)
+		stats.sample("processing_stack", self.processing_stack)
+		for idx, ch in enumerate(self.channels):
+			stats.sample("channel{0}".format(idx), ch)
 
 	def step (self):
+		stats = self.stats
+		tracer = self.tracer
+		if stats is not None:
+			self.sample(stats)
+		while self.orders:
+			cls, dst = self.orders.pop(0)
+			if cls in self.processes and dst != self.thread_id:
+				self.migrate(cls, dst)
+		self.adopt()
+		if self.deferred:
+			self.resend()
+		if self.periodic:
+			self.release()
+		if self.tickers or self.periodic:
+			self.tick()
+		self.complete_offloaded()
 		# Request要求処理
-		req = self.request.seek()
-		if req:
-			self.request.dequeue()
-			prc = self.processes[req.cls]
-			self.processing_stack.push(ProcessingInfo(prc, req.hdl, prc.tables[type(req.hdl)]))
-		mgr = ProcessingInfo(None, None, None)
+		# rx_queueとchannelsから順番に1つずつ、合わせてadmit個まで受け付ける
+		sources = self.sources
+		nsrc = len(sources)
+		idx = self.source_idx
+		admitted = []
+		misses = 0
+		while misses < nsrc and len(admitted) < self.admit:
+			rxq = sources[idx]
+			idx = (idx + 1) % nsrc
+			req = rxq.seek()
+			if req is None:
+				misses += 1
+				continue
+			rxq.dequeue()
+			admitted.append(req)
+			misses = 0
+		self.source_idx = idx
+		if not admitted and self.replicas and self.processing_stack.is_empty():
+			# 手が空いていれば、他のレプリカに溜まった要求を盗む
+			for rq in self.replicas:
+				req = rq.steal(self.thread_id)
+				if req is not None:
+					admitted.append(req)
+					break
+		if 1 < len(admitted) and self.priorities:
+			priorities = self.priorities
+			admitted.sort(key = lambda req: -priorities.get(req.cls, 0))
+		dispatch = self.dispatch
+		stack = self.processing_stack
+		# 先頭に積むので、受け付けた順に実行されるよう逆順に積む
+		for req in reversed(admitted):
+			entry = dispatch.get(req.cls) or self.entry(req.cls)
+			if entry is None:
+				self.forward(req)
+				continue
+			if stats is not None:
+				stats.admit(req)
+			if tracer is not None and req.__class__ is not ProcessingInfo:
+				tracer.admit(req.cls, req.flow)
+			prc, tables = entry
+			if req.__class__ is ProcessingInfo:
+				# FEEDで戻ってきた処理
+				if req.prc is not prc:
+					# 他のレプリカで中断した処理は、このスレッドのレプリカで再開する
+					req.stp = getattr(prc, req.stp.__name__)
+					req.prc = prc
+				stack.push(req)
+			else:
+				stp = req.stp
+				if stp is not None and stp.__self__ is not prc:
+					stp = getattr(prc, stp.__name__)
+				stack.push(ProcessingInfo(prc, req.hdl, stp or tables[type(req.hdl)]))
+		quantum_steps = self.quantum_steps
+		deadline = time.perf_counter() + self.quantum_sec if self.quantum_sec is not None else None
+		nsteps = 0
+		loads = self.loads
+		interceptor = self.interceptor
+		routes = self.routes
+		complete = self.complete
+		mgr = None
 		while True:
 			# Interrupt要求処理
-			interrupt = self.interceptor.seek()
+			interrupt = interceptor.seek()
 			if interrupt:
-				self.interceptor.dequeue()
+				interceptor.dequeue()
+				entry = dispatch.get(interrupt.cls) or self.entry(interrupt.cls)
+				if entry is None:
+					self.forward(interrupt, True)
+					continue
+				if stats is not None:
+					stats.admit(interrupt)
+				if tracer is not None:
+					tracer.admit(interrupt.cls, interrupt.flow)
 				# 実行中の処理を退避
-				self.processing_stack.push(ProcessingInfo(mgr))
+				if mgr is not None:
+					stack.push(mgr)
 				# 割り込み処理を開始
-				prc = self.processes[interrupt.cls]
-				mgr = ProcessingInfo(prc, interrupt.hdl, prc.tables[type(interrupt.hdl)])
-			if mgr.prc is None:
-				stk = self.processing_stack.seek()
-				if stk:
-					# 退避していた処理を復帰
-					self.processing_stack.pop()
-					mgr = stk
-					mgr.hdl.status = TblStatus.RUN
-				else:
+				prc, tables = entry
+				mgr = ProcessingInfo(prc, interrupt.hdl, interrupt.stp or tables[type(interrupt.hdl)])
+			if mgr is None:
+				mgr = stack.seek()
+				if mgr is None:
 					# 残りの処理がなければ終了
 					break
+				# 退避していた処理を復帰
+				stack.pop()
+				if self.migrated and mgr.cls not in dispatch:
+					self.forward(mgr)
+					mgr = None
+					continue
+				mgr.hdl.status = TblStatus.RUN
+
+			if (quantum_steps is not None and nsteps >= quantum_steps)\
+					or (deadline is not None and time.perf_counter() >= deadline):
+				# 上限に達したら実行中の処理を最後尾に回し、残りは次のstepで実行する
+				stack.enqueue(mgr)
+				self.quantum_exceeded += 1
+				break
+			nsteps += 1
 
 			# 1ステップ実行
-			rc = mgr.stp(mgr.hdl)
-
-			if RC._tag.ERROR == rc.tag:
+			if stats is None and loads is None and tracer is None:
+				rc = mgr.stp(mgr.hdl)
+			else:
+				stp = mgr.stp
+				begin = time.perf_counter()
+				rc = stp(mgr.hdl)
+				sec = time.perf_counter() - begin
+				if stats is not None:
+					stats.step(mgr.prc, stp, sec, RC.tag_of(rc))
+				if loads is not None:
+					loads[mgr.cls] = loads.get(mgr.cls, 0.0) + sec
+				if tracer is not None:
+					tracer.step(mgr.cls, stp, rc, mgr.hdl, begin, sec)
+
+			if rc.__class__ is not RC:
+				# RC.OK
+				mgr.stp = rc
+			elif rc is RC_FEED:
+				if self.deferred or not routes[mgr.cls].enqueue(mgr):
+					self.deferred.append(mgr)
+				mgr = None
+			elif rc is RC_FIN:
+				complete(mgr.hdl, TblStatus.FIN)
+				mgr = None
+			elif rc is RC_PEND:
+				mgr = None
+			elif rc.tag is RC._tag.WAIT:
+				# 全て完了済みならそのまま同じステップを再実行する
+				if not wait_hdls(rc.hdls, mgr.cls, mgr.hdl, mgr.stp):
+					mgr = None
+			else:
 				self.SetError(ErrorProcess.ID.RC_ERROR, "{0}がRC_ERROR({1})を返した".format(mgr.stp, rc.eid))
-				mgr.hdl.status = TblStatus.ERROR
-				mgr.prc = None
-			elif RC._tag.OK == rc.tag:
-				mgr.stp = rc.next
-			elif RC._tag.FEED == rc.tag:
-				self.IF.enqueue(RequestInfo(type(mgr.prc), mgr.hdl))
-				mgr.prc = None
-			elif RC._tag.FIN == rc.tag:
-				mgr.hdl.status = TblStatus.FIN
-				mgr.prc = None
+				complete(mgr.hdl, TblStatus.ERROR)
+				mgr = None
+
+		if self.tickers or self.periodic:
+			# このstepで登録されたタイマーを次の期限に反映する
+			self.tick()
+		if stats is not None:
+			self.sample(stats)
 
 
 class TblSystem:
-	def __init__ (self, num_threads):
+	class SCHEDULE (Enum):
+		# 固定周期(TblSystemTh.SEC)でstepを呼び出す。サイクルのタイミングが決定的
+		CYCLIC = 0
+		# キューへの投入で起床し、要求がなければブロックする
+		EVENT = 1
+		# 全スレッドのstepを呼出元のスレッドで順番に実行し、仮想時計で時刻を進める
+		# 実行できる処理がなくなったら、時計を次のタイマーの期限まで進める
+		SIMULATION = 2
+
+	class ROUTING (Enum):
+		# 全てのRequestをthread_id0のTblSystem.stepが振り分ける
+		CENTRAL = 0
+		# 送信元スレッドから送信先スレッドへのチャネルに直接投入する
+		DIRECT = 1
+
+	class PLACEMENT (Enum):
+		# regist_processで指定したスレッドで実行し続ける
+		STATIC = 0
+		# 処理クラスごとの実行時間を計測し、スレッドの負荷の偏りが大きければ処理を移す
+		BALANCED = 1
+
+	# 負荷分散モードで負荷を見直す間隔
+	REBALANCE_SEC = 1.0
+	# 一番忙しいスレッドの実行時間が間隔のこの割合を超えたら処理の移動を検討する
+	REBALANCE_BUSY = 0.5
+
+	def __init__ (self, num_threads, schedule = SCHEDULE.CYCLIC, queue_cls = None, queue_size = None, growable = False\
+			, routing = ROUTING.CENTRAL, quantum_steps = None, quantum_sec = None, admit = TblSystemTh.ADMIT\
+			, placement = PLACEMENT.STATIC, overflow = None, overflow_timeout = None, seed = None):
 		if num_threads < 1:
 			raise RuntimeError("Thread size is less than zero: {0}".format(num_threads))
+		self.schedule = schedule
+		self.routing = routing
+		self.placement = placement
+		self.clock = VirtualClock() if TblSystem.SCHEDULE.SIMULATION == schedule else Clock()
+		# 処理が使う乱数。シミュレーションモードでseedを固定すれば実行結果を再現できる
+		self.random = random.Random(seed)
+		# Offloadでexecutorを指定しなかったときに使うexecutor
+		self.executor = None
+		# 負荷分散で移動しない処理
+		self.pinned = set()
+		# 処理の移動の履歴
+		self.migrations = []
+		# 前回の見直し時の thread_id -> 処理クラスごとの実行時間の累計
+		self.m_prev_loads = {}
+		# 最後に移動を指示した時刻
+		self.m_moved = {}
+		self.m_rebalanced = time.time()
+		# キューの実装と容量
+		self.queue_cls = queue_cls if queue_cls is not None else RingQueue
+		self.queue_size = queue_size if queue_size is not None else Queue.SIZE
+		self.growable = growable
+		# キューが満杯のときの扱い (指定がなければgrowableならSPILL、そうでなければREJECT)
+		if overflow is None:
+			overflow = Queue.OVERFLOW.SPILL if growable else Queue.OVERFLOW.REJECT
+		if Queue.OVERFLOW.SPILL == overflow and not issubclass(self.queue_cls, RingQueue):
+			raise RuntimeError("{0} requires RingQueue".format(overflow))
+		check_block(overflow, overflow_timeout)
+		self.overflow = overflow
+		self.overflow_timeout = overflow_timeout
 		self.threads = []
 		self.tthreads = []
 		self.tx_queues = []
 		self.rx_queues = []
 		self.interceptors = []
-		self.processes = []
+		# channels[送信元][送信先] (直接ルーティングモードのみ)
+		self.channels = []
+		self.processes = ProcessRegistry()
 		self.transport = {}
+		# 複製した処理のクラス -> ReplicaQueue
+		self.replicas = {}
+		# 繰り返しを数えたまま送っていないSetError。ErrorProcessが周期ごとに送る
+		#   (ErrorProcessのいないOSプロセスでは、そのプロセスのループがflush_errorsで送る)
+		self.error_pending = set()
+		# 全スレッドから参照するログレベル(LogProcessが更新する)
+		self.loglevel = self.new_value(LogProcess.LEVEL.MESSAGE.value)
+		self.route_tables = {}
 
 		for pidx in range(0, num_threads):
-			self.tx_queues.append(Queue())
-			self.rx_queues.append(Queue())
-			self.interceptors.append(Queue())
+			self.tx_queues.append(self.new_queue())
+			self.rx_queues.append(self.new_queue())
+			# 割り込みキューは複数のスレッドから投入される
+			self.interceptors.append(self.new_queue(multi_producer = True))
 
 		for pidx in range(0, num_threads):
 			# スレッドを生成
-			self.threads.append(TblSystemTh(self.tx_queues[pidx], self.rx_queues[pidx], self.interceptors[pidx]))
+			self.threads.append(TblSystemTh(self.tx_queues[pidx], self.rx_queues[pidx], self.interceptors[pidx]\
+						, self.new_queue(growable = True)))
+			self.threads[pidx].quantum_steps = quantum_steps
+			self.threads[pidx].quantum_sec = quantum_sec
+			self.threads[pidx].admit = admit
+
+		if TblSystem.ROUTING.DIRECT == routing:
+			# 送信元と送信先の組ごとに単一生産者/単一消費者のチャネルを持つ
+			self.channels = [[self.new_queue() for dst in range(0, num_threads)] for src in range(0, num_threads)]
+			for dst in range(0, num_threads):
+				self.threads[dst].channels = [self.channels[src][dst] for src in range(0, num_threads)]
+
+		if TblSystem.SCHEDULE.EVENT == schedule:
+			# rx_queue、interceptorへの投入で担当スレッドを起床させる
+			for pidx in range(0, num_threads):
+				self.rx_queues[pidx].notify = self.threads[pidx].wakeup.set
+				self.interceptors[pidx].notify = self.threads[pidx].wakeup.set
+				self.threads[pidx].completions.notify = self.threads[pidx].wakeup.set
+				# tx_queueはthread_id0のTblSystem.stepが振り分ける
+				self.tx_queues[pidx].notify = self.threads[0].wakeup.set
+				for ch in self.threads[pidx].channels:
+					ch.notify = self.threads[pidx].wakeup.set
 
 		# 標準機能
 		self.regist_process(ErrorProcess, 0, 1)
 		self.regist_process(ClockProcess, 0, 1)
 		self.regist_process(FileIOProcess, 0, 100)
 		self.regist_process(LogProcess, 0, 100)
+		self.pinned.update([ErrorProcess, ClockProcess, FileIOProcess, LogProcess])
+
+	def new_value (self, init):
+		return SharedValue(init)
 
-	def regist_process (self, process_cls, thread_id, cycle_msec):
-		if find_if(lambda e: e.cls is process_cls, self.processes):
+	def new_queue (self, growable = None, multi_producer = False):
+		# growableを指定すると満杯のときの扱いはoverflowではなくSPILL/REJECTになる
+		if growable is None:
+			overflow = self.overflow
+		else:
+			overflow = Queue.OVERFLOW.SPILL if growable else Queue.OVERFLOW.REJECT
+		if issubclass(self.queue_cls, RingQueue) and Queue.OVERFLOW.DROP_OLDEST != overflow:
+			queue = self.queue_cls(self.queue_size, Queue.OVERFLOW.SPILL == overflow, multi_producer)
+		elif (multi_producer or Queue.OVERFLOW.DROP_OLDEST == overflow) and not issubclass(self.queue_cls, MutexQueue):
+			# DROP_OLDESTは消費側と排他して捨てる必要がある
+			queue = MutexQueue(self.queue_size)
+		else:
+			queue = self.queue_cls(self.queue_size)
+		if Queue.OVERFLOW.SPILL != overflow or isinstance(queue, RingQueue):
+			queue.set_overflow(overflow, self.overflow_timeout)
+		if Queue.OVERFLOW.DROP_OLDEST == overflow:
+			queue.on_drop = self.discard
+		return queue
+
+	def discard (self, req):
+		# DROP_OLDESTで捨てた要求のHdlを、thread_id0で異常終了させる
+		self.threads[0].completions.enqueue((req.hdl, None))
+
+	def queues (self):
+		# 名前と、スレッド間のキュー
+		for pidx, th in enumerate(self.threads):
+			yield "tx{0}".format(pidx), self.tx_queues[pidx]
+			yield "rx{0}".format(pidx), self.rx_queues[pidx]
+			yield "interceptor{0}".format(pidx), self.interceptors[pidx]
+		for src, channels in enumerate(self.channels):
+			for dst, ch in enumerate(channels):
+				yield "channel{0}_{1}".format(src, dst), ch
+		for cls, rq in self.replicas.items():
+			yield "replica_{0}".format(cls.__name__), rq
+
+	def regist_process (self, process_cls, thread_id, cycle_msec, priority = 0):
+		# thread_idにthread_idの並びを指定すると、それぞれのスレッドに処理のレプリカを置く
+		# 状態をHdlにしか持たない処理向け。要求はレプリカに振り分け、手が空いたレプリカが他から盗む
+		# 割り込みとtransportは先頭のスレッドのレプリカが受け持つ
+		if process_cls in self.processes:
 			raise RuntimeError("Duplicate Resistoration. Process({0})".format(process_cls))
 		if not issubclass(process_cls, BaseTblProcess):
 			raise RuntimeError("Registered Process({0}) doesn't inherit {1}".format(process_cls, BaseTblProcess))
-		if thread_id >= len(self.threads):
-			raise RuntimeError("Registered ThreadId({0}) is more than thread size({1})".format(thread_id, len(self.threads)))
-
-		self.processes.append(ProcessInfo(process_cls, thread_id, cycle_msec))
+		replicas = None
+		if not isinstance(thread_id, int):
+			replicas = tuple(thread_id)
+			if not replicas or len(set(replicas)) != len(replicas):
+				raise RuntimeError("Registered ThreadIds({0}) are empty or duplicated".format(replicas))
+			thread_id = replicas[0]
+		for tid in replicas or (thread_id,):
+			if tid >= len(self.threads):
+				raise RuntimeError("Registered ThreadId({0}) is more than thread size({1})".format(tid, len(self.threads)))
+
+		pinfo = ProcessInfo(process_cls, thread_id, cycle_msec, priority)
+		pinfo.replicas = replicas
+		self.processes.add(pinfo)
 		self.transport[process_cls] = thread_id
+		if replicas:
+			notifies = [self.threads[tid].wakeup.set for tid in replicas] if TblSystem.SCHEDULE.EVENT == self.schedule else None
+			self.replicas[process_cls] = ReplicaQueue(process_cls, replicas, None if self.growable else self.queue_size, notifies)
+			# レプリカは負荷分散で移動しない
+			self.pinned.add(process_cls)
+
+	def regist_processes (self, entries):
+		# (クラス, thread_id, 周期[, 優先度])の並びをまとめて登録する
+		for entry in entries:
+			self.regist_process(*entry)
 
 	def establish (self):
 		for pidx in range(0, len(self.threads)):
-			assignments = [pinfo for pinfo in self.processes if pinfo.thread_id == pidx]
+			assignments = self.processes.assignments(pidx)
 			# スレッドにProcessクラスを割当て
 			for pmgr in assignments:
-				self.threads[pidx].regist_process(self, pmgr.cls)
+				self.threads[pidx].regist_process(self, pmgr.cls, pmgr.priority)
 
-			self.threads[pidx].establish(self)
+			self.threads[pidx].establish(self, pidx)
 
 			# MainHdl要求をキューに追加
 			for pmgr in assignments:
-				if self.rx_queues[pidx].is_full():
-					raise  RuntimeError("cannot insert MainHdl. RequestQueue is full.")
-				else:
-					self.rx_queues[pidx].enqueue(RequestInfo(pmgr.cls, pmgr.cls.MainHdl(pmgr.cycle_msec)))
+				self.start(pidx, pmgr)
 
-			if 0 != pidx:
+			if 0 == pidx:
+				for rq in self.replicas.values():
+					rq.since = self.clock.time()
+			if 0 != pidx and TblSystem.SCHEDULE.SIMULATION != self.schedule:
 				# id0以外の処理は別スレッドで実行
-				th = threading.Thread(target = self.threads[pidx].cyclic_call)
+				th = threading.Thread(target = self.threads[pidx].cyclic_call, args = (self.schedule,))
 				th.start()
 				self.tthreads.append(th)
 
+	def queue_of (self, cls):
+		# 外部から受け取ったclsへの要求を投入するキュー
+		if cls in self.replicas:
+			return self.replicas[cls]
+		return self.rx_queues[self.transport[cls]]
+
+	def start (self, pidx, pmgr):
+		# 処理のMainHdlを、周期実行ならスレッドの予定に登録し、そうでなければ1回だけ要求する
+		if pmgr.cls.PERIODIC:
+			self.threads[pidx].schedule(pmgr.cls, pmgr.cls.MainHdl(pmgr.cycle_msec), pmgr.cycle_msec)
+		elif self.rx_queues[pidx].is_full():
+			raise  RuntimeError("cannot insert MainHdl. RequestQueue is full.")
+		else:
+			self.rx_queues[pidx].enqueue(RequestInfo(pmgr.cls, pmgr.cls.MainHdl(pmgr.cycle_msec)))
+
+	def enable_stats (self, enable = True):
+		# 計測の開始/停止。開始するたびに計測値をリセットする
+		for th in self.threads:
+			th.stats = Stats() if enable else None
+
+	def enable_trace (self, enable = True, classes = None, size = Tracer.SIZE):
+		# トレースの開始/停止。classesを指定すればその処理のクラスだけ記録する
+		for pidx, th in enumerate(self.threads):
+			th.tracer = Tracer(pidx, self.clock, set(classes) if classes is not None else None, size) if enable else None
+
+	def trace_classes (self, classes):
+		# 記録する処理のクラスを実行中に切り替える (Noneなら全て)
+		for th in self.threads:
+			if th.tracer is not None:
+				th.tracer.classes = set(classes) if classes is not None else None
+
+	def export_trace (self, filepath):
+		# 記録したトレースをChrome/Perfetto(ui.perfetto.dev)で読めるJSONで書き出す
+		# 実行中でも書き出せるが、書き出している間に上書きされたレコードは崩れることがある
+		events = []
+		for th in self.threads:
+			if th.tracer is not None:
+				events += th.tracer.events(os.getpid())
+		dirname = os.path.dirname(filepath)
+		if dirname:
+			os.makedirs(dirname, exist_ok = True)
+		with open(filepath, "w", encoding = "utf-8") as fp:
+			json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fp)
+
+	def stats (self):
+		# 実行中に他のスレッドから読み出してよい
+		return {"threads": [dict(thread_id = pidx, **th.stats.dump()) for pidx, th in enumerate(self.threads) if th.stats is not None]\
+				, "quantum_exceeded": [th.quantum_exceeded for th in self.threads]\
+				, "migrations": list(self.migrations)\
+				, "periodic": [dict(thread_id = pidx, process = info.cls.__name__, cycle_msec = info.period * 1000.0\
+						, misses = info.misses, jitter = info.jitter.dump())\
+					for pidx, th in enumerate(self.threads) for info in list(th.periodics.values())]\
+				, "replicas": [replica for rq in list(self.replicas.values()) for replica in rq.dump(self.clock.time())]\
+				, "queues": {name: {"full": queue.full_count, "dropped": queue.dropped}\
+					for name, queue in self.queues() if queue.full_count}}
+
+	def pin (self, cls, thread_id = None):
+		# clsを負荷分散で移動しないようにする。thread_idを指定すればそのスレッドへ移す
+		if cls not in self.transport:
+			raise RuntimeError("{0} is not registered.".format(cls))
+		if thread_id is not None and cls in self.replicas:
+			raise RuntimeError("{0} is replicated and cannot be moved.".format(cls))
+		if thread_id is not None and thread_id >= len(self.threads):
+			raise RuntimeError("ThreadId({0}) is more than thread size({1})".format(thread_id, len(self.threads)))
+		self.pinned.add(cls)
+		src = self.transport[cls]
+		if thread_id is None or thread_id == src:
+			return
+		if self.threads[src].tblsystem is None:
+			# establish前なら割当てを変更するだけ
+			self.processes.move(cls, thread_id)
+			self.transport[cls] = thread_id
+		else:
+			# 移動は実行中のスレッドが次のstepの先頭で行う
+			self.threads[src].orders.append((cls, thread_id))
+			self.threads[src].wakeup.set()
+
+	def unpin (self, cls):
+		self.pinned.discard(cls)
+
+	def relocate (self, cls, src, dst):
+		# clsへの送信先をdstのスレッドに切り替える。移動元のスレッドで呼ばれる
+		self.processes.move(cls, dst)
+		self.transport[cls] = dst
+		if TblSystem.ROUTING.DIRECT == self.routing:
+			for tid, routes in list(self.route_tables.items()):
+				routes[cls] = self.channels[tid][dst]
+		self.migrations.append({"process": cls.__name__, "src": src, "dst": dst, "time": time.time()})
+		if LogProcess.LEVEL.MESSAGE.value >= self.loglevel.value:
+			self.routes(src)[LogProcess].enqueue(RequestInfo(LogProcess\
+					, LogProcess.WriteLogHdl.acquire(LogProcess.LEVEL.MESSAGE, "migrate {0}: thread {1} -> {2}", (cls.__name__, src, dst))))
+
+	def rebalance (self):
+		# 前回からのスレッドごとの実行時間を比べ、一番忙しいスレッドの処理を一番空いているスレッドへ移す
+		now = time.time()
+		window = now - self.m_rebalanced
+		if window < TblSystem.REBALANCE_SEC:
+			return
+		self.m_rebalanced = now
+		loads = {}
+		thread_loads = [0.0] * len(self.threads)
+		for pidx, th in enumerate(self.threads):
+			current = dict(th.loads)
+			prev = self.m_prev_loads.get(pidx, {})
+			for cls, sec in current.items():
+				if cls in self.replicas:
+					# レプリカは移さないので、実行したスレッドの負荷として数える
+					thread_loads[pidx] += sec - prev.get(cls, 0.0)
+				else:
+					loads[cls] = loads.get(cls, 0.0) + sec - prev.get(cls, 0.0)
+			self.m_prev_loads[pidx] = current
+		for cls, sec in loads.items():
+			thread_loads[self.transport[cls]] += sec
+		src = max(range(0, len(self.threads)), key = lambda pidx: thread_loads[pidx])
+		dst = min(range(0, len(self.threads)), key = lambda pidx: thread_loads[pidx])
+		if thread_loads[src] < window * TblSystem.REBALANCE_BUSY:
+			return
+		# 移すと差が縮まる処理のうち、差を一番小さくするものを選ぶ
+		# 直前に移した処理は、移動先での負荷が分かるまで動かさない
+		gap = thread_loads[src] - thread_loads[dst]
+		candidates = [(sec, cls) for cls, sec in loads.items() if self.transport[cls] == src and cls not in self.pinned\
+				and 0.0 < sec < gap and now - self.m_moved.get(cls, 0.0) > 2 * TblSystem.REBALANCE_SEC]
+		if not candidates:
+			return
+		_, cls = min(candidates, key = lambda candidate: abs(gap - 2 * candidate[0]))
+		self.m_moved[cls] = now
+		self.threads[src].orders.append((cls, dst))
+		self.threads[src].wakeup.set()
+
+	def stop (self):
+		# 各スレッドのループを終了させる
+		for th in self.threads:
+			th.running = False
+			th.wakeup.set()
+		for th in self.tthreads:
+			if th is not threading.current_thread():
+				th.join()
+		# ループを抜けていないスレッド(stopを呼んだスレッドなど)は、ループを抜けたところで後始末する
+		for th in self.threads:
+			if not th.looping:
+				th.shutdown()
+
 	def interceptor (self, cls):
-		pmgr = find_if(lambda pmgr: pmgr.cls == cls, self.processes)
+		pmgr = self.processes.get(cls)
 		if not pmgr:
 			raise RuntimeError("{0} is not registered.".format(cls))
 
 		return self.interceptors[pmgr.thread_id]
 
+	def routes (self, thread_id):
+		# thread_idで実行される処理からの送信先キューをクラスごとに解決する
+		# 同じスレッドの処理は同じ表を共有する
+		if thread_id not in self.route_tables:
+			if TblSystem.ROUTING.DIRECT == self.routing:
+				self.route_tables[thread_id] = {pinfo.cls: self.channels[thread_id][pinfo.thread_id] for pinfo in self.processes}
+			else:
+				self.route_tables[thread_id] = {pinfo.cls: self.tx_queues[thread_id] for pinfo in self.processes}
+			# 複製した処理へはルーティングによらずReplicaQueueへ直接投入する
+			self.route_tables[thread_id].update(self.replicas)
+		return self.route_tables[thread_id]
+
+	def flush_errors (self):
+		# 繰り返しが止まって送られずに残っているSetErrorの回数を送る
+		now = self.clock.time()
+		for setter in list(self.error_pending):
+			setter.flush(now)
+
+	def is_idle (self):
+		return all(map(lambda txq: txq.is_empty(), self.tx_queues)) and self.threads[0].is_idle()
+
 	def step (self):
 		# tx_queuesに入ってくるrequestをrx_queuesに振り分ける
 		for txq in self.tx_queues:
 			while True:
 				req = txq.seek()
-				if req:
-					txq.dequeue()
-					self.rx_queues[self.transport[req.cls]].enqueue(req)
-				else:
+				if not req:
+					break
+				# 送信先が満杯なら送信元に残し、次のstepで振り分ける(送信元のキューが溢れ方を決める)
+				rxq = self.rx_queues[self.transport[req.cls]]
+				if rxq.is_full():
 					break
+				txq.dequeue()
+				rxq.enqueue(req)
+		if TblSystem.PLACEMENT.BALANCED == self.placement:
+			self.rebalance()
 		# thread_id0の処理はここで行う
 		self.threads[0].step()
 
+	def attach (self):
+		# thread_id0のキューと、TblSystem.stepが振り分けるtx_queuesは呼出元のスレッドが読む
+		self.threads[0].attach()
+		for txq in self.tx_queues:
+			txq.consumer = threading.get_ident()
+
 	def cyclic_call (self):
-		cyclic_caller(self.step, TblSystemTh.SEC)
+		th = self.threads[0]
+		self.attach()
+		th.looping = True
+		try:
+			if TblSystem.SCHEDULE.EVENT == self.schedule:
+				event_caller(self.step, self.is_idle, th.wakeup, lambda: th.running, th.timeout)
+			elif TblSystem.SCHEDULE.SIMULATION == self.schedule:
+				self.simulate()
+			else:
+				cyclic_caller(self.step, TblSystemTh.SEC, lambda: th.running)
+		finally:
+			th.looping = False
+			if not th.running:
+				th.shutdown()
+
+	def simulate (self, sec = None):
+		# シミュレーションモードで仮想時計のsec秒(Noneならstopするか処理がなくなるまで)実行する
+		# 戻った後に再び呼べば続きから実行する
+		if TblSystem.SCHEDULE.SIMULATION != self.schedule:
+			raise RuntimeError("simulate requires SCHEDULE.SIMULATION")
+		clock = self.clock
+		end = None if sec is None else clock.time() + sec
+		# 全スレッドのキューを呼出元のスレッドが読む
+		self.attach()
+		for th in self.threads[1:]:
+			th.attach()
+		due = lambda th: th.deadline is not None and th.deadline <= clock.now
+		while self.threads[0].running:
+			# 要求もタイマーの期限もないスレッドは飛ばす
+			busy = False
+			if not self.is_idle() or due(self.threads[0]):
+				self.step()
+				busy = True
+			for th in self.threads[1:]:
+				if not th.is_idle() or due(th):
+					th.step()
+					busy = True
+			if busy:
+				continue
+			# 実行できる処理がなければ、次のタイマーの期限まで時計を進める
+			deadlines = [th.deadline for th in self.threads if th.deadline is not None]
+			if not deadlines:
+				break
+			deadline = min(deadlines)
+			if end is not None and deadline > end:
+				break
+			clock.advance(deadline)
+		if end is not None:
+			clock.advance(end)
 
 class Queue:
 	SIZE = 1024
-	def __init__ (self):
-		self.buffer = [None] * Queue.SIZE
+	# BLOCKで空きを待つときの確認間隔
+	BLOCK_SEC = 0.0001
+
+	class OVERFLOW (Enum):
+		# 投入せずにenqueueがFalseを返す
+		REJECT = 0
+		# 空くまでtimeout秒待つ。空かなければREJECTと同じ
+		# 消費側のスレッド自身が投入するときは、待っても空かないのでREJECTと同じ
+		BLOCK = 1
+		# 一番古い要素を捨てて投入する (MutexQueueのみ)
+		DROP_OLDEST = 2
+		# 容量を超えた分も全て保持する (growableなRingQueueのみ)
+		SPILL = 3
+
+	def __init__ (self, size = SIZE, notify = None):
+		self.size = size
+		self.buffer = [None] * size
 		self.head = 0
 		self.tail = 0
+		# 投入時に呼び出す(イベント駆動モードで受信側スレッドを起床させる)
+		self.notify = notify
+		# 満杯のときの扱い
+		self.overflow = Queue.OVERFLOW.REJECT
+		self.timeout = None
+		# 満杯だった回数と、DROP_OLDESTで捨てた数
+		self.full_count = 0
+		self.dropped = 0
+		# DROP_OLDESTで捨てた要素を渡す
+		self.on_drop = None
+		# 消費側のスレッド(threading.get_ident())。分からなければNone
+		self.consumer = None
+
+	def set_overflow (self, overflow, timeout = None):
+		if overflow not in (Queue.OVERFLOW.REJECT, Queue.OVERFLOW.BLOCK):
+			raise RuntimeError("{0} doesn't support {1}".format(type(self).__name__, overflow))
+		check_block(overflow, timeout)
+		self.overflow = overflow
+		self.timeout = timeout
 
 	def __str__ (self):
 		if self.tail < self.head:
@@ -234,22 +1364,38 @@ class Queue:
 			return "<Queue {0}>".format(self.buffer[self.head: self.tail])
 			
 
+	def __len__ (self):
+		return (self.tail - self.head) % self.size
+
 	def is_full (self):
-		return (self.head - self.tail) % Queue.SIZE == 1
+		return (self.head - self.tail) % self.size == 1
 
 	def is_empty (self):
 		return self.head == self.tail
 
 	def enqueue (self, data):
+		# 満杯なら上書きせず、overflowに従う
+		if Queue.is_full(self) and not self.make_room():
+			return False
 		self.buffer[self.tail] = data
-		self.tail = (self.tail + 1) % Queue.SIZE
+		self.tail = (self.tail + 1) % self.size
+		if self.notify:
+			self.notify()
+		return True
+
+	def make_room (self):
+		# 満杯のときに呼ばれる。投入してよければTrue
+		self.full_count += 1
+		if Queue.OVERFLOW.BLOCK == self.overflow and self.consumer != threading.get_ident():
+			return wait_until(lambda: not Queue.is_full(self), self.timeout)
+		return False
 
 	def dequeue (self):
 		self.buffer[self.head] = None
-		self.head = (self.head + 1) % Queue.SIZE
+		self.head = (self.head + 1) % self.size
 
 	def push (self, data):
-		self.head = (self.head - 1) if self.head > 0 else Queue.SIZE - 1
+		self.head = (self.head - 1) if self.head > 0 else self.size - 1
 		self.buffer[self.head] = data
 
 	def pop (self):
@@ -259,31 +1405,54 @@ class Queue:
 		return self.buffer[self.head]
 
 class MutexQueue (Queue):
-	def __init__ (self):
-		super().__init__()
+	def __init__ (self, size = Queue.SIZE, notify = None):
+		super().__init__(size, notify)
 		self.head_lock = threading.Lock()
 		self.tail_lock = threading.Lock()
 
+	def set_overflow (self, overflow, timeout = None):
+		if Queue.OVERFLOW.SPILL == overflow:
+			raise RuntimeError("{0} doesn't support {1}".format(type(self).__name__, overflow))
+		check_block(overflow, timeout)
+		self.overflow = overflow
+		self.timeout = timeout
+
+	# ロックはtail_lock、head_lockの順に取る
 	def is_full (self):
-		self.head_lock.acquire()
 		self.tail_lock.acquire()
+		self.head_lock.acquire()
 		ans = super().is_full()
-		self.tail_lock.release()
 		self.head_lock.release()
+		self.tail_lock.release()
 		return ans
 
 	def is_empty (self):
-		self.head_lock.acquire()
 		self.tail_lock.acquire()
+		self.head_lock.acquire()
 		ans = super().is_empty()
-		self.tail_lock.release()
 		self.head_lock.release()
+		self.tail_lock.release()
 		return ans
 
 	def enqueue (self, data):
 		self.tail_lock.acquire()
-		super().enqueue(data)
+		res = super().enqueue(data)
 		self.tail_lock.release()
+		return res
+
+	def make_room (self):
+		# tail_lockを持った状態で呼ばれる
+		if Queue.OVERFLOW.DROP_OLDEST == self.overflow:
+			self.full_count += 1
+			self.head_lock.acquire()
+			data = Queue.seek(self)
+			Queue.dequeue(self)
+			self.head_lock.release()
+			self.dropped += 1
+			if self.on_drop:
+				self.on_drop(data)
+			return True
+		return super().make_room()
 
 	def dequeue (self):
 		self.head_lock.acquire()
@@ -301,6 +1470,288 @@ class MutexQueue (Queue):
 		self.head_lock.release()
 		return res
 
+# 単一生産者/単一消費者のリングバッファ
+# * 容量は2のべき乗に切り上げ、添字は%ではなくマスクで求める
+# * head、tailは単調増加のカウンタで、enqueueはtail、dequeueはheadだけを書き換える
+# * growable=Trueの場合、満杯になると生産者が倍の容量のリングを繋いで書き込み先を移す。
+#   消費者は古いリングを読み切ってから新しいリングへ移る
+# * multi_producer=Trueの場合、enqueueだけをロックする(割り込みキュー用)
+# * 満杯のときの扱いはREJECT、BLOCK、SPILL(growable)から選ぶ
+class RingQueue:
+	__slots__ = ("rd", "wr", "growable", "lock", "notify", "overflow", "timeout", "full_count", "dropped", "consumer")
+	class _Ring:
+		__slots__ = ("buffer", "mask", "head", "tail", "next")
+		def __init__ (self, size):
+			capacity = 1
+			while capacity < size:
+				capacity <<= 1
+			self.buffer = [None] * capacity
+			self.mask = capacity - 1
+			self.head = 0
+			self.tail = 0
+			# 拡張後のリング
+			self.next = None
+
+	def __init__ (self, size = Queue.SIZE, growable = False, multi_producer = False, notify = None):
+		self.rd = self.wr = RingQueue._Ring(size)
+		self.growable = growable
+		self.lock = threading.Lock() if multi_producer else None
+		self.notify = notify
+		self.overflow = Queue.OVERFLOW.SPILL if growable else Queue.OVERFLOW.REJECT
+		self.timeout = None
+		self.full_count = 0
+		self.dropped = 0
+		self.consumer = None
+
+	def set_overflow (self, overflow, timeout = None):
+		if Queue.OVERFLOW.DROP_OLDEST == overflow:
+			raise RuntimeError("{0} doesn't support {1}".format(type(self).__name__, overflow))
+		check_block(overflow, timeout)
+		self.overflow = overflow
+		self.timeout = timeout
+		self.growable = Queue.OVERFLOW.SPILL == overflow
+
+	def __str__ (self):
+		items = []
+		ring = self.rd
+		while ring is not None:
+			items += [ring.buffer[idx & ring.mask] for idx in range(ring.head, ring.tail)]
+			ring = ring.next
+		return "<RingQueue {0}>".format(items)
+
+	def __len__ (self):
+		depth = 0
+		ring = self.rd
+		while ring is not None:
+			depth += ring.tail - ring.head
+			ring = ring.next
+		return depth
+
+	def capacity (self):
+		return self.wr.mask + 1
+
+	def _reader (self):
+		# 読み切ったリングから拡張先のリングへ移る
+		# nextを先に読むことで、古いリングへの書き込みが全て見えている状態で判定する
+		rd = self.rd
+		while True:
+			nxt = rd.next
+			if nxt is None or rd.head != rd.tail:
+				return rd
+			rd = nxt
+			self.rd = rd
+
+	def is_full (self):
+		if self.growable:
+			return False
+		wr = self.wr
+		return wr.tail - wr.head > wr.mask
+
+	def is_empty (self):
+		rd = self._reader()
+		return rd.head == rd.tail
+
+	def enqueue (self, data):
+		if self.lock:
+			with self.lock:
+				res = self._enqueue(data)
+			if res and self.notify:
+				self.notify()
+			return res
+		wr = self.wr
+		if wr.tail - wr.head > wr.mask:
+			if not self._make_room():
+				# 満杯のときは上書きせずに失敗を返す
+				return False
+			wr = self.wr
+		wr.buffer[wr.tail & wr.mask] = data
+		wr.tail += 1
+		if self.notify:
+			self.notify()
+		return True
+
+	def _enqueue (self, data):
+		wr = self.wr
+		if wr.tail - wr.head > wr.mask:
+			if not self._make_room():
+				return False
+			wr = self.wr
+		wr.buffer[wr.tail & wr.mask] = data
+		wr.tail += 1
+		return True
+
+	def _make_room (self):
+		# 満杯のときに生産者側で呼ばれる。書き込めるようになればTrue
+		self.full_count += 1
+		if self.growable:
+			return self._grow()
+		if Queue.OVERFLOW.BLOCK == self.overflow and self.consumer != threading.get_ident():
+			wr = self.wr
+			return wait_until(lambda: wr.tail - wr.head <= wr.mask, self.timeout)
+		return False
+
+	def _grow (self):
+		wr = self.wr
+		nxt = RingQueue._Ring((wr.mask + 1) << 1)
+		wr.next = nxt
+		self.wr = nxt
+		return True
+
+	def dequeue (self):
+		rd = self.rd
+		if rd.head == rd.tail:
+			rd = self._reader()
+		rd.buffer[rd.head & rd.mask] = None
+		rd.head += 1
+
+	def push (self, data):
+		# 先頭への挿入は消費側スレッドだけが行う(processing_stack用)
+		rd = self._reader()
+		if rd.tail - rd.head > rd.mask:
+			if not self.growable:
+				return False
+			# 消費側で全要素を倍の容量のリングへ移し替える
+			items = []
+			while not self.is_empty():
+				items.append(self.seek())
+				self.dequeue()
+			rd = RingQueue._Ring(max(len(items) + 1, rd.mask + 1) << 1)
+			for item in items:
+				rd.buffer[rd.tail & rd.mask] = item
+				rd.tail += 1
+			self.rd = self.wr = rd
+		rd.head -= 1
+		rd.buffer[rd.head & rd.mask] = data
+		return True
+
+	def pop (self):
+		self.dequeue()
+
+	def seek (self):
+		rd = self.rd
+		if rd.head == rd.tail:
+			if rd.next is None:
+				return None
+			rd = self._reader()
+		return rd.buffer[rd.head & rd.mask]
+
+class ReplicaQueue:
+	# 複製した処理への要求を、レプリカ(担当スレッド)ごとのdequeに振り分ける
+	# 投入はどのスレッドからでもよい。レプリカは自分のdequeの先頭から取り出し
+	# 手が空いたレプリカは、他のレプリカのdequeの末尾から盗む
+	# (dequeのappend/popleft/popはそれぞれ不可分なので、取り合っても同じ要求を2度取り出さない)
+	def __init__ (self, cls, thread_ids, size = Queue.SIZE, notifies = None):
+		self.cls = cls
+		self.thread_ids = thread_ids
+		# レプリカ1つあたりの容量 (Noneなら無制限)
+		self.size = size
+		self.notifies = notifies
+		self.m_deques = [collections.deque() for _ in thread_ids]
+		self.m_index = {tid: idx for idx, tid in enumerate(thread_ids)}
+		self.m_next = 0
+		# レプリカごとの、受け付けた要求の数と、そのうち他のレプリカから盗んだ数
+		self.served = [0] * len(thread_ids)
+		self.stolen = [0] * len(thread_ids)
+		# 取り出して受け付ける前の要求 (レプリカごと)
+		self.m_held = [None] * len(thread_ids)
+		self.since = None
+		self.full_count = 0
+		self.dropped = 0
+
+	def __len__ (self):
+		return sum(map(len, self.m_deques))
+
+	def is_full (self):
+		return self.size is not None and all(map(lambda dq: len(dq) >= self.size, self.m_deques))
+
+	def is_empty (self):
+		return not any(self.m_deques) and all(map(lambda held: held is None, self.m_held))
+
+	def enqueue (self, req):
+		deques = self.m_deques
+		idx = None
+		if req.stp is not None:
+			# 中断した処理の再開は中断したレプリカへ戻す (忙しければ他のレプリカが盗む)
+			idx = self.m_index.get(req.stp.__self__.th.thread_id)
+		if idx is None:
+			# 待ちの一番少ないレプリカへ。同じなら順番に
+			start = self.m_next
+			self.m_next = (start + 1) % len(deques)
+			idx = start
+			depth = len(deques[start])
+			for k in range(1, len(deques)):
+				i = (start + k) % len(deques)
+				if len(deques[i]) < depth:
+					idx = i
+					depth = len(deques[i])
+		if self.size is not None and len(deques[idx]) >= self.size:
+			self.full_count += 1
+			return False
+		deques[idx].append(req)
+		if self.notifies:
+			if 1 < len(deques[idx]):
+				# 待ちができたら、休んでいるレプリカにも盗ませる
+				for notify in self.notifies:
+					notify()
+			else:
+				self.notifies[idx]()
+		return True
+
+	def source (self, thread_id):
+		# thread_idのレプリカが受付に使うキュー
+		return ReplicaSource(self, self.m_index[thread_id])
+
+	def steal (self, thread_id):
+		# 一番待ちの多い他のレプリカの末尾から1つ盗む。なければNone
+		idx = self.m_index[thread_id]
+		deques = self.m_deques
+		victim = max((i for i in range(len(deques)) if i != idx), key = lambda i: len(deques[i]), default = None)
+		if victim is None:
+			return None
+		try:
+			req = deques[victim].pop()
+		except IndexError:
+			return None
+		self.stolen[idx] += 1
+		if req.stp is None:
+			self.served[idx] += 1
+		return req
+
+	def dump (self, now):
+		elapsed = now - self.since if self.since is not None else 0.0
+		return [{"process": self.cls.__name__, "thread_id": tid, "served": self.served[idx], "stolen": self.stolen[idx]\
+				, "queued": len(self.m_deques[idx]), "per_sec": self.served[idx] / elapsed if 0.0 < elapsed else 0.0}\
+				for idx, tid in enumerate(self.thread_ids)]
+
+class ReplicaSource:
+	# レプリカが自分のdequeから受け付けるためのseek/dequeue
+	# 盗まれないよう、seekの時点でdequeから取り出して保持する
+	def __init__ (self, replicas, idx):
+		self.replicas = replicas
+		self.idx = idx
+		self.m_deque = replicas.m_deques[idx]
+
+	def __len__ (self):
+		return len(self.m_deque) + (self.replicas.m_held[self.idx] is not None)
+
+	def is_empty (self):
+		return self.replicas.m_held[self.idx] is None and not self.m_deque
+
+	def seek (self):
+		held = self.replicas.m_held
+		if held[self.idx] is None:
+			try:
+				held[self.idx] = self.m_deque.popleft()
+			except IndexError:
+				return None
+		return held[self.idx]
+
+	def dequeue (self):
+		held = self.replicas.m_held
+		if held[self.idx].stp is None:
+			self.replicas.served[self.idx] += 1
+		held[self.idx] = None
+
 class TblStatus (Enum):
 	ERROR = -1
 	INIT = 0
@@ -308,33 +1759,152 @@ class TblStatus (Enum):
 	FIN = 2
 
 class BaseHdl:
+	# 派生クラスで__slots__を宣言すると、__dict__を持たない小さなHdlになる
+	# (宣言しなければ従来通り__dict__を持つ)
+	__slots__ = ("status", "waiters")
+	# 0より大きければ、releaseしたHdlをこの数までクラスごとに保持し、acquireで再利用する
+	POOL_SIZE = 0
+	# Trueなら完了を誰も参照しない(送りっぱなしの)Hdlとして、FINになったときにTblSystemThがreleaseする
+	RELEASE_ON_FIN = False
+	m_free = []
+
+	def __init_subclass__ (cls, **kwargs):
+		super().__init_subclass__(**kwargs)
+		cls.m_free = []
+
 	def __init__ (self):
 		self.status = TblStatus.INIT
+		# RC.WAITでこのHdlの完了を待っている処理
+		self.waiters = None
+
+	@classmethod
+	def acquire (cls, *args, **kwargs):
+		# プールにあれば__init__し直して再利用し、なければ生成する
+		try:
+			hdl = cls.m_free.pop()
+		except IndexError:
+			return cls(*args, **kwargs)
+		hdl.__init__(*args, **kwargs)
+		return hdl
+
+	def release (self):
+		# 完了して誰も参照しなくなったHdlをプールに戻す
+		free = type(self).m_free
+		if self.waiters is None and len(free) < self.POOL_SIZE:
+			free.append(self)
+
+	def is_done (self):
+		return TblStatus.FIN == self.status or TblStatus.ERROR == self.status
+
+	# 別プロセスへ送るときは完了待ちの情報を含めない
+	def __getstate__ (self):
+		state = dict(getattr(self, "__dict__", ()))
+		for cls in type(self).__mro__:
+			for name in cls.__dict__.get("__slots__", ()):
+				if hasattr(self, name):
+					state[name] = getattr(self, name)
+		state.pop("waiters", None)
+		return state
+
+	def __setstate__ (self, state):
+		for name, value in state.items():
+			setattr(self, name, value)
+		self.waiters = None
 
 
 class BaseTblProcess:
+	# Trueなら、regist_processの周期でTblSystemThがMainHdlのテーブルを起動する (テーブルは周期ごとにFINで終える)
+	# Falseなら、MainHdlを1回だけ要求し、処理が自分で待ってMainHdlを要求し直す
+	PERIODIC = False
+
 	def __init__ (self, tx_queue):
 		# メッセージIF
 		self.IF = tx_queue
 		self.tables = {}
 
 	def establish (self, tblsystem):
+		# 時刻はtime.time()ではなくclockから読む(シミュレーションモードでは仮想時計)
+		self.clock = tblsystem.clock
+		self.random = tblsystem.random
+		self.executor = tblsystem.executor
 		# SetErrorは割り込みで実行する
 		self.err_interceptor = tblsystem.interceptor(ErrorProcess)
-		def _seterr (eid, msg):
-			if self.err_interceptor.is_full():
-				raise RuntimeError("{0} insert Error, but ErrorQueue is full".format(type(self)))
-			else:
-				self.err_interceptor.enqueue(\
-						RequestInfo(ErrorProcess\
-							, ErrorProcess.SetErrorHdl(eid, msg)))
-		self.SetError = _seterr
+		self.SetError = ErrorProcess.setter(self.err_interceptor, type(self).__name__, self.clock, tblsystem.error_pending)
 
 		# よく使う関数を登録
-		self.Request = lambda cls, hdl: self.IF.enqueue(RequestInfo(cls, hdl))
-		self.WriteLog = lambda msg:\
-						self.Request(LogProcess, LogProcess.WriteLogHdl(msg))
-
+		self.bind(tblsystem, tblsystem.transport[type(self)])
+
+		# 出力されないレベルのログはHdlを作らずに捨てる
+		# msgが呼出可能ならレベルを満たすときだけ呼び出し、argsがあればLogProcessで整形する
+		loglevel = tblsystem.loglevel
+		def _writelog (msg, *args, level = LogProcess.LEVEL.MESSAGE):
+			if level.value < loglevel.value:
+				return
+			if callable(msg):
+				msg = msg()
+			self.Request(LogProcess, LogProcess.WriteLogHdl.acquire(level, msg, args))
+		self.WriteLog = _writelog
+
+
+	def bind (self, tblsystem, thread_id):
+		# 実行するスレッドに依存するものを設定する。処理を他のスレッドへ移したときにも呼ばれる
+		# 送信先のキューはここで解決しておく
+		routes = tblsystem.routes(thread_id)
+		th = tblsystem.threads[thread_id]
+		self.routes = routes
+		self.th = th
+		self.completions = th.completions
+		def _request (cls, hdl):
+			req = RequestInfo(cls, hdl)
+			if th.stats is not None:
+				req.t = time.perf_counter()
+			if th.tracer is not None:
+				th.tracer.send(type(self), cls, req)
+			if routes[cls].enqueue(req):
+				return True
+			# 送信先が満杯で受け付けられなければ、Hdlを異常終了させてErrorProcessへ通知する
+			hdl.status = TblStatus.ERROR
+			# ErrorProcessへのキューも満杯なら通知しない(満杯になった回数はキューが数えている)
+			if not self.err_interceptor.is_full():
+				self.SetError(ErrorProcess.ID.QUEUE_FULL, "{0}への要求{1}を投入できない".format(cls.__name__, type(hdl).__name__))
+			return False
+		self.Request = _request
+
+	def tick (self):
+		# 各stepの先頭で呼ばれる。次に呼んでほしい時刻(clock.time()基準)を返す
+		# 上書きした処理だけがTblSystemThに登録される
+		return None
+
+	def shutdown (self):
+		# TblSystem.stopで、処理を実行するスレッドが止まった後に呼ばれる
+		# 自分で作ったスレッドプールなどはここで閉じる
+		pass
+
+	def Offload (self, executor, hdl, fn, *args):
+		# 待ち時間のある処理fnをexecutorで実行し、終わったらこの処理のスレッドでhdlを完了させる
+		# 呼出元のステップはRC.PEND()を返す。fnが例外を送出したらhdlはERRORになる
+		# executorがNoneならTblSystemのexecutorを使う
+		# シミュレーションモードでは結果を再現できるよう、その場で実行する
+		completions = self.completions
+		if self.clock.virtual:
+			future = concurrent.futures.Future()
+			try:
+				future.set_result(fn(*args))
+			except Exception as e:
+				future.set_exception(e)
+			completions.enqueue((hdl, future))
+			return future
+		if executor is None:
+			executor = self.executor
+			if executor is None:
+				raise RuntimeError("{0} has no executor".format(type(self)))
+		future = executor.submit(fn, *args)
+		future.add_done_callback(lambda future: completions.enqueue((hdl, future)))
+		return future
+
+	def Finish (self, hdl, status = None):
+		# RC.PENDで保持していたHdlを完了させる
+		self.th.complete(hdl, TblStatus.FIN if status is None else status)
 
 	def regist_table (self, tbltop, hdl_cls):
 		if not hasattr(self, tbltop.__name__):
@@ -342,6 +1912,7 @@ class BaseTblProcess:
 		self.tables[hdl_cls] = tbltop
 
 class ErrorProcess (BaseTblProcess):
+	PERIODIC = True
 	class LEVEL (Enum):
 		NONE = 0
 		CYCLE = 1
@@ -351,12 +1922,42 @@ class ErrorProcess (BaseTblProcess):
 		NONE = 0
 		RC_ERROR = 1
 		UNDEFINED_ERR = 2
+		QUEUE_FULL = 3
+
+	# 同じ(eid, 発生元)の繰り返しは、この間隔の間は回数だけ数える
+	INTERVAL_SEC = 1.0
+	# 残しておく発生履歴の件数
+	HISTORY = 256
+	# 異常一覧のファイル。1行に1件のJSONで、変わった件だけを追記する
+	# 読む側は{"reset": 時刻}の行より後を(eid, source)ごとに最後の行で上書きすれば一覧になる
+	FILEPATH = "log/errors.jsonl"
+	# 最後の書き出しからこの時間が経ったらMainHdlの周期で書き出す
+	FLUSH_SEC = 0.1
+	# 追記した行がこの数を超えたら、今の一覧だけで書き直す
+	COMPACT_LINES = 4096
 
 	def __init__ (self, tx_queue):
 		super().__init__(tx_queue)
 
-		self.m_errors = []
+		# (eid, 発生元) -> 異常の情報(JSONにする辞書)
+		self.m_errors = {}
+		# (eid, 発生元) -> 最後に履歴へ残した時刻
+		self.m_recorded = {}
+		self.m_history = collections.deque(maxlen = ErrorProcess.HISTORY)
+		self.m_level = ErrorProcess.LEVEL.NONE
 		self.m_interceptors = []
+		self.m_resets = []
+		self.m_filepath = ErrorProcess.FILEPATH
+		# 書き直すときに置き換えるので、FileIOProcessに開いたままにさせず自分で開く
+		# ファイル操作はステップ内で行わず、順番を保つため1つのスレッドのプールに任せる(m_fpはそのスレッドだけが触る)
+		self.m_fp = None
+		self.m_pool = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+		# 繰り返しを数えたまま送っていないSetError (TblSystem.error_pending)
+		self.m_pending = set()
+		# 書き出していない変更 ((eid, 発生元)を変わった順に並べる。Noneはリセット)
+		self.m_dirty = {}
+		self.m_lines = 0
+		self.m_flushed = time.time()
 
 		self.regist_table(self.main_countup,	ErrorProcess.MainHdl)
 		self.regist_table(self.error_event,		ErrorProcess.ErrorEventHdl)
@@ -366,31 +1967,136 @@ class ErrorProcess (BaseTblProcess):
 
 	def establish (self, tblsystem):
 		super().establish(tblsystem)
-		# 自身以外全てのクラスに対する割り込みキュー
-		self.m_interceptors = [(pinfo.cls, tblsystem.interceptor(pinfo.cls)) for pinfo in tblsystem.processes if pinfo.cls != ErrorProcess]
+		# 自身以外で異常イベントを受けるクラスに対する割り込みキューと、リセットを受けるクラス
+		# (ErrorEventHdl、ResetHdlを持たないクラスには送らない)
+		self.m_interceptors = [(pinfo.cls, tblsystem.interceptor(pinfo.cls)) for pinfo in tblsystem.processes\
+				if pinfo.cls != ErrorProcess and hasattr(pinfo.cls, "ErrorEventHdl")]
+		self.m_resets = [pinfo.cls for pinfo in tblsystem.processes if pinfo.cls != ErrorProcess and hasattr(pinfo.cls, "ResetHdl")]
+		self.m_pending = tblsystem.error_pending
+		self.m_flushed = self.clock.time()
+
+	def shutdown (self):
+		# 書き出し中の変更を待ってからプールを閉じる。閉じた後はm_fpを触るスレッドはない
+		self.m_pool.shutdown(wait = True)
+		if self.m_fp is not None:
+			self.m_fp.close()
+			self.m_fp = None
+
+	@staticmethod
+	def setter (interceptor, source, clock, pending = None):
+		# SetErrorを作る。同じeidの繰り返しはINTERVAL_SECの間は送らずに数え、次に送るときに回数を載せる
+		# 数えたまま繰り返しが止まった分は、pendingに登録してErrorProcessの周期処理にflushで送らせる
+		last = {}
+		# eid -> (数えた回数, 最後のmsg)
+		suppressed = {}
+		# 発生元のスレッドとErrorProcessのスレッドの両方から触る
+		lock = threading.Lock()
+		def _send (eid, msg, count):
+			interceptor.enqueue(RequestInfo(ErrorProcess\
+					, ErrorProcess.SetErrorHdl(ErrorProcess.LEVEL.CYCLE, eid, msg, source, count)))
+		def _seterr (eid, msg):
+			now = clock.time()
+			with lock:
+				if eid in last and now - last[eid] < ErrorProcess.INTERVAL_SEC:
+					suppressed[eid] = (suppressed.get(eid, (0, None))[0] + 1, msg)
+					if pending is not None:
+						pending.add(_seterr)
+					return
+				if interceptor.is_full():
+					raise RuntimeError("{0} insert Error, but ErrorQueue is full".format(source))
+				last[eid] = now
+				count = 1 + suppressed.pop(eid, (0, None))[0]
+			_send(eid, msg, count)
+		def _flush (now):
+			# INTERVAL_SECの間に繰り返されなかったeidの回数を送る
+			sends = []
+			with lock:
+				for eid in list(suppressed):
+					if now - last[eid] >= ErrorProcess.INTERVAL_SEC and not interceptor.is_full():
+						count, msg = suppressed.pop(eid)
+						last[eid] = now
+						sends.append((eid, msg, count))
+				if not suppressed and pending is not None:
+					pending.discard(_seterr)
+			for eid, msg, count in sends:
+				_send(eid, msg, count)
+		_seterr.flush = _flush
+		return _seterr
+
+	def flush (self):
+		# 変わった件の行をこのスレッドで作り、書き出しはプールに任せる。追記した行が多くなったら一覧を書き直す
+		if not self.m_dirty:
+			return
+		self.m_flushed = self.clock.time()
+		if self.m_lines + len(self.m_dirty) > ErrorProcess.COMPACT_LINES:
+			self.compact()
+			return
+		lines = []
+		for key in self.m_dirty:
+			if key is None:
+				lines.append(json.dumps({"reset": self.clock.time()}) + "\n")
+			else:
+				lines.append(json.dumps(self.m_errors[key], ensure_ascii = False, default = str) + "\n")
+		self.m_dirty = {}
+		self.m_lines += len(lines)
+		self.Offload(self.m_pool, FileIOProcess.JobHdl(), self.append_job, "".join(lines))
+	def append_job (self, text):
+		try:
+			if self.m_fp is None:
+				dirname = os.path.dirname(self.m_filepath)
+				if dirname:
+					os.makedirs(dirname, exist_ok = True)
+				self.m_fp = open(self.m_filepath, "a", encoding = "utf-8")
+			self.m_fp.write(text)
+			self.m_fp.flush()
+		except OSError:
+			self.m_fp = None
+
+	def compact (self):
+		# 今の一覧を別のファイルに書いて置き換える(読む側が書きかけを見ないように)
+		self.m_dirty = {}
+		lines = [json.dumps({"reset": self.clock.time()}) + "\n"]
+		for error in self.m_errors.values():
+			lines.append(json.dumps(error, ensure_ascii = False, default = str) + "\n")
+		self.m_lines = len(lines)
+		self.Offload(self.m_pool, FileIOProcess.JobHdl(), self.compact_job, "".join(lines))
+	def compact_job (self, text):
+		tmppath = self.m_filepath + ".tmp"
+		try:
+			dirname = os.path.dirname(self.m_filepath)
+			if dirname:
+				os.makedirs(dirname, exist_ok = True)
+			with open(tmppath, "w", encoding = "utf-8") as fp:
+				fp.write(text)
+			os.replace(tmppath, self.m_filepath)
+			if self.m_fp is not None:
+				self.m_fp.close()
+			self.m_fp = open(self.m_filepath, "a", encoding = "utf-8")
+		except OSError:
+			self.m_fp = None
 
 	class MainHdl (BaseHdl):
+		__slots__ = ("i_cycle_msec", "counter")
 		def __init__ (self, cycle_msec):
 			super().__init__()
 			self.i_cycle_msec = cycle_msec
-			self.sleep_hdl = None
 			self.counter = 0
 
 	def main_countup (self, hdl):
 		hdl.counter += 1
-		hdl.sleep_hdl = ClockProcess.SleepSecHdl(hdl.i_cycle_msec / 1000.0)
-		self.Request(ClockProcess, hdl.sleep_hdl)
-		return RC.OK(self.main_waitinterval)
-	def main_waitinterval (self, hdl):
-		if TblStatus.FIN != hdl.sleep_hdl.status:
-			return RC.FEED()
-		return RC.OK(self.main_recur)
-	def main_recur (self, hdl):
-		self.Request(ErrorProcess, hdl)
+		return RC.OK(self.main_flush)
+	def main_flush (self, hdl):
+		now = self.clock.time()
+		# 繰り返しが止まって送られずに残っている回数を送る
+		for setter in list(self.m_pending):
+			setter.flush(now)
+		if now - self.m_flushed >= ErrorProcess.FLUSH_SEC:
+			self.flush()
 		return RC.FIN()
 
 	
 	class ErrorEventHdl (BaseHdl):
+		__slots__ = ("i_level",)
 		def __init__ (self, level):
 			super().__init__()
 			self.i_level = level
@@ -400,6 +2106,7 @@ class ErrorProcess (BaseTblProcess):
 
 
 	class ResetHdl (BaseHdl):
+		__slots__ = ()
 		def __init__ (self):
 			super().__init__()
 
@@ -408,50 +2115,82 @@ class ErrorProcess (BaseTblProcess):
 
 
 	class SetErrorHdl (BaseHdl):
-		def __init__ (self, level, eid, msg):
+		__slots__ = ("i_level", "i_eid", "i_msg", "i_source", "i_count", "hdls")
+		def __init__ (self, level, eid, msg, source = None, count = 1):
 			super().__init__()
-			self.i_level = 0
+			self.i_level = level
 			self.i_eid = eid
 			self.i_msg = msg
+			# 発生元と、呼出元で間引いた分を含めた発生回数
+			self.i_source = source
+			self.i_count = count
 			self.hdls = []
 
 	def seterror_set (self, hdl):
-		self.m_errors.append(hdl)
-		if hdl.i_level > self.m_level:
+		# 同じ(eid, 発生元)は1件にまとめて回数を数え、INTERVAL_SECごとに履歴へ残す
+		now = self.clock.time()
+		key = (hdl.i_eid, hdl.i_source)
+		error = self.m_errors.get(key)
+		if error is None:
+			error = {"eid": hdl.i_eid.value if isinstance(hdl.i_eid, Enum) else hdl.i_eid, "source": hdl.i_source\
+					, "level": hdl.i_level.name, "msg": hdl.i_msg, "count": 0, "first": now, "last": now}
+			self.m_errors[key] = error
+		error["count"] += hdl.i_count
+		error["last"] = now
+		if now - self.m_recorded.get(key, now - ErrorProcess.INTERVAL_SEC) >= ErrorProcess.INTERVAL_SEC:
+			error["level"] = hdl.i_level.name
+			error["msg"] = hdl.i_msg
+			self.m_recorded[key] = now
+			self.m_history.append(dict(error))
+		self.m_dirty[key] = True
+		if hdl.i_level.value > self.m_level.value:
 			# 異常レベルが上がった場合、各クラスの異常イベントを起動する
 			self.m_level = hdl.i_level
 			for cls, interceptor in self.m_interceptors:
-				hdl.hdls.append(cls.ErrorEventHdl(self.m_level))
-				interceptor.enqueue(cls, hdl.hdls[-1])
+				event = cls.ErrorEventHdl(self.m_level)
+				# 割り込みキューが満杯で送れなければ、完了を待たない
+				if interceptor.enqueue(RequestInfo(cls, event)):
+					hdl.hdls.append(event)
 		return RC.OK(self.seterror_waitset)
 	def seterror_waitset (self, hdl):
-		if all(map(lambda hdl: TblStatus.FIN == hdl.status, hdl.hdls)):
+		if all(map(lambda hdl: hdl.is_done(), hdl.hdls)):
 			# 全クラスの異常イベントが完了したら終了
 			return RC.FIN()
-		return RC.FEED()
+		return RC.WAIT(*hdl.hdls)
 
 
 	class ResetErrorHdl (BaseHdl):
+		__slots__ = ("hdls",)
 		def __init__ (self):
 			super().__init__()
+			self.hdls = []
 
 	def reseterror_reset (self, hdl):
-		self.m_errors = []
-		for cls, interceptor in self.m_interceptors:
+		self.m_errors = {}
+		self.m_recorded = {}
+		self.m_dirty = {None: True}
+		# 次の異常で再び各クラスの異常イベントを起動する
+		self.m_level = ErrorProcess.LEVEL.NONE
+		for cls in self.m_resets:
 			hdl.hdls.append(cls.ResetHdl())
 			self.Request(cls, hdl.hdls[-1])
 		return RC.OK(self.reseterror_waitreset)
 	def reseterror_waitreset (self, hdl):
-		if all(map(lambda hdl: TblStatus.FIN == hdl.status, hdl.hdls)):
+		if all(map(lambda hdl: hdl.is_done(), hdl.hdls)):
 			# 全クラスのリセットが完了したら終了
 			return RC.FIN()
-		return RC.FEED()
+		return RC.WAIT(*hdl.hdls)
 
 
 class ClockProcess (BaseTblProcess):
+	PERIODIC = True
 	def __init__ (self, tx_queue):
 		super().__init__(tx_queue)
 
+		# 待機中のSleepSecHdlを期限順に並べたヒープ (期限, 登録順, Hdl)
+		self.m_timers = []
+		self.m_seq = itertools.count()
+
 		self.regist_table(self.main_countup,		ClockProcess.MainHdl)
 		self.regist_table(self.error_event,			ClockProcess.ErrorEventHdl)
 		self.regist_table(self.reset,				ClockProcess.ResetHdl)
@@ -460,27 +2199,19 @@ class ClockProcess (BaseTblProcess):
 		self.regist_table(self.sleepsec_gettime, ClockProcess.SleepSecHdl)
 
 	class MainHdl (BaseHdl):
+		__slots__ = ("i_cycle_msec", "counter")
 		def __init__ (self, cycle_msec):
 			super().__init__()
 			self.i_cycle_msec = cycle_msec
-			self.sleep_hdl = None
 			self.counter = 0
 
 	def main_countup (self, hdl):
 		hdl.counter += 1
-		hdl.sleep_hdl = ClockProcess.SleepSecHdl(hdl.i_cycle_msec / 1000.0)
-		self.Request(ClockProcess, hdl.sleep_hdl)
-		return RC.OK(self.main_waitinterval)
-	def main_waitinterval (self, hdl):
-		if TblStatus.FIN != hdl.sleep_hdl.status:
-			return RC.FEED()
-		return RC.OK(self.main_recur)
-	def main_recur (self, hdl):
-		self.Request(ErrorProcess, hdl)
 		return RC.FIN()
 
 	
 	class ErrorEventHdl (BaseHdl):
+		__slots__ = ("i_level",)
 		def __init__ (self, level):
 			super().__init__()
 			self.i_level = level
@@ -490,6 +2221,7 @@ class ClockProcess (BaseTblProcess):
 
 
 	class ResetHdl (BaseHdl):
+		__slots__ = ()
 		def __init__ (self):
 			super().__init__()
 
@@ -498,75 +2230,109 @@ class ClockProcess (BaseTblProcess):
 
 
 	class GetClockHdl (BaseHdl):
+		__slots__ = ("o_clock",)
 		def __init__ (self):
 			super().__init__()
 			self.o_clock = 0.0
 
 	def getclock_getclock (self, hdl):
-		hdl.o_clock = time.clock()
+		hdl.o_clock = self.clock.perf_counter()
 		return RC.FIN()
 
 
 	class GetTimeHdl (BaseHdl):
+		__slots__ = ("o_time",)
 		def __init__ (self):
 			super().__init__()
 			self.o_time = 0.0
 
 	def gettime_gettime (self, hdl):
-		hdl.o_time = time.time()
+		hdl.o_time = self.clock.time()
 		return RC.FIN()
 
 
 	class SleepSecHdl (BaseHdl):
+		__slots__ = ("i_secs", "begin")
 		def __init__ (self, secs):
 			super().__init__()
 			self.i_secs = secs
 			self.begin = None
 
 	def sleepsec_gettime (self, hdl):
-		hdl.begin = time.time()
-		return RC.OK(self.sleepsec_checkpast)
-	def sleepsec_checkpast (self, hdl):
-		now = time.time()
-		if now - hdl.begin < hdl.i_secs:
-			return RC.FEED()
-
-		return RC.FIN()
+		hdl.begin = self.clock.time()
+		# 期限まではタイマーに預け、tickで完了させる
+		heapq.heappush(self.m_timers, (hdl.begin + hdl.i_secs, next(self.m_seq), hdl))
+		return RC.PEND()
+
+	def tick (self):
+		timers = self.m_timers
+		if not timers:
+			return None
+		now = self.clock.time()
+		while timers and timers[0][0] <= now:
+			_, _, hdl = heapq.heappop(timers)
+			self.Finish(hdl)
+		return timers[0][0] if timers else None
 
 class FileIOProcess (BaseTblProcess):
+	PERIODIC = True
+	# ファイル操作を行うスレッドの数
+	POOL_SIZE = 4
+	# 同時に実行中にできるファイル操作の数。超えた要求は空くまで待たせる
+	MAX_PENDING = 64
+
 	def __init__ (self, tx_queue):
 		super().__init__(tx_queue)
 
 		self.m_files = {}
+		# 開いている最中のファイル (パス -> OpenHdl)
+		self.m_opening = {}
+		# ファイル操作はステップ内で行わず、スレッドプールに任せる
+		self.m_pool = concurrent.futures.ThreadPoolExecutor(max_workers = FileIOProcess.POOL_SIZE)
+		self.m_pending = []
 
 		self.regist_table(self.main_countup,	FileIOProcess.MainHdl)
 		self.regist_table(self.error_event,		FileIOProcess.ErrorEventHdl)
 		self.regist_table(self.reset,			FileIOProcess.ResetHdl)
 		self.regist_table(self.open_isopen,		FileIOProcess.OpenHdl)
 		self.regist_table(self.close_isclose,	FileIOProcess.CloseHdl)
+		self.regist_table(self.read_read,		FileIOProcess.ReadHdl)
+		self.regist_table(self.write_write,		FileIOProcess.WriteHdl)
+		self.regist_table(self.append_append,	FileIOProcess.AppendHdl)
+
+	def shutdown (self):
+		# 実行中のファイル操作を待ってからプールを閉じ、開いたままのファイルを閉じる
+		self.m_pool.shutdown(wait = True)
+		for fp in self.m_files.values():
+			fp.close()
+		self.m_files = {}
+
+	def is_busy (self):
+		if len(self.m_pending) >= FileIOProcess.MAX_PENDING:
+			self.m_pending = [future for future in self.m_pending if not future.done()]
+		return len(self.m_pending) >= FileIOProcess.MAX_PENDING
+
+	def submit (self, hdl, fn, *args):
+		# プールが埋まっていればFEEDで待たせる
+		if self.is_busy():
+			return RC.FEED()
+		self.m_pending.append(self.Offload(self.m_pool, hdl, fn, hdl, *args))
+		return RC.PEND()
 
 	class MainHdl (BaseHdl):
+		__slots__ = ("i_cycle_msec", "counter")
 		def __init__ (self, cycle_msec):
 			super().__init__()
 			self.i_cycle_msec = cycle_msec
-			self.sleep_hdl = None
 			self.counter = 0
 
 	def main_countup (self, hdl):
 		hdl.counter += 1
-		hdl.sleep_hdl = ClockProcess.SleepSecHdl(hdl.i_cycle_msec / 1000.0)
-		self.Request(ClockProcess, hdl.sleep_hdl)
-		return RC.OK(self.main_waitinterval)
-	def main_waitinterval (self, hdl):
-		if TblStatus.FIN != hdl.sleep_hdl.status:
-			return RC.FEED()
-		return RC.OK(self.main_recur)
-	def main_recur (self, hdl):
-		self.Request(ErrorProcess, hdl)
 		return RC.FIN()
 
 
 	class ErrorEventHdl (BaseHdl):
+		__slots__ = ("i_level",)
 		def __init__ (self, level):
 			super().__init__()
 			self.i_level = level
@@ -576,38 +2342,72 @@ class FileIOProcess (BaseTblProcess):
 
 
 	class ResetHdl (BaseHdl):
+		__slots__ = ()
 		def __init__ (self):
 			super().__init__()
 
 	def reset (self, hdl):
 		return RC.FIN()
 
+	class JobHdl (BaseHdl):
+		# プールで実行する操作の完了を、要求したHdlのテーブルで待つためのHdl
+		__slots__ = ()
+
 	class OpenHdl (BaseHdl):
-		def __init__ (self, filepath):
+		__slots__ = ("i_filepath", "i_mode", "o_fp", "o_success", "job_hdl")
+		def __init__ (self, filepath, mode = "r"):
+			super().__init__()
 			self.i_filepath = filepath
+			self.i_mode = mode
 			self.o_fp = None
 			self.o_success = False
+			self.job_hdl = None
 
 	def open_isopen (self, hdl):
 		if hdl.i_filepath in self.m_files:
 			hdl.o_fp = self.m_files[hdl.i_filepath]
 			hdl.o_success = True
 			return RC.FIN()
+		opening = self.m_opening.get(hdl.i_filepath)
+		if opening is not None:
+			# 同じファイルを開いている最中なら、その完了を待ってやり直す
+			return RC.WAIT(opening)
 		return RC.OK(self.open_open)
 	def open_open (self, hdl):
+		if self.is_busy():
+			return RC.FEED()
+		# 開いている最中であることはプールへ渡す前に登録する (プールで先に終わることがある)
+		self.m_opening[hdl.i_filepath] = hdl
+		hdl.job_hdl = FileIOProcess.JobHdl()
+		self.m_pending.append(self.Offload(self.m_pool, hdl.job_hdl, self.open_job, hdl))
+		return RC.OK(self.open_waitopen)
+	def open_job (self, hdl):
+		# プールのスレッドではhdlだけを書き換え、m_files、m_openingはopen_waitopenで更新する
 		try:
-			fp = open(hdl.i_filepath)
-			hdl.o_fp = fp
-			self.m_files[hdl.i_filepath] = fp
+			if "r" != hdl.i_mode:
+				# 書き込みの場合はディレクトリを作成する
+				dirname = os.path.dirname(hdl.i_filepath)
+				if dirname:
+					os.makedirs(dirname, exist_ok = True)
+			hdl.o_fp = open(hdl.i_filepath, hdl.i_mode)
 			hdl.o_success = True
-		except FileNotFoundError as e:
+		except OSError as e:
 			hdl.o_fp = None
 			hdl.o_success = False
+	def open_waitopen (self, hdl):
+		if not hdl.job_hdl.is_done():
+			return RC.WAIT(hdl.job_hdl)
+		hdl.job_hdl = None
+		del self.m_opening[hdl.i_filepath]
+		if hdl.o_success:
+			self.m_files[hdl.i_filepath] = hdl.o_fp
 		return RC.FIN()
 
 	
 	class CloseHdl (BaseHdl):
+		__slots__ = ("i_filepath", "o_success")
 		def __init__ (self, filepath):
+			super().__init__()
 			self.i_filepath = filepath
 			self.o_success = False
 			
@@ -617,53 +2417,214 @@ class FileIOProcess (BaseTblProcess):
 		hdl.o_success = True
 		return RC.FIN()
 	def close_close (self, hdl):
-		fp = self.m_files.pop(hdl.i_filepath)
-		close(fp)
+		if self.is_busy():
+			return RC.FEED()
+		return self.submit(hdl, self.close_job, self.m_files.pop(hdl.i_filepath))
+	def close_job (self, hdl, fp):
+		fp.close()
 		hdl.o_success = True
-		return RC.FIN()
+
+
+	class ReadHdl (BaseHdl):
+		__slots__ = ("i_filepath", "i_offset", "i_size", "i_mmap", "o_data", "o_success")
+		# i_size < 0ならi_offset以降を全て読む
+		# i_mmap=Trueならファイル全体をmmapしてo_dataに返す(コピーせずにスライスできる。使い終わったらcloseする)
+		def __init__ (self, filepath, offset = 0, size = -1, use_mmap = False):
+			super().__init__()
+			self.i_filepath = filepath
+			self.i_offset = offset
+			self.i_size = size
+			self.i_mmap = use_mmap
+			self.o_data = None
+			self.o_success = False
+
+	def read_read (self, hdl):
+		return self.submit(hdl, self.read_job)
+	def read_job (self, hdl):
+		try:
+			with open(hdl.i_filepath, "rb") as fp:
+				if hdl.i_mmap:
+					# 空のファイルはmmapできない
+					if 0 == os.fstat(fp.fileno()).st_size:
+						hdl.o_data = b""
+					else:
+						mm = mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)
+						hdl.o_data = mm
+				else:
+					fp.seek(hdl.i_offset)
+					hdl.o_data = fp.read(hdl.i_size)
+			hdl.o_success = True
+		except OSError as e:
+			hdl.o_data = None
+			hdl.o_success = False
+
+
+	class WriteHdl (BaseHdl):
+		__slots__ = ("i_filepath", "i_data", "o_success")
+		# ファイル全体をi_dataで置き換える。i_dataはstrでもbytesでもよい
+		def __init__ (self, filepath, data):
+			super().__init__()
+			self.i_filepath = filepath
+			self.i_data = data
+			self.o_success = False
+
+	def write_write (self, hdl):
+		return self.submit(hdl, self.write_job, "w")
+	def write_job (self, hdl, mode):
+		try:
+			dirname = os.path.dirname(hdl.i_filepath)
+			if dirname:
+				os.makedirs(dirname, exist_ok = True)
+			with open(hdl.i_filepath, mode + ("b" if isinstance(hdl.i_data, (bytes, bytearray, memoryview)) else "")) as fp:
+				fp.write(hdl.i_data)
+			hdl.o_success = True
+		except OSError as e:
+			hdl.o_success = False
+
+
+	class AppendHdl (WriteHdl):
+		__slots__ = ("i_flush", "i_fsync")
+		# ファイルの末尾にi_dataを追記する
+		# OpenHdlで開いたままのファイルならそこへ書き、i_flush、i_fsyncに従って同期する
+		def __init__ (self, filepath, data, flush = True, fsync = False):
+			super().__init__(filepath, data)
+			self.i_flush = flush
+			self.i_fsync = fsync
+
+	def append_append (self, hdl):
+		fp = self.m_files.get(hdl.i_filepath)
+		if fp is not None:
+			return self.submit(hdl, self.append_job, fp)
+		return self.submit(hdl, self.write_job, "a")
+	def append_job (self, hdl, fp):
+		try:
+			fp.write(hdl.i_data)
+			if hdl.i_flush or hdl.i_fsync:
+				fp.flush()
+			if hdl.i_fsync:
+				os.fsync(fp.fileno())
+			hdl.o_success = True
+		except (OSError, ValueError) as e:
+			# ValueErrorは、書き込む前にCloseHdlで閉じられた場合
+			hdl.o_success = False
 
 
 class LogProcess (BaseTblProcess):
+	PERIODIC = True
 	class LEVEL (Enum):
 		DEBUG = -1
 		MESSAGE = 0
 		WARNING = 1
 		ERROR = 2
 
+	class SYNC (Enum):
+		# 書き出し後の同期方法
+		NONE = 0	# OSのバッファに任せる
+		FLUSH = 1	# 書き出すたびにflushする
+		FSYNC = 2	# 書き出すたびにfsyncする
+
+	# バッファがこのサイズを超えたら即座に書き出す
+	FLUSH_BYTES = 64 * 1024
+	# 最後の書き出しからこの時間が経ったらMainHdlの周期で書き出す
+	FLUSH_SEC = 0.1
+	# バッファの上限。超えた分は破棄して件数を記録する
+	MAX_BYTES = 4 * 1024 * 1024
+
 	def __init__ (self, tx_queue):
 		super().__init__(tx_queue)
 
 		self.m_loglevel = LogProcess.LEVEL.MESSAGE
 		self.m_filepath = "log/{0}.log".format(time.time())
+		self.m_sync = LogProcess.SYNC.FLUSH
+		# ログファイルは最初に書くものができたときにFileIOProcessに開かせ、開いたままにする
+		# バッファはまとめてFileIOProcessのプールで追記する(順番を保つため、追記は1つずつ)
+		self.m_opened = False
+		self.m_open_hdl = None
+		self.m_append_hdl = None
+		# 失敗した追記の数 (FlushHdlが、待つ間に失敗したかを調べる)
+		self.m_append_errors = 0
+		self.m_buffer = []
+		self.m_bytes = 0
+		self.m_dropped = 0
+		self.m_flushed = time.time()
 
 		self.regist_table(self.main_countup,		LogProcess.MainHdl)
 		self.regist_table(self.error_event,			LogProcess.ErrorEventHdl)
 		self.regist_table(self.reset,				LogProcess.ResetHdl)
 		self.regist_table(self.writelog_checklevel, LogProcess.WriteLogHdl)
 		self.regist_table(self.loglevel_loglevel,	LogProcess.LogLevelHdl)
+		self.regist_table(self.flush_waitopen,		LogProcess.FlushHdl)
+
+	def establish (self, tblsystem):
+		super().establish(tblsystem)
+		self.m_shared_level = tblsystem.loglevel
+		self.m_shared_level.value = self.m_loglevel.value
+		self.m_flushed = self.clock.time()
+
+	def open (self):
+		# 書くものがあればログファイルを開かせる。開いたかどうかを返す
+		if self.m_open_hdl is not None and self.m_open_hdl.is_done():
+			# 開けなかった場合は次に書くときに開き直す
+			self.m_opened = self.m_open_hdl.o_success
+			self.m_open_hdl = None
+		if not self.m_opened and self.m_open_hdl is None and (self.m_buffer or self.m_dropped):
+			self.m_open_hdl = FileIOProcess.OpenHdl(self.m_filepath, "a")
+			self.Request(FileIOProcess, self.m_open_hdl)
+		return self.m_opened
+
+	def appended (self):
+		# 前の追記が終わっていれば結果を数えて手放し、次の追記を始められるかを返す
+		hdl = self.m_append_hdl
+		if hdl is None:
+			return True
+		if not hdl.is_done():
+			return False
+		if TblStatus.FIN != hdl.status or not hdl.o_success:
+			self.m_append_errors += 1
+		self.m_append_hdl = None
+		return True
+
+	def flush (self, sync = None):
+		if not (self.m_buffer or self.m_dropped) or not self.open():
+			return
+		if not self.appended():
+			# 前の追記が終わるまでバッファに溜めておく
+			return
+		if self.m_dropped:
+			self.m_buffer.append("{0:.6f} {1} {2} lines dropped\n".format(self.clock.time(), LogProcess.LEVEL.WARNING.name, self.m_dropped))
+			self.m_dropped = 0
+		sync = self.m_sync if sync is None else sync
+		hdl = FileIOProcess.AppendHdl(self.m_filepath, "".join(self.m_buffer)\
+				, LogProcess.SYNC.NONE != sync, LogProcess.SYNC.FSYNC == sync)
+		if not self.Request(FileIOProcess, hdl):
+			# FileIOProcessへのキューが満杯なら次の周期で書き出す
+			return
+		self.m_append_hdl = hdl
+		self.m_buffer = []
+		self.m_bytes = 0
+		self.m_flushed = self.clock.time()
 
 	class MainHdl (BaseHdl):
+		__slots__ = ("i_cycle_msec", "counter")
 		def __init__ (self, cycle_msec):
 			super().__init__()
 			self.i_cycle_msec = cycle_msec
-			self.sleep_hdl = None
 			self.counter = 0
 
 	def main_countup (self, hdl):
 		hdl.counter += 1
-		hdl.sleep_hdl = ClockProcess.SleepSecHdl(hdl.i_cycle_msec / 1000.0)
-		self.Request(ClockProcess, hdl.sleep_hdl)
-		return RC.OK(self.main_waitinterval)
-	def main_waitinterval (self, hdl):
-		if TblStatus.FIN != hdl.sleep_hdl.status:
-			return RC.FEED()
-		return RC.OK(self.main_recur)
-	def main_recur (self, hdl):
-		self.Request(ErrorProcess, hdl)
+		return RC.OK(self.main_openfile)
+	def main_openfile (self, hdl):
+		self.open()
+		return RC.OK(self.main_flush)
+	def main_flush (self, hdl):
+		if self.clock.time() - self.m_flushed >= LogProcess.FLUSH_SEC:
+			self.flush()
 		return RC.FIN()
 
 
 	class ErrorEventHdl (BaseHdl):
+		__slots__ = ("i_level",)
 		def __init__ (self, level):
 			super().__init__()
 			self.i_level = level
@@ -673,6 +2634,7 @@ class LogProcess (BaseTblProcess):
 
 
 	class ResetHdl (BaseHdl):
+		__slots__ = ()
 		def __init__ (self):
 			super().__init__()
 
@@ -681,40 +2643,93 @@ class LogProcess (BaseTblProcess):
 
 
 	class WriteLogHdl (BaseHdl):
-		def __init__ (self, level, msg):
+		__slots__ = ("i_level", "i_msg", "i_args")
+		# WriteLogは送りっぱなしなので、書き終えたら再利用する
+		POOL_SIZE = 1024
+		RELEASE_ON_FIN = True
+		def __init__ (self, level, msg, args = ()):
+			super().__init__()
 			self.i_level = level
 			self.i_msg = msg
-			self.fileopen_hdl = None
-			self.fileclose_hdl = None
+			self.i_args = args
 
 	def writelog_checklevel (self, hdl):
-		if hdl.i_level < self.m_level:
-			return RC.FIN()
-		return RC.OK(self.writelog_openfile)
-	def writelog_openfile (self, hdl):
-		hdl.fileopen_hdl = FileIOProcess.OpenHdl(self.m_filepath)
-		self.Request(FileIOProcess, hdl.fileopen_hdl)
-		return RC.OK(self.writelog_waitopenfile)
-	def writelog_waitopenfile (self, hdl):
-		if TblStatus.FIN == hdl.fileopen_hdl.status:
-			return RC.OK(self.writelog_write)
-		return RC.FEED()
-	def writelog_write (self, hdl):
-		hdl.fileopen_hdl.o_fp.write(hdl.i_msg)
-		return RC.OK(self.writelog_closefile)
-	def writelog_closefile (self, hdl):
-		hdl.fileclose_hdl = FileIOProcess.CloseHdl(self.m_filepath)
-		self.Request(FileIOProcess, hdl.fileclose_hdl)
-		return RC.OK(self.writelog_waitclosefile)
-	def writelog_waitclosefile (self, hdl):
-		if TblStatus.FIN == hdl.fileclose_hdl.status:
+		if hdl.i_level.value < self.m_loglevel.value:
 			return RC.FIN()
-		return RC.FEED()
+		return RC.OK(self.writelog_buffer)
+	def writelog_buffer (self, hdl):
+		try:
+			msg = hdl.i_msg.format(*hdl.i_args) if hdl.i_args else hdl.i_msg
+		except Exception:
+			# 書式と引数が合わなければ、そのまま書いておく
+			# (WriteLogは送りっぱなしで誰もHdlを見ないので、FINで完了してプールへ戻す)
+			msg = "format failed: {0!r} {1!r}".format(hdl.i_msg, hdl.i_args)
+		line = "{0:.6f} {1} {2}\n".format(self.clock.time(), hdl.i_level.name, msg)
+		if self.m_bytes + len(line) > LogProcess.MAX_BYTES:
+			self.m_dropped += 1
+		else:
+			self.m_buffer.append(line)
+			self.m_bytes += len(line)
+			if not self.m_opened:
+				self.open()
+			if self.m_bytes >= LogProcess.FLUSH_BYTES:
+				self.flush()
+		return RC.FIN()
+
 
 	class LogLevelHdl (BaseHdl):
+		__slots__ = ("i_level",)
 		def __init__ (self, level):
+			super().__init__()
 			self.i_level = level
 
 	def loglevel_loglevel (self, hdl):
 		self.m_loglevel = hdl.i_level
+		# 呼出元での判定に使うレベルを公開する
+		self.m_shared_level.value = hdl.i_level.value
+		return RC.FIN()
+
+
+	class FlushHdl (BaseHdl):
+		__slots__ = ("i_sync", "append_hdl", "errors")
+		# バッファを書き出し、書き終えたら完了する
+		# 開けなかった、または待っていた追記が失敗した場合はERRORで完了する
+		def __init__ (self, sync = None):
+			super().__init__()
+			self.i_sync = sync
+			self.append_hdl = None
+			self.errors = 0
+
+	def flush_waitopen (self, hdl):
+		hdl.errors = self.m_append_errors
+		self.open()
+		return RC.OK(self.flush_waitopened)
+	def flush_waitopened (self, hdl):
+		# 開けなかったときは開き直しを待たずに進む
+		if self.m_open_hdl is not None and not self.m_open_hdl.is_done():
+			return RC.WAIT(self.m_open_hdl)
+		return RC.OK(self.flush_waitappend)
+	def flush_waitappend (self, hdl):
+		# 前の追記が終わってから書き出す
+		if not self.appended():
+			return RC.WAIT(self.m_append_hdl)
+		self.flush(hdl.i_sync)
+		if self.m_buffer or self.m_dropped:
+			# 開けなかった、またはFileIOProcessへのキューが満杯で書き出せなかった
+			self.Finish(hdl, TblStatus.ERROR)
+			return RC.PEND()
+		hdl.append_hdl = self.m_append_hdl
+		return RC.OK(self.flush_flush)
+	def flush_flush (self, hdl):
+		if hdl.append_hdl is not None:
+			if not hdl.append_hdl.is_done():
+				return RC.WAIT(hdl.append_hdl)
+			if self.m_append_hdl is hdl.append_hdl:
+				# まだ手放されていなければ、ここで結果を数える
+				self.appended()
+			hdl.append_hdl = None
+		if self.m_append_errors != hdl.errors:
+			# 待っている間に追記が失敗した
+			self.Finish(hdl, TblStatus.ERROR)
+			return RC.PEND()
 		return RC.FIN()
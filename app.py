@@ -1,32 +1,72 @@
 #! /usr/bin/env python3
 
 import re
+import json
+import queue
+import threading
+import concurrent.futures
 from TblSystem import *
 
+class ConsoleReader:
+	# 標準入力を読む専用のスレッド。Offloadのexecutorとして使う
+	# ThreadPoolExecutorは終了時に実行中のinput()を待ってしまうので、デーモンスレッドで読む
+	def __init__ (self):
+		self.m_jobs = queue.SimpleQueue()
+		self.m_thread = threading.Thread(target = self.run, daemon = True)
+		self.m_thread.start()
+
+	def submit (self, fn, *args):
+		future = concurrent.futures.Future()
+		self.m_jobs.put((future, fn, args))
+		return future
+
+	def run (self):
+		while True:
+			future, fn, args = self.m_jobs.get()
+			if not future.set_running_or_notify_cancel():
+				continue
+			try:
+				future.set_result(fn(*args))
+			except BaseException as e:
+				future.set_exception(e)
+
 class CmdlineProcess (BaseTblProcess):
+	PERIODIC = True
 	def __init__ (self, tx_queue):
 		super().__init__(tx_queue)
 
 		self.m_param = 1
+		# 先頭の単語 -> [(パターン, コマンド)]
 		self.m_commands = {}
+		# input()はステップ内で呼ばず、専用のスレッドで読む
+		self.m_reader = ConsoleReader()
 
 		self.regist_table(self.main_countup,	CmdlineProcess.MainHdl)
 		self.regist_table(self.error_event,		CmdlineProcess.ErrorEventHdl)
 		self.regist_table(self.reset,			CmdlineProcess.ResetHdl)
 		self.regist_table(self.keyin_prompt,	CmdlineProcess.KeyinHdl)
 
+	def establish (self, tblsystem):
+		super().establish(tblsystem)
+		# 計測値の表示
+		self.regist_command("stats", r"^stats\s+on$", lambda keyin: tblsystem.enable_stats(True))
+		self.regist_command("stats", r"^stats\s+off$", lambda keyin: tblsystem.enable_stats(False))
+		self.regist_command("stats", r"^stats$", lambda keyin: print(json.dumps(tblsystem.stats(), indent = 1)))
+
+	def regist_command (self, word, pattern, cmd):
+		# 先頭の単語がwordの入力を、同じ単語で先に登録したパターンから照合する
+		self.m_commands.setdefault(word, []).append((re.compile(pattern), cmd))
+
 	class MainHdl (BaseHdl):
+		__slots__ = ("i_cycle_msec", "keyin_hdl", "counter")
 		def __init__ (self, cycle_msec):
 			super().__init__()
 			self.i_cycle_msec = cycle_msec
-			self.sleep_hdl = None
 			self.keyin_hdl = None
 			self.counter = 0
 
 	def main_countup (self, hdl):
 		hdl.counter += 1
-		hdl.sleep_hdl = ClockProcess.SleepSecHdl(hdl.i_cycle_msec / 1000.0)
-		self.Request(ClockProcess, hdl.sleep_hdl)
 		return RC.OK(self.main_checkkeyin)
 	def main_checkkeyin (self, hdl):
 		if hdl.keyin_hdl is None:
@@ -34,29 +74,24 @@ class CmdlineProcess (BaseTblProcess):
 			self.Request(CmdlineProcess, hdl.keyin_hdl)
 		if TblStatus.FIN == hdl.keyin_hdl.status:
 			return RC.OK(self.main_parsecmd)
-		return RC.OK(self.main_waitinterval)
+		return RC.FIN()
 	def main_parsecmd (self, hdl):
-		keyin = hdl.keyin_hdl.o_str
+		keyin = hdl.keyin_hdl.o_str.strip()
+		words = keyin.split(None, 1)
 		found = False
-		for pat, cmd in self.m_commands.items():
+		for pat, cmd in self.m_commands.get(words[0] if words else "", ()):
 			if pat.match(keyin):
 				found = True
 				cmd(keyin)
 				break
-		if not found:
+		if not found and keyin:
 			print("Unknown Command: {0}".format(keyin))
-		self.keyin_hdl = None
-		return RC.OK(self.main_waitinterval)
-	def main_waitinterval (self, hdl):
-		if TblStatus.FIN != hdl.sleep_hdl.status:
-			return RC.FEED()
-		return RC.OK(self.main_recur)
-	def main_recur (self, hdl):
-		self.Request(ErrorProcess, hdl)
+		hdl.keyin_hdl = None
 		return RC.FIN()
 
 	
 	class ErrorEventHdl (BaseHdl):
+		__slots__ = ("i_level",)
 		def __init__ (self, level):
 			super().__init__()
 			self.i_level = level
@@ -66,6 +101,7 @@ class CmdlineProcess (BaseTblProcess):
 
 
 	class ResetHdl (BaseHdl):
+		__slots__ = ()
 		def __init__ (self):
 			super().__init__()
 
@@ -74,6 +110,7 @@ class CmdlineProcess (BaseTblProcess):
 
 	
 	class KeyinHdl (BaseHdl):
+		__slots__ = ("o_str",)
 		def __init__ (self):
 			super().__init__()
 			self.o_str = ""
@@ -83,8 +120,12 @@ class CmdlineProcess (BaseTblProcess):
 		return RC.OK(self.keyin_readkeyin)
 
 	def keyin_readkeyin (self, hdl):
-		self.o_str = input()
-		return RC.FIN()
+		# 読み終わるとこのスレッドでhdlが完了する。標準入力が閉じていればERRORになる
+		self.Offload(self.m_reader, hdl, self.keyin_job, hdl)
+		return RC.PEND()
+
+	def keyin_job (self, hdl):
+		hdl.o_str = input()
 
 
 
@@ -0,0 +1,600 @@
+#! /usr/bin/env python3
+#! -*- coding: utf-8 -*-
+
+# TblSystemのベンチマーク
+# 結果は1行1件のJSONで標準出力に出す(コミット間の比較用)
+#   python bench.py [-n 回数] [-o 出力ファイル] [--compare 比較元ファイル] [ベンチマーク名 ...]
+# --compareを指定すると、同じ条件の結果同士を比べてthreshold以上悪化したものを報告し、終了コード1を返す
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+import threading
+import multiprocessing
+from TblSystem import *
+from TblMultiProcess import ProcessTblSystem
+
+QUEUES = {
+	"Queue": lambda: Queue(),
+	"MutexQueue": lambda: MutexQueue(),
+	"RingQueue": lambda: RingQueue(),
+	"RingQueue(growable)": lambda: RingQueue(growable = True),
+	"RingQueue(multi_producer)": lambda: RingQueue(multi_producer = True),
+}
+
+def result (bench, **kwargs):
+	res = {"bench": bench}
+	res.update(kwargs)
+	return res
+
+def bench_queue (n):
+	# 単一スレッドでenqueue、seek、dequeueを繰り返す
+	BATCH = 64
+	for name, factory in QUEUES.items():
+		q = factory()
+		begin = time.perf_counter()
+		for _ in range(n // BATCH):
+			for i in range(BATCH):
+				q.enqueue(i)
+			for i in range(BATCH):
+				q.seek()
+				q.dequeue()
+		elapsed = time.perf_counter() - begin
+		yield result("queue", queue = name, ops = n, sec = elapsed, ops_per_sec = n / elapsed)
+
+def bench_queue_spsc (n):
+	# 生産者スレッドと消費者スレッドで受け渡す
+	for name, factory in QUEUES.items():
+		q = factory()
+		def _produce ():
+			for i in range(n):
+				while q.is_full():
+					time.sleep(0)
+				q.enqueue(i)
+		th = threading.Thread(target = _produce)
+		begin = time.perf_counter()
+		th.start()
+		received = 0
+		while received < n:
+			if q.seek() is None:
+				time.sleep(0)
+				continue
+			q.dequeue()
+			received += 1
+		th.join()
+		elapsed = time.perf_counter() - begin
+		yield result("queue_spsc", queue = name, ops = n, sec = elapsed, ops_per_sec = n / elapsed)
+
+class EchoProcess (BaseTblProcess):
+	# 受け取ったEchoHdlをすぐに完了させる
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.regist_table(self.main_fin,	type(self).MainHdl)
+		self.regist_table(self.echo_fin,	EchoProcess.EchoHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+
+	def main_fin (self, hdl):
+		return RC.FIN()
+
+	class EchoHdl (BaseHdl):
+		def __init__ (self):
+			super().__init__()
+
+	def echo_fin (self, hdl):
+		return RC.FIN()
+
+class PingProcess (BaseTblProcess):
+	# targetへEchoHdlを送り、完了までの往復時間を計測する
+	target = None
+	count = 0
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.m_latencies = []
+		self.regist_table(self.main_send,	type(self).MainHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+			self.echo_hdl = None
+			self.begin = 0.0
+
+	def main_send (self, hdl):
+		hdl.echo_hdl = EchoProcess.EchoHdl()
+		hdl.begin = time.perf_counter()
+		self.Request(self.target, hdl.echo_hdl)
+		return RC.OK(self.main_wait)
+	def main_wait (self, hdl):
+		if not hdl.echo_hdl.is_done():
+			return RC.WAIT(hdl.echo_hdl)
+		self.m_latencies.append(time.perf_counter() - hdl.begin)
+		if len(self.m_latencies) < self.count:
+			return RC.OK(self.main_send)
+		self.done()
+		return RC.FIN()
+
+def run_until (tblsystem, done, timeout = 60.0):
+	# thread_id0を別スレッドで回し、done.wait後に停止する
+	th = threading.Thread(target = tblsystem.cyclic_call)
+	th.start()
+	finished = done.wait(timeout)
+	tblsystem.stop()
+	th.join()
+	if not finished:
+		raise RuntimeError("benchmark timed out")
+
+def percentile (values, p):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * p))]
+
+def bench_routing (n, max_threads = 8):
+	# スレッド数を増やしながら、隣のスレッドへの往復時間を計測する
+	# SIMULATIONは仮想時計で進むので、往復時間を測っても意味がない
+	schedules = (TblSystem.SCHEDULE.CYCLIC, TblSystem.SCHEDULE.EVENT)
+	for schedule, routing in [(schedule, routing) for schedule in schedules for routing in TblSystem.ROUTING]:
+		for num_threads in range(1, max_threads + 1):
+			tblsystem = TblSystem(num_threads, schedule, routing = routing)
+			pings = []
+			done = threading.Event()
+			remain = [num_threads]
+			lock = threading.Lock()
+			def _done ():
+				with lock:
+					remain[0] -= 1
+					if 0 == remain[0]:
+						done.set()
+			for tid in range(0, num_threads):
+				echo = type("EchoProcess{0}".format(tid), (EchoProcess,), {})
+				ping = type("PingProcess{0}".format(tid), (PingProcess,)\
+						, {"count": max(n // 100, 1), "done": lambda self: _done()})
+				pings.append(ping)
+				tblsystem.regist_process(echo, (tid + 1) % num_threads, 1)
+				tblsystem.regist_process(ping, tid, 1)
+				ping.target = echo
+			tblsystem.establish()
+			run_until(tblsystem, done)
+			latencies = sum([tblsystem.threads[tblsystem.transport[ping]].processes[ping].m_latencies for ping in pings], [])
+			yield result("routing", schedule = schedule.name, routing = routing.name, threads = num_threads, samples = len(latencies)\
+					, mean_usec = 1e6 * sum(latencies) / len(latencies)\
+					, p50_usec = 1e6 * percentile(latencies, 0.5)\
+					, p99_usec = 1e6 * percentile(latencies, 0.99))
+
+class CollectProcess (BaseTblProcess):
+	# DoneHdlを数え、expectedに達したらdoneを呼ぶ
+	expected = 0
+	done = None
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.m_count = 0
+		self.regist_table(self.main_fin,	CollectProcess.MainHdl)
+		self.regist_table(self.done_count,	CollectProcess.DoneHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+
+	def main_fin (self, hdl):
+		return RC.FIN()
+
+	class DoneHdl (BaseHdl):
+		def __init__ (self):
+			super().__init__()
+
+	def done_count (self, hdl):
+		self.m_count += 1
+		if self.m_count == self.expected:
+			type(self).done()
+		return RC.FIN()
+
+class CpuProcess (BaseTblProcess):
+	# 1ステップごとにwork回の計算をcount回行い、CollectProcessへ完了を送る
+	work = 0
+	count = 0
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.regist_table(self.main_compute,	type(self).MainHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+			self.counter = 0
+			self.acc = 0
+
+	def main_compute (self, hdl):
+		acc = 0
+		for i in range(self.work):
+			acc += i * i
+		hdl.acc ^= acc
+		hdl.counter += 1
+		if hdl.counter < self.count:
+			return RC.FEED()
+		self.Request(CollectProcess, CollectProcess.DoneHdl())
+		return RC.FIN()
+
+def bench_cpu_scaling (n, max_workers = None):
+	# CPU負荷の処理をworkers個のthread_idに分散し、スレッドとOSプロセスで所要時間を比べる
+	max_workers = max_workers or multiprocessing.cpu_count()
+	for system_cls in [TblSystem, ProcessTblSystem]:
+		for workers in range(1, max_workers + 1):
+			tblsystem = system_cls(workers + 1, TblSystem.SCHEDULE.EVENT)
+			done = threading.Event()
+			CollectProcess.expected = workers
+			CollectProcess.done = done.set
+			tblsystem.regist_process(CollectProcess, 0, 1)
+			for tid in range(1, workers + 1):
+				cpu = type("CpuProcess{0}".format(tid), (CpuProcess,), {"work": 2000, "count": max(n // 100, 1)})
+				tblsystem.regist_process(cpu, tid, 1)
+			begin = time.perf_counter()
+			tblsystem.establish()
+			run_until(tblsystem, done)
+			elapsed = time.perf_counter() - begin
+			yield result("cpu_scaling", system = system_cls.__name__, workers = workers, sec = elapsed\
+					, steps_per_sec = workers * max(n // 100, 1) / elapsed)
+
+class SpinProcess (BaseTblProcess):
+	# MainHdlでcount回ステップを実行してdoneを呼ぶ
+	# feed=TrueならステップごとにFEEDして、ルーティングを経由させる
+	count = 0
+	feed = False
+	done = None
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.regist_table(self.main_spin,	type(self).MainHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+			self.counter = 0
+
+	def main_spin (self, hdl):
+		hdl.counter += 1
+		if hdl.counter >= self.count:
+			type(self).done()
+			return RC.FIN()
+		if self.feed:
+			return RC.FEED()
+		return RC.OK(self.main_spin)
+
+def countdown (num, event):
+	# num回呼ばれたらeventをセットする関数を返す
+	remain = [num]
+	lock = threading.Lock()
+	def _done ():
+		with lock:
+			remain[0] -= 1
+			if 0 == remain[0]:
+				event.set()
+	return _done
+
+def run_spin (num_threads, count, feed, routing = TblSystem.ROUTING.CENTRAL, schedule = TblSystem.SCHEDULE.EVENT):
+	tblsystem = TblSystem(num_threads, schedule, routing = routing)
+	done = threading.Event()
+	_done = countdown(num_threads, done)
+	for tid in range(0, num_threads):
+		spin = type("SpinProcess{0}".format(tid), (SpinProcess,), {"count": count, "feed": feed, "done": staticmethod(_done)})
+		tblsystem.regist_process(spin, tid, 1)
+	tblsystem.establish()
+	begin = time.perf_counter()
+	run_until(tblsystem, done)
+	return time.perf_counter() - begin
+
+def bench_steps (n):
+	# 1つのTblSystemThで、OKで遷移し続けるステップとFEEDを繰り返すステップの速度
+	for feed in [False, True]:
+		elapsed = run_spin(1, n, feed)
+		yield result("steps", feed = feed, steps = n, sec = elapsed, steps_per_sec = n / elapsed)
+
+def bench_scaling (n, max_threads = 8):
+	# スレッド数を増やしたときの、FEEDを繰り返す処理全体のステップ数
+	for routing in TblSystem.ROUTING:
+		for num_threads in range(1, max_threads + 1):
+			count = max(n // num_threads, 1)
+			elapsed = run_spin(num_threads, count, True, routing)
+			yield result("scaling", routing = routing.name, threads = num_threads, steps = count * num_threads\
+					, sec = elapsed, steps_per_sec = count * num_threads / elapsed)
+
+class InterruptProcess (BaseTblProcess):
+	# 割り込みで受け取ったHdlの投入から実行までの時間を記録する
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.m_latencies = []
+		self.regist_table(self.main_fin,		InterruptProcess.MainHdl)
+		self.regist_table(self.interrupt_record,	InterruptProcess.InterruptHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+
+	def main_fin (self, hdl):
+		return RC.FIN()
+
+	class InterruptHdl (BaseHdl):
+		def __init__ (self):
+			super().__init__()
+			self.begin = time.perf_counter()
+
+	def interrupt_record (self, hdl):
+		self.m_latencies.append(time.perf_counter() - hdl.begin)
+		return RC.FIN()
+
+class InterrupterProcess (BaseTblProcess):
+	# InterruptProcessへ割り込みを1つずつ送り、完了を待つ
+	count = 0
+	done = None
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.regist_table(self.main_interrupt,	InterrupterProcess.MainHdl)
+
+	def establish (self, tblsystem):
+		super().establish(tblsystem)
+		self.m_interceptor = tblsystem.interceptor(InterruptProcess)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+			self.counter = 0
+			self.interrupt_hdl = None
+
+	def main_interrupt (self, hdl):
+		hdl.interrupt_hdl = InterruptProcess.InterruptHdl()
+		self.m_interceptor.enqueue(RequestInfo(InterruptProcess, hdl.interrupt_hdl))
+		return RC.OK(self.main_wait)
+	def main_wait (self, hdl):
+		if not hdl.interrupt_hdl.is_done():
+			return RC.WAIT(hdl.interrupt_hdl)
+		hdl.counter += 1
+		if hdl.counter < self.count:
+			return RC.OK(self.main_interrupt)
+		type(self).done()
+		return RC.FIN()
+
+def bench_interrupt (n):
+	# 別スレッドからinterceptor()経由で割り込んだときの、投入から実行までの時間
+	# busy=Trueなら割り込み先のスレッドでFEEDを繰り返す処理を動かしておく
+	for busy in [False, True]:
+		tblsystem = TblSystem(3, TblSystem.SCHEDULE.EVENT)
+		done = threading.Event()
+		count = max(n // 10, 1)
+		InterrupterProcess.count = count
+		InterrupterProcess.done = staticmethod(countdown(1, done))
+		tblsystem.regist_process(InterruptProcess, 2, 1)
+		tblsystem.regist_process(InterrupterProcess, 1, 1)
+		if busy:
+			spin = type("SpinProcessBusy", (SpinProcess,), {"count": 1 << 62, "feed": True, "done": staticmethod(lambda: None)})
+			tblsystem.regist_process(spin, 2, 1)
+		tblsystem.establish()
+		run_until(tblsystem, done)
+		latencies = tblsystem.threads[2].processes[InterruptProcess].m_latencies
+		yield result("interrupt", busy = busy, samples = len(latencies)\
+				, mean_usec = 1e6 * sum(latencies) / len(latencies)\
+				, p50_usec = 1e6 * percentile(latencies, 0.5)\
+				, p99_usec = 1e6 * percentile(latencies, 0.99))
+
+class LogSpamProcess (BaseTblProcess):
+	# count行のログを書き、FlushHdlの完了でdoneを呼ぶ
+	count = 0
+	done = None
+	BATCH = 100
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.regist_table(self.main_write,	LogSpamProcess.MainHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+			self.counter = 0
+			self.flush_hdl = None
+
+	def main_write (self, hdl):
+		for i in range(LogSpamProcess.BATCH):
+			self.WriteLog("log line {0}", hdl.counter)
+			self.WriteLog("debug line {0}", hdl.counter, level = LogProcess.LEVEL.DEBUG)
+			hdl.counter += 1
+		if hdl.counter < self.count:
+			return RC.FEED()
+		hdl.flush_hdl = LogProcess.FlushHdl()
+		self.Request(LogProcess, hdl.flush_hdl)
+		return RC.OK(self.main_wait)
+	def main_wait (self, hdl):
+		if not hdl.flush_hdl.is_done():
+			return RC.WAIT(hdl.flush_hdl)
+		type(self).done()
+		return RC.FIN()
+
+def bench_log (n):
+	# LogProcessへ書いたログがファイルへ書き出されるまでの速度 (DEBUGは捨てられる)
+	tblsystem = TblSystem(2, TblSystem.SCHEDULE.EVENT, growable = True)
+	done = threading.Event()
+	LogSpamProcess.count = n
+	LogSpamProcess.done = staticmethod(countdown(1, done))
+	tblsystem.regist_process(LogSpamProcess, 1, 1)
+	tblsystem.establish()
+	begin = time.perf_counter()
+	run_until(tblsystem, done)
+	elapsed = time.perf_counter() - begin
+	yield result("log", lines = n, sec = elapsed, lines_per_sec = n / elapsed)
+
+class BurstWorkerProcess (BaseTblProcess):
+	# JobHdlの生成から実行までの時間を記録する
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.m_latencies = []
+		self.regist_table(self.main_fin,	BurstWorkerProcess.MainHdl)
+		self.regist_table(self.job_record,	BurstWorkerProcess.JobHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+
+	def main_fin (self, hdl):
+		return RC.FIN()
+
+	class JobHdl (BaseHdl):
+		def __init__ (self):
+			super().__init__()
+			self.begin = time.perf_counter()
+
+	def job_record (self, hdl):
+		self.m_latencies.append(time.perf_counter() - hdl.begin)
+		return RC.FIN()
+
+class HogProcess (BaseTblProcess):
+	# OKで長く遷移し続けてからFEEDする処理
+	CHAIN = 5000
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.regist_table(self.main_hog,	HogProcess.MainHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+			self.counter = 0
+
+	def main_hog (self, hdl):
+		hdl.counter += 1
+		if 0 == hdl.counter % HogProcess.CHAIN:
+			return RC.FEED()
+		return RC.OK(self.main_hog)
+
+class BurstProcess (BaseTblProcess):
+	# count個のJobHdlを一度に投入し、全ての完了を待つ
+	count = 0
+	done = None
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.regist_table(self.main_burst,	BurstProcess.MainHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+			self.hdls = []
+
+	def main_burst (self, hdl):
+		for i in range(self.count):
+			hdl.hdls.append(BurstWorkerProcess.JobHdl())
+			self.Request(BurstWorkerProcess, hdl.hdls[-1])
+		return RC.OK(self.main_wait)
+	def main_wait (self, hdl):
+		if not all(map(lambda job: job.is_done(), hdl.hdls)):
+			return RC.WAIT(*hdl.hdls)
+		type(self).done()
+		return RC.FIN()
+
+def bench_burst (n):
+	# 一度に投入した要求の待ち時間。受付数(admit)と実行の上限(quantum_steps)ごと
+	# 受付先のスレッドではOKで長く遷移する処理が動いている
+	count = min(max(n // 100, 10), 1000)
+	for config in [{}, {"admit": 64}, {"admit": 64, "quantum_steps": 256}]:
+		tblsystem = TblSystem(3, TblSystem.SCHEDULE.CYCLIC, growable = True, **config)
+		done = threading.Event()
+		BurstProcess.count = count
+		BurstProcess.done = staticmethod(countdown(1, done))
+		tblsystem.regist_process(BurstWorkerProcess, 1, 1)
+		tblsystem.regist_process(HogProcess, 1, 1)
+		tblsystem.regist_process(BurstProcess, 2, 1)
+		tblsystem.establish()
+		begin = time.perf_counter()
+		run_until(tblsystem, done)
+		elapsed = time.perf_counter() - begin
+		latencies = tblsystem.threads[1].processes[BurstWorkerProcess].m_latencies
+		yield result("burst", requests = count, admit = config.get("admit", TblSystemTh.ADMIT)\
+				, quantum_steps = config.get("quantum_steps"), sec = elapsed\
+				, quantum_exceeded = tblsystem.threads[1].quantum_exceeded\
+				, p50_usec = 1e6 * percentile(latencies, 0.5)\
+				, p99_usec = 1e6 * percentile(latencies, 0.99))
+
+BENCHES = {
+	"queue": bench_queue,
+	"queue_spsc": bench_queue_spsc,
+	"routing": bench_routing,
+	"cpu_scaling": bench_cpu_scaling,
+	"steps": bench_steps,
+	"scaling": bench_scaling,
+	"interrupt": bench_interrupt,
+	"log": bench_log,
+	"burst": bench_burst,
+}
+
+def meta ():
+	try:
+		commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output = True, text = True\
+				, cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+	except OSError:
+		commit = ""
+	return result("meta", commit = commit, python = platform.python_version(), cpus = multiprocessing.cpu_count())
+
+def identity (res):
+	# 計測値(float)以外の項目が同じ結果同士を比べる
+	return tuple(sorted((key, value) for key, value in res.items() if not isinstance(value, float)))
+
+def compare (baseline, res, threshold):
+	# _per_secは大きいほど、_usecは小さいほど良い (secは問題の大きさに依存するので比べない)
+	for key, value in res.items():
+		if key not in baseline or not isinstance(value, float):
+			continue
+		if key.endswith("_per_sec"):
+			ratio = value / baseline[key] if baseline[key] else 1.0
+		elif key.endswith("_usec"):
+			ratio = baseline[key] / value if value else 1.0
+		else:
+			continue
+		yield result("compare", target = res["bench"], metric = key, baseline = baseline[key], value = value\
+				, ratio = ratio, regression = ratio < 1.0 - threshold)
+
+def main ():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-n", type = int, default = 100000)
+	parser.add_argument("-o", "--output", default = None)
+	parser.add_argument("--compare", default = None)
+	parser.add_argument("--threshold", type = float, default = 0.2)
+	parser.add_argument("benches", nargs = "*", default = list(BENCHES.keys()))
+	args = parser.parse_args()
+
+	baselines = {}
+	if args.compare:
+		with open(args.compare) as fp:
+			for line in fp:
+				res = json.loads(line)
+				baselines[identity(res)] = res
+
+	output = open(args.output, "w") if args.output else None
+	def _emit (res):
+		line = json.dumps(res)
+		print(line)
+		sys.stdout.flush()
+		if output:
+			output.write(line + "\n")
+
+	regressions = 0
+	_emit(meta())
+	for name in args.benches:
+		if name not in BENCHES:
+			raise RuntimeError("Unknown benchmark: {0}".format(name))
+	# TblSystemが作るlog/などは一時ディレクトリに置き、終わったら消す
+	cwd = os.getcwd()
+	with tempfile.TemporaryDirectory() as tmpdir:
+		os.chdir(tmpdir)
+		try:
+			for name in args.benches:
+				for res in BENCHES[name](args.n):
+					_emit(res)
+					baseline = baselines.get(identity(res))
+					if baseline:
+						for cmp in compare(baseline, res, args.threshold):
+							regressions += cmp["regression"]
+							_emit(cmp)
+		finally:
+			os.chdir(cwd)
+	if output:
+		output.close()
+	sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+	main()
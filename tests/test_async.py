@@ -0,0 +1,140 @@
+#!  /usr/bin/env python3
+#! -*- coding: utf-8 -*-
+
+# AsyncTblSystemのsubmitを、イベントループの中からも他のスレッドからも待てること
+# 待っているタスクを取り消しても、Hdlの完了でシステムが止まらないこと
+
+import os
+import sys
+import shutil
+import asyncio
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from TblSystem import *
+from TblAsync import *
+
+class Echo (BaseTblProcess):
+	# gateが開くまでFEEDで待ってから、実行したスレッドを記録して完了する
+	gate = None
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.regist_table(self.main_fin, Echo.MainHdl)
+		self.regist_table(self.echo_wait, Echo.EchoHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+
+	def main_fin (self, hdl):
+		return RC.FIN()
+
+	class EchoHdl (BaseHdl):
+		def __init__ (self, value, fail = False):
+			super().__init__()
+			self.i_value = value
+			self.i_fail = fail
+			self.o_value = None
+			self.o_thread_id = None
+
+	def echo_wait (self, hdl):
+		if not Echo.gate.is_set():
+			return RC.FEED()
+		hdl.o_value = hdl.i_value
+		hdl.o_thread_id = self.th.thread_id
+		if hdl.i_fail:
+			self.Finish(hdl, TblStatus.ERROR)
+			return RC.PEND()
+		return RC.FIN()
+
+class TestAsync (unittest.TestCase):
+	TIMEOUT_SEC = 10.0
+
+	def setUp (self):
+		self.cwd = os.getcwd()
+		self.tmpdir = tempfile.mkdtemp()
+		os.chdir(self.tmpdir)
+		Echo.gate = threading.Event()
+		Echo.gate.set()
+		# スレッドで起きた例外を記録する
+		self.errors = []
+		self.excepthook = threading.excepthook
+		threading.excepthook = self.errors.append
+		self.tblsystem = AsyncTblSystem(2)
+		self.tblsystem.regist_process(Echo, 1, 10)
+		self.tblsystem.establish()
+
+	def tearDown (self):
+		self.tblsystem.executor.shutdown(wait = True)
+		threading.excepthook = self.excepthook
+		os.chdir(self.cwd)
+		shutil.rmtree(self.tmpdir, ignore_errors = True)
+
+	def run_loop (self, scenario):
+		# run()と並べてscenarioを実行し、終わったらstopする
+		async def _main ():
+			runner = asyncio.ensure_future(self.tblsystem.run())
+			try:
+				return await asyncio.wait_for(scenario(), TestAsync.TIMEOUT_SEC)
+			finally:
+				self.tblsystem.stop()
+				await asyncio.wait_for(runner, TestAsync.TIMEOUT_SEC)
+		return asyncio.run(_main())
+
+	def test_submit_in_loop (self):
+		async def _scenario ():
+			hdls = [Echo.EchoHdl(i) for i in range(10)]
+			return await asyncio.gather(*[self.tblsystem.submit(Echo, hdl) for hdl in hdls]), hdls
+		results, hdls = self.run_loop(_scenario)
+		# 結果はsubmitしたHdlそのもの
+		self.assertEqual(len(hdls), len(results))
+		self.assertTrue(all(result is hdl for result, hdl in zip(results, hdls)))
+		self.assertEqual(list(range(10)), [hdl.o_value for hdl in results])
+		self.assertTrue(all(TblStatus.FIN == hdl.status and 1 == hdl.o_thread_id for hdl in results))
+
+	def test_submit_error (self):
+		# ERRORで完了しても例外にせず、Hdlを返す
+		async def _scenario ():
+			return await self.tblsystem.submit(Echo, Echo.EchoHdl(1, fail = True))
+		hdl = self.run_loop(_scenario)
+		self.assertEqual(TblStatus.ERROR, hdl.status)
+		self.assertEqual(1, hdl.o_value)
+
+	def test_submit_other_thread (self):
+		# イベントループの外ではconcurrent.futures.Futureを返す
+		results = []
+		def _submit ():
+			futures = [self.tblsystem.submit(Echo, Echo.EchoHdl(i)) for i in range(10)]
+			results.extend(future.result(TestAsync.TIMEOUT_SEC) for future in futures)
+		async def _scenario ():
+			thread = threading.Thread(target = _submit)
+			thread.start()
+			while thread.is_alive():
+				await asyncio.sleep(0.01)
+		self.run_loop(_scenario)
+		self.assertEqual(list(range(10)), [hdl.o_value for hdl in results])
+		self.assertTrue(all(TblStatus.FIN == hdl.status for hdl in results))
+
+	def test_cancel (self):
+		# 待っているタスクを取り消した後にHdlが完了しても、完了させたスレッドは続けて動く
+		async def _scenario ():
+			Echo.gate.clear()
+			hdl = Echo.EchoHdl(1)
+			task = asyncio.ensure_future(self.tblsystem.submit(Echo, hdl))
+			await asyncio.sleep(0.05)
+			task.cancel()
+			with self.assertRaises(asyncio.CancelledError):
+				await task
+			Echo.gate.set()
+			after = await self.tblsystem.submit(Echo, Echo.EchoHdl(2))
+			return hdl, after
+		hdl, after = self.run_loop(_scenario)
+		self.assertEqual(TblStatus.FIN, hdl.status)
+		self.assertEqual(TblStatus.FIN, after.status)
+		self.assertEqual(2, after.o_value)
+		self.assertEqual([], [args.exc_value for args in self.errors])
+
+if __name__ == "__main__":
+	unittest.main()
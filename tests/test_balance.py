@@ -0,0 +1,184 @@
+#!  /usr/bin/env python3
+#! -*- coding: utf-8 -*-
+
+# 処理を他のスレッドへ移しても、キューに残った要求、FEEDで戻した要求、割り込みが全て完了すること
+# pinした処理は負荷分散で移らないこと
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from TblSystem import *
+
+class Worker (BaseTblProcess):
+	# JobHdlごとにFEEDを挟んで数回実行し、実行したスレッドを記録する
+	SPIN_SEC = 0.0005
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.regist_table(self.main_fin, Worker.MainHdl)
+		self.regist_table(self.job_run, Worker.JobHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+
+	def main_fin (self, hdl):
+		return RC.FIN()
+
+	class JobHdl (BaseHdl):
+		def __init__ (self, feeds):
+			super().__init__()
+			self.i_feeds = feeds
+			self.threads = set()
+
+	def job_run (self, hdl):
+		end = time.perf_counter() + Worker.SPIN_SEC
+		while time.perf_counter() < end:
+			pass
+		hdl.threads.add(self.th.thread_id)
+		if hdl.i_feeds:
+			hdl.i_feeds -= 1
+			return RC.FEED()
+		return RC.FIN()
+
+class Movable1 (Worker):
+	pass
+
+class Movable2 (Worker):
+	pass
+
+class Pinned (Worker):
+	pass
+
+WORKERS = (Movable1, Movable2, Pinned)
+
+class Client (BaseTblProcess):
+	# 各Workerへ要求と割り込みを送り、全て完了するまで待つことを繰り返す
+	BATCH = 8
+	FEEDS = 3
+	running = True
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.hdls = []
+		self.done = False
+		self.regist_table(self.main_send, Client.MainHdl)
+
+	def establish (self, tblsystem):
+		super().establish(tblsystem)
+		# 移動前の割り込みキューを持ち続け、移動後は移動元のスレッドに送り直させる
+		self.m_interceptors = {cls: tblsystem.interceptor(cls) for cls in WORKERS}
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+			self.hdls = []
+
+	def main_send (self, hdl):
+		hdl.hdls = []
+		for cls in WORKERS:
+			for _ in range(Client.BATCH):
+				hdl.hdls.append(Worker.JobHdl(Client.FEEDS))
+				self.Request(cls, hdl.hdls[-1])
+			job = Worker.JobHdl(Client.FEEDS)
+			if self.m_interceptors[cls].enqueue(RequestInfo(cls, job)):
+				hdl.hdls.append(job)
+		return RC.OK(self.main_wait)
+	def main_wait (self, hdl):
+		rest = [child for child in hdl.hdls if not child.is_done()]
+		if rest:
+			return RC.WAIT(*rest)
+		self.hdls += [(cls, child) for cls, child in zip(self.classes(hdl), hdl.hdls)]
+		if Client.running:
+			return RC.OK(self.main_send)
+		self.done = True
+		return RC.FIN()
+
+	def classes (self, hdl):
+		# main_sendで送った順の送信先
+		for cls in WORKERS:
+			for _ in range(Client.BATCH + 1):
+				yield cls
+
+class TestBalance (unittest.TestCase):
+	TIMEOUT_SEC = 10.0
+
+	def setUp (self):
+		self.cwd = os.getcwd()
+		self.tmpdir = tempfile.mkdtemp()
+		os.chdir(self.tmpdir)
+		self.rebalance_sec = TblSystem.REBALANCE_SEC
+		TblSystem.REBALANCE_SEC = 0.2
+		Client.running = True
+
+	def tearDown (self):
+		TblSystem.REBALANCE_SEC = self.rebalance_sec
+		os.chdir(self.cwd)
+		shutil.rmtree(self.tmpdir, ignore_errors = True)
+
+	def run_workers (self, routing, until):
+		# thread_id1に全てのWorkerを置き、untilが成り立つまで要求を送り続ける
+		tblsystem = TblSystem(4, TblSystem.SCHEDULE.EVENT, routing = routing\
+				, placement = TblSystem.PLACEMENT.BALANCED, growable = True)
+		for cls in WORKERS:
+			tblsystem.regist_process(cls, 1, 10)
+		tblsystem.regist_process(Client, 2, 10)
+		tblsystem.pin(Pinned)
+		tblsystem.establish()
+		client = tblsystem.threads[2].processes[Client]
+		def _watch ():
+			end = time.perf_counter() + TestBalance.TIMEOUT_SEC
+			until(tblsystem, end)
+			Client.running = False
+			wait_until(lambda: client.done, max(end - time.perf_counter(), 1.0))
+			tblsystem.stop()
+		watcher = threading.Thread(target = _watch)
+		watcher.start()
+		tblsystem.cyclic_call()
+		watcher.join()
+		self.assertTrue(client.done, "requests did not finish")
+		self.assertTrue(all(TblStatus.FIN == hdl.status for _, hdl in client.hdls))
+		# pinした処理はthread_id1から動かない
+		self.assertEqual(1, tblsystem.transport[Pinned])
+		self.assertEqual({1}, set().union(*[hdl.threads for cls, hdl in client.hdls if cls is Pinned]))
+		self.assertNotIn(Pinned.__name__, [migration["process"] for migration in tblsystem.migrations])
+		return tblsystem, client
+
+	def rebalanced (self, tblsystem, end):
+		wait_until(lambda: tblsystem.migrations, max(end - time.perf_counter(), 0.0))
+
+	def moved (self, tblsystem, end):
+		# 負荷の偏りによらず、実行中に行き来させる
+		for dst in (3, 1, 2, 1):
+			before = len(tblsystem.migrations)
+			tblsystem.pin(Movable1, dst)
+			wait_until(lambda: len(tblsystem.migrations) > before, max(end - time.perf_counter(), 0.0))
+			time.sleep(0.05)
+		tblsystem.unpin(Movable1)
+
+	def check_moved (self, tblsystem, client):
+		self.assertEqual([(1, 3), (3, 1), (1, 2), (2, 1)], [(migration["src"], migration["dst"])\
+				for migration in tblsystem.migrations if migration["process"] == Movable1.__name__][:4])
+		# 移動をまたいでFEEDで戻した要求は、移動先で続きを実行した
+		self.assertTrue(any(len(hdl.threads) > 1 for cls, hdl in client.hdls if cls is Movable1))
+
+	def test_balanced_central (self):
+		tblsystem, _ = self.run_workers(TblSystem.ROUTING.CENTRAL, self.rebalanced)
+		self.assertTrue(tblsystem.migrations)
+
+	def test_balanced_direct (self):
+		tblsystem, _ = self.run_workers(TblSystem.ROUTING.DIRECT, self.rebalanced)
+		self.assertTrue(tblsystem.migrations)
+
+	def test_pin_move_central (self):
+		self.check_moved(*self.run_workers(TblSystem.ROUTING.CENTRAL, self.moved))
+
+	def test_pin_move_direct (self):
+		self.check_moved(*self.run_workers(TblSystem.ROUTING.DIRECT, self.moved))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,105 @@
+#!  /usr/bin/env python3
+#! -*- coding: utf-8 -*-
+
+# LogProcessのFlushHdlが、書き出せたときだけFINで完了すること
+# 書式の合わないWriteLogでも、行を残してHdlをプールへ戻すこと
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from TblSystem import *
+
+class Writer (BaseTblProcess):
+	N = 100
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.statuses = []
+		self.regist_table(self.main_fin, Writer.MainHdl)
+		self.regist_table(self.write_write, Writer.WriteHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+
+	def main_fin (self, hdl):
+		return RC.FIN()
+
+	class WriteHdl (BaseHdl):
+		def __init__ (self, msg = "line {0}", args = None):
+			super().__init__()
+			self.i_msg = msg
+			self.i_args = args
+			self.flush_hdl = None
+
+	def write_write (self, hdl):
+		for i in range(Writer.N):
+			self.WriteLog(hdl.i_msg, *(hdl.i_args if hdl.i_args is not None else (i,)))
+		hdl.flush_hdl = LogProcess.FlushHdl()
+		self.Request(LogProcess, hdl.flush_hdl)
+		return RC.OK(self.write_waitflush)
+	def write_waitflush (self, hdl):
+		if not hdl.flush_hdl.is_done():
+			return RC.WAIT(hdl.flush_hdl)
+		self.statuses.append(hdl.flush_hdl.status)
+		return RC.FIN()
+
+class TestLog (unittest.TestCase):
+	def setUp (self):
+		self.cwd = os.getcwd()
+		self.tmpdir = tempfile.mkdtemp()
+		os.chdir(self.tmpdir)
+		self.tblsystem = TblSystem(2, TblSystem.SCHEDULE.SIMULATION)
+		self.tblsystem.regist_process(Writer, 1, 10)
+		self.tblsystem.establish()
+		self.writer = self.find(Writer)
+		self.log = self.find(LogProcess)
+
+	def tearDown (self):
+		self.tblsystem.stop()
+		os.chdir(self.cwd)
+		shutil.rmtree(self.tmpdir, ignore_errors = True)
+
+	def find (self, cls):
+		return find_if(lambda prc: prc is not None, [th.processes.get(cls) for th in self.tblsystem.threads])
+
+	def write (self, hdl = None):
+		self.tblsystem.rx_queues[1].enqueue(RequestInfo(Writer, hdl or Writer.WriteHdl()))
+		self.tblsystem.simulate(1.0)
+		return self.writer.statuses[-1]
+
+	def lines (self):
+		with open(self.log.m_filepath, encoding = "utf-8") as fp:
+			return fp.read().splitlines()
+
+	def test_flush (self):
+		self.assertEqual(TblStatus.FIN, self.write())
+		self.assertEqual(Writer.N, len(self.lines()))
+
+	def test_open_failed (self):
+		# ディレクトリの代わりにファイルがあって開けない
+		with open("blocker", "w"):
+			pass
+		self.log.m_filepath = os.path.join("blocker", "test.log")
+		self.assertEqual(TblStatus.ERROR, self.write())
+
+	def test_append_failed (self):
+		self.assertEqual(TblStatus.FIN, self.write())
+		# 開いたままのファイルを閉じて、次の追記を失敗させる
+		self.find(FileIOProcess).m_files[self.log.m_filepath].close()
+		self.assertEqual(TblStatus.ERROR, self.write())
+
+	def test_format_failed (self):
+		# 書式の合わない行も残し、送りっぱなしのHdlはプールへ戻す
+		del LogProcess.WriteLogHdl.m_free[:]
+		self.assertEqual(TblStatus.FIN, self.write(Writer.WriteHdl("{0} {1}", ("only",))))
+		lines = self.lines()
+		self.assertEqual(Writer.N, len(lines))
+		self.assertTrue(all("format failed" in line for line in lines))
+		self.assertGreater(len(LogProcess.WriteLogHdl.m_free), 0)
+
+if __name__ == "__main__":
+	unittest.main()
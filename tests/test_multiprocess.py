@@ -0,0 +1,78 @@
+#!  /usr/bin/env python3
+#! -*- coding: utf-8 -*-
+
+# ProcessTblSystemの子プロセスで繰り返したSetErrorが、止んだ後に全て数えられること
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from TblSystem import *
+from TblMultiProcess import ProcessTblSystem
+
+class Storm (BaseTblProcess):
+	N = 50
+	EID = 900
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.regist_table(self.main_storm, Storm.MainHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+
+	def main_storm (self, hdl):
+		for i in range(Storm.N):
+			self.SetError(Storm.EID, "storm {0}".format(i))
+		return RC.FIN()
+
+class TestMultiProcess (unittest.TestCase):
+	TIMEOUT_SEC = 10.0
+
+	def setUp (self):
+		self.cwd = os.getcwd()
+		self.tmpdir = tempfile.mkdtemp()
+		os.chdir(self.tmpdir)
+		# 子プロセスへはforkで引き継がれる
+		self.interval_sec = ErrorProcess.INTERVAL_SEC
+		ErrorProcess.INTERVAL_SEC = 0.2
+
+	def tearDown (self):
+		ErrorProcess.INTERVAL_SEC = self.interval_sec
+		os.chdir(self.cwd)
+		shutil.rmtree(self.tmpdir, ignore_errors = True)
+
+	def storm (self, schedule):
+		tblsystem = ProcessTblSystem(2, schedule)
+		tblsystem.regist_process(Storm, 1, 10)
+		tblsystem.establish()
+		errors = tblsystem.threads[0].processes[ErrorProcess].m_errors
+		key = (Storm.EID, Storm.__name__)
+		def _count ():
+			return errors[key]["count"] if key in errors else 0
+		counts = []
+		def _watch ():
+			wait_until(lambda: _count() >= Storm.N, TestMultiProcess.TIMEOUT_SEC)
+			# 数え過ぎていないことも確かめる
+			time.sleep(ErrorProcess.INTERVAL_SEC * 2)
+			counts.append(_count())
+			tblsystem.stop()
+		watcher = threading.Thread(target = _watch)
+		watcher.start()
+		tblsystem.cyclic_call()
+		watcher.join()
+		self.assertEqual([Storm.N], counts)
+
+	def test_storm_cyclic (self):
+		self.storm(TblSystem.SCHEDULE.CYCLIC)
+
+	def test_storm_event (self):
+		self.storm(TblSystem.SCHEDULE.EVENT)
+
+if __name__ == "__main__":
+	unittest.main()
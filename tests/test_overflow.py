@@ -0,0 +1,124 @@
+#!  /usr/bin/env python3
+#! -*- coding: utf-8 -*-
+
+# 満杯のキューへ要求を溢れさせたときに、どの扱いでも全てのHdlが完了し、スレッドが止まらないこと
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from TblSystem import *
+
+class Sink (BaseTblProcess):
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.count = 0
+		self.regist_table(self.main_fin, Sink.MainHdl)
+		self.regist_table(self.job_count, Sink.JobHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+
+	def main_fin (self, hdl):
+		return RC.FIN()
+
+	class JobHdl (BaseHdl):
+		def __init__ (self):
+			super().__init__()
+
+	def job_count (self, hdl):
+		self.count += 1
+		return RC.FIN()
+
+class Src (BaseTblProcess):
+	# ErrorEventHdl、ResetHdlを持たない処理
+	N = 40
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.done = None
+		self.regist_table(self.main_flood, Src.MainHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+			self.hdls = []
+
+	def main_flood (self, hdl):
+		for _ in range(Src.N):
+			hdl.hdls.append(Sink.JobHdl())
+			self.Request(Sink, hdl.hdls[-1])
+		return RC.OK(self.main_wait)
+	def main_wait (self, hdl):
+		rest = [child for child in hdl.hdls if not child.is_done()]
+		if rest:
+			return RC.WAIT(*rest)
+		self.done = hdl.hdls
+		return RC.FIN()
+
+class TestOverflow (unittest.TestCase):
+	TIMEOUT_SEC = 10.0
+
+	def setUp (self):
+		# LogProcessが作るlog/を一時ディレクトリに置く
+		self.cwd = os.getcwd()
+		self.tmpdir = tempfile.mkdtemp()
+		os.chdir(self.tmpdir)
+
+	def tearDown (self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.tmpdir, ignore_errors = True)
+
+	def flood (self, src_thread, sink_thread, **kwargs):
+		tblsystem = TblSystem(3, TblSystem.SCHEDULE.EVENT, queue_size = 8, **kwargs)
+		tblsystem.regist_process(Src, src_thread, 1)
+		tblsystem.regist_process(Sink, sink_thread, 1)
+		tblsystem.establish()
+		src = tblsystem.threads[src_thread].processes[Src]
+		sink = tblsystem.threads[sink_thread].processes[Sink]
+		def _watch ():
+			end = time.time() + TestOverflow.TIMEOUT_SEC
+			while src.done is None and time.time() < end:
+				time.sleep(0.01)
+			tblsystem.stop()
+		watcher = threading.Thread(target = _watch)
+		watcher.start()
+		tblsystem.cyclic_call()
+		watcher.join()
+		self.assertIsNotNone(src.done, "flood did not finish")
+		statuses = [hdl.status for hdl in src.done]
+		self.assertTrue(all(map(lambda status: status in (TblStatus.FIN, TblStatus.ERROR), statuses)))
+		self.assertEqual(statuses.count(TblStatus.FIN), sink.count)
+		return statuses
+
+	def test_reject (self):
+		statuses = self.flood(1, 2, overflow = Queue.OVERFLOW.REJECT)
+		self.assertIn(TblStatus.ERROR, statuses)
+
+	def test_block (self):
+		statuses = self.flood(1, 2, overflow = Queue.OVERFLOW.BLOCK, overflow_timeout = 1.0)
+		self.assertEqual(Src.N, statuses.count(TblStatus.FIN))
+
+	def test_block_own_queue (self):
+		# thread_id0の処理が、thread_id0の振り分けるtx_queueへ投入する
+		statuses = self.flood(0, 1, overflow = Queue.OVERFLOW.BLOCK, overflow_timeout = 1.0)
+		self.assertIn(TblStatus.FIN, statuses)
+
+	def test_block_requires_timeout (self):
+		with self.assertRaises(RuntimeError):
+			TblSystem(1, TblSystem.SCHEDULE.EVENT, overflow = Queue.OVERFLOW.BLOCK)
+
+	def test_drop_oldest (self):
+		self.flood(1, 2, queue_cls = MutexQueue, overflow = Queue.OVERFLOW.DROP_OLDEST)
+
+	def test_spill (self):
+		statuses = self.flood(1, 2, growable = True)
+		self.assertEqual(Src.N, statuses.count(TblStatus.FIN))
+
+if __name__ == "__main__":
+	unittest.main()
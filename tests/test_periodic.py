@@ -0,0 +1,130 @@
+#!  /usr/bin/env python3
+#! -*- coding: utf-8 -*-
+
+# 周期処理が予定の時刻(最初の予定から周期の整数倍)に起動し、遅れを持ち越さないこと
+# 前の周期の実行が終わっていなければ起動せずに数え、起動の遅れをjitterに数えること
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from TblSystem import *
+
+class Ticker (BaseTblProcess):
+	# OVERRUN回に1回、周期より長く眠って次の周期に食い込む
+	PERIODIC = True
+	OVERRUN = 5
+	OVERRUN_SEC = 0.25
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.starts = []
+		self.regist_table(self.main_start, Ticker.MainHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+			self.sleep_hdl = None
+
+	def main_start (self, hdl):
+		self.starts.append(self.clock.time())
+		if len(self.starts) % Ticker.OVERRUN:
+			return RC.FIN()
+		hdl.sleep_hdl = ClockProcess.SleepSecHdl(Ticker.OVERRUN_SEC)
+		self.Request(ClockProcess, hdl.sleep_hdl)
+		return RC.OK(self.main_wait)
+	def main_wait (self, hdl):
+		if not hdl.sleep_hdl.is_done():
+			return RC.WAIT(hdl.sleep_hdl)
+		return RC.FIN()
+
+class Hog (BaseTblProcess):
+	# 同じスレッドを塞いで、周期処理の起動を遅らせる
+	SPIN_SEC = 0.035
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.regist_table(self.main_spin, Hog.MainHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+
+	def main_spin (self, hdl):
+		end = time.perf_counter() + Hog.SPIN_SEC
+		while time.perf_counter() < end:
+			pass
+		return RC.FEED()
+
+class TestPeriodic (unittest.TestCase):
+	PERIOD_MSEC = 100
+
+	def setUp (self):
+		self.cwd = os.getcwd()
+		self.tmpdir = tempfile.mkdtemp()
+		os.chdir(self.tmpdir)
+
+	def tearDown (self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.tmpdir, ignore_errors = True)
+
+	def periodic (self, tblsystem, cls):
+		return find_if(lambda info: info["process"] == cls.__name__, tblsystem.stats()["periodic"])
+
+	def assert_on_grid (self, times, origin, period):
+		for t in times:
+			# 実時間の時刻は大きいので、足し続けた丸め誤差は許す
+			cycles = (t - origin) / period
+			self.assertAlmostEqual(cycles, round(cycles), delta = 1e-3)
+
+	def test_overrun_simulation (self):
+		tblsystem = TblSystem(2, TblSystem.SCHEDULE.SIMULATION, seed = 1)
+		tblsystem.regist_process(Ticker, 1, TestPeriodic.PERIOD_MSEC)
+		tblsystem.establish()
+		origin = tblsystem.clock.time()
+		# 周期の境目で終わらないようにする
+		tblsystem.simulate(9.95)
+		ticker = tblsystem.threads[1].processes[Ticker]
+		info = self.periodic(tblsystem, Ticker)
+		tblsystem.stop()
+		period = TestPeriodic.PERIOD_MSEC / 1000.0
+		starts = ticker.starts
+		# 起動は全て予定の時刻ちょうどで、遅れはない
+		self.assert_on_grid(starts, origin, period)
+		self.assertEqual(len(starts), info["jitter"]["count"])
+		self.assertEqual(0.0, info["jitter"]["max_sec"])
+		# 食い込んだ周期の次は、眠り終えた後の予定の時刻まで起動しない
+		for idx, (t, next_t) in enumerate(zip(starts, starts[1:])):
+			overrun = 0 == (idx + 1) % Ticker.OVERRUN
+			cycles = 3 if overrun else 1
+			self.assertAlmostEqual(cycles * period, next_t - t, places = 6)
+		# 起動した周期と数えた周期で、期間中の予定を全て数える
+		self.assertEqual(int(9.95 / period) + 1, len(starts) + info["misses"])
+		self.assertGreater(info["misses"], 0)
+
+	def test_late_event (self):
+		# 実時間で起動が周期以上遅れたら、過ぎた周期をまとめて数え、予定は元の格子に戻す
+		tblsystem = TblSystem(2, TblSystem.SCHEDULE.EVENT)
+		tblsystem.regist_process(Ticker, 1, 10)
+		tblsystem.regist_process(Hog, 1, 10)
+		tblsystem.establish()
+		ticker = tblsystem.threads[1].processes[Ticker]
+		origin = tblsystem.threads[1].periodics[Ticker].due
+		def _watch ():
+			wait_until(lambda: len(ticker.starts) >= 10, 10.0)
+			tblsystem.stop()
+		watcher = threading.Thread(target = _watch)
+		watcher.start()
+		tblsystem.cyclic_call()
+		watcher.join()
+		info = self.periodic(tblsystem, Ticker)
+		self.assertGreaterEqual(len(ticker.starts), 10)
+		self.assertGreater(info["misses"], 0)
+		self.assertGreater(info["jitter"]["max_sec"], 0.0)
+		self.assert_on_grid([tblsystem.threads[1].periodics[Ticker].due], origin, 0.01)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,74 @@
+#!  /usr/bin/env python3
+#! -*- coding: utf-8 -*-
+
+# ProcessRegistryをクラス、番号(process_id)、hdl_idのどれからでも引けること
+# 同じ順に登録すれば、別のTblSystemでも同じ番号になること
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from TblSystem import *
+
+class Job (BaseTblProcess):
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.regist_table(self.main_fin, Job.MainHdl)
+		self.regist_table(self.work_fin, Job.WorkHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+
+	class WorkHdl (BaseHdl):
+		def __init__ (self):
+			super().__init__()
+
+	def main_fin (self, hdl):
+		return RC.FIN()
+
+	def work_fin (self, hdl):
+		return RC.FIN()
+
+class TestRegistry (unittest.TestCase):
+	def setUp (self):
+		self.cwd = os.getcwd()
+		self.tmpdir = tempfile.mkdtemp()
+		os.chdir(self.tmpdir)
+
+	def tearDown (self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.tmpdir, ignore_errors = True)
+
+	def registry (self):
+		tblsystem = TblSystem(3)
+		tblsystem.regist_process(Job, 2, 10)
+		return tblsystem.processes
+
+	def test_lookup (self):
+		registry = self.registry()
+		for pinfo in registry:
+			self.assertIs(pinfo, registry.by_id(pinfo.process_id))
+			self.assertIs(pinfo, registry.get(pinfo.cls))
+		pinfo = registry.get(Job)
+		self.assertIn(pinfo, registry.assignments(2))
+		self.assertIs(Job.WorkHdl, registry.hdl_cls(registry.hdl_id(Job.WorkHdl)))
+
+	def test_stable_ids (self):
+		first, second = self.registry(), self.registry()
+		self.assertEqual(first.get(Job).process_id, second.get(Job).process_id)
+		for hdl_cls in (Job.MainHdl, Job.WorkHdl, ErrorProcess.SetErrorHdl):
+			self.assertEqual(first.hdl_id(hdl_cls), second.hdl_id(hdl_cls))
+
+	def test_reindex (self):
+		# 番号を引いた後に登録した処理のHdlにも番号が振られる
+		tblsystem = TblSystem(3)
+		tblsystem.processes.hdl_id(ErrorProcess.SetErrorHdl)
+		tblsystem.regist_process(Job, 2, 10)
+		self.assertIs(Job.WorkHdl, tblsystem.processes.hdl_cls(tblsystem.processes.hdl_id(Job.WorkHdl)))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,167 @@
+#!  /usr/bin/env python3
+#! -*- coding: utf-8 -*-
+
+# 複製した処理への要求が全て完了し、FEEDやWAITで中断した要求を他のレプリカが盗んでも
+# 盗んだスレッドのレプリカで再開すること。stats()["replicas"]の数が合うこと
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from TblSystem import *
+
+class Helper (BaseTblProcess):
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.regist_table(self.main_fin, Helper.MainHdl)
+		self.regist_table(self.echo_fin, Helper.EchoHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+
+	def main_fin (self, hdl):
+		return RC.FIN()
+
+	class EchoHdl (BaseHdl):
+		def __init__ (self):
+			super().__init__()
+
+	def echo_fin (self, hdl):
+		return RC.FIN()
+
+class Parse (BaseTblProcess):
+	# 子の完了をWAITで待ってから、FEEDを挟んで数回に分けて実行する
+	FEEDS = 4
+	SPIN_SEC = 0.0002
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.regist_table(self.main_fin, Parse.MainHdl)
+		self.regist_table(self.parse_request, Parse.ParseHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+
+	def main_fin (self, hdl):
+		return RC.FIN()
+
+	class ParseHdl (BaseHdl):
+		def __init__ (self):
+			super().__init__()
+			self.child = None
+			self.count = 0
+			# 実行したステップごとの(OSスレッド, 処理のインスタンス)
+			self.runs = []
+
+	def parse_request (self, hdl):
+		hdl.runs.append((threading.get_ident(), self))
+		hdl.child = Helper.EchoHdl()
+		self.Request(Helper, hdl.child)
+		return RC.OK(self.parse_wait)
+	def parse_wait (self, hdl):
+		hdl.runs.append((threading.get_ident(), self))
+		if not hdl.child.is_done():
+			return RC.WAIT(hdl.child)
+		return RC.OK(self.parse_work)
+	def parse_work (self, hdl):
+		hdl.runs.append((threading.get_ident(), self))
+		end = time.perf_counter() + Parse.SPIN_SEC
+		while time.perf_counter() < end:
+			pass
+		hdl.count += 1
+		if hdl.count < Parse.FEEDS:
+			return RC.FEED()
+		return RC.FIN()
+
+class Driver (BaseTblProcess):
+	N = 300
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.done = None
+		self.regist_table(self.main_send, Driver.MainHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+			self.hdls = []
+
+	def main_send (self, hdl):
+		for _ in range(Driver.N):
+			hdl.hdls.append(Parse.ParseHdl())
+			self.Request(Parse, hdl.hdls[-1])
+		return RC.OK(self.main_wait)
+	def main_wait (self, hdl):
+		rest = [child for child in hdl.hdls if not child.is_done()]
+		if rest:
+			return RC.WAIT(*rest)
+		self.done = hdl.hdls
+		return RC.FIN()
+
+class TestReplica (unittest.TestCase):
+	TIMEOUT_SEC = 20.0
+	REPLICAS = (1, 2, 3)
+
+	def setUp (self):
+		self.cwd = os.getcwd()
+		self.tmpdir = tempfile.mkdtemp()
+		os.chdir(self.tmpdir)
+
+	def tearDown (self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.tmpdir, ignore_errors = True)
+
+	def run_replicas (self, schedule, routing = TblSystem.ROUTING.CENTRAL):
+		tblsystem = TblSystem(5, schedule, routing = routing, growable = True)
+		tblsystem.regist_process(Parse, TestReplica.REPLICAS, 10)
+		tblsystem.regist_process(Helper, 4, 10)
+		tblsystem.regist_process(Driver, 4, 10)
+		tblsystem.establish()
+		driver = tblsystem.threads[4].processes[Driver]
+		def _watch ():
+			wait_until(lambda: driver.done is not None, TestReplica.TIMEOUT_SEC)
+			tblsystem.stop()
+		watcher = threading.Thread(target = _watch)
+		watcher.start()
+		tblsystem.cyclic_call()
+		watcher.join()
+		self.assertIsNotNone(driver.done, "requests did not finish")
+		hdls = driver.done
+		self.assertTrue(all(TblStatus.FIN == hdl.status and Parse.FEEDS == hdl.count for hdl in hdls))
+
+		# 各ステップは、実行したスレッドのレプリカで実行した
+		replicas = [tblsystem.threads[tid].processes[Parse] for tid in TestReplica.REPLICAS]
+		self.assertEqual(len(replicas), len(set(map(id, replicas))))
+		idents = {}
+		for hdl in hdls:
+			for ident, prc in hdl.runs:
+				self.assertIn(prc, replicas)
+				self.assertEqual(ident, idents.setdefault(id(prc), ident))
+
+		stats = tblsystem.stats()["replicas"]
+		self.assertEqual(list(TestReplica.REPLICAS), [replica["thread_id"] for replica in stats])
+		# 新しい要求は、盗んだかどうかによらず1度だけ受け付ける
+		self.assertEqual(Driver.N, sum(replica["served"] for replica in stats))
+		self.assertTrue(all(0 == replica["queued"] for replica in stats))
+		return hdls, stats
+
+	def test_steal_event (self):
+		hdls, stats = self.run_replicas(TblSystem.SCHEDULE.EVENT)
+		self.assertGreater(sum(replica["stolen"] for replica in stats), 0)
+		# 中断した要求が他のレプリカで再開された
+		self.assertTrue(any(len(set(prc for _, prc in hdl.runs)) > 1 for hdl in hdls))
+
+	def test_steal_direct (self):
+		hdls, stats = self.run_replicas(TblSystem.SCHEDULE.EVENT, TblSystem.ROUTING.DIRECT)
+		self.assertGreater(sum(replica["stolen"] for replica in stats), 0)
+
+	def test_cyclic (self):
+		self.run_replicas(TblSystem.SCHEDULE.CYCLIC)
+
+if __name__ == "__main__":
+	unittest.main()
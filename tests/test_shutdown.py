@@ -0,0 +1,109 @@
+#!  /usr/bin/env python3
+#! -*- coding: utf-8 -*-
+
+# TblSystem.stopの後、処理が作ったスレッドプールが閉じられ、プールのスレッドと開いたファイルが残らないこと
+# ループの中からstopしても、ループを抜けたところで閉じること
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from TblSystem import *
+
+class Failer (BaseTblProcess):
+	# 周期ごとにSetErrorとログを書き、untilが成り立ったら自分のスレッドからstopする
+	PERIODIC = True
+	EID = 901
+	until = None
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.regist_table(self.main_fail, Failer.MainHdl)
+
+	def establish (self, tblsystem):
+		super().establish(tblsystem)
+		self.m_tblsystem = tblsystem
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+
+	def main_fail (self, hdl):
+		self.SetError(Failer.EID, "fail")
+		self.WriteLog("fail")
+		if Failer.until is not None and Failer.until():
+			Failer.until = None
+			self.m_tblsystem.stop()
+		return RC.FIN()
+
+class TestShutdown (unittest.TestCase):
+	TIMEOUT_SEC = 10.0
+
+	def setUp (self):
+		self.cwd = os.getcwd()
+		self.tmpdir = tempfile.mkdtemp()
+		os.chdir(self.tmpdir)
+		Failer.until = None
+
+	def tearDown (self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.tmpdir, ignore_errors = True)
+
+	def new_system (self, schedule):
+		tblsystem = TblSystem(2, schedule)
+		tblsystem.regist_process(Failer, 1, 10)
+		tblsystem.establish()
+		return tblsystem
+
+	def find (self, tblsystem, cls):
+		return find_if(lambda prc: prc is not None, [th.processes.get(cls) for th in tblsystem.threads])
+
+	def started (self, tblsystem):
+		# プールのスレッドが動き始め、ファイルを開いた
+		error = self.find(tblsystem, ErrorProcess)
+		fileio = self.find(tblsystem, FileIOProcess)
+		return error.m_pool._threads and error.m_fp is not None and fileio.m_pool._threads and fileio.m_files
+
+	def assert_closed (self, tblsystem):
+		error = self.find(tblsystem, ErrorProcess)
+		self.assertTrue(error.m_pool._shutdown)
+		self.assertFalse(any(th.is_alive() for th in error.m_pool._threads))
+		self.assertIsNone(error.m_fp)
+		fileio = self.find(tblsystem, FileIOProcess)
+		self.assertTrue(fileio.m_pool._shutdown)
+		self.assertFalse(any(th.is_alive() for th in fileio.m_pool._threads))
+		self.assertEqual({}, fileio.m_files)
+
+	def test_stop_outside (self):
+		tblsystem = self.new_system(TblSystem.SCHEDULE.EVENT)
+		def _watch ():
+			wait_until(lambda: self.started(tblsystem), TestShutdown.TIMEOUT_SEC)
+			tblsystem.stop()
+		watcher = threading.Thread(target = _watch)
+		watcher.start()
+		tblsystem.cyclic_call()
+		watcher.join()
+		self.assert_closed(tblsystem)
+
+	def test_stop_inside (self):
+		# thread_id1の処理からstopする。stopはthread_id1もthread_id0も待たずに戻る
+		tblsystem = self.new_system(TblSystem.SCHEDULE.CYCLIC)
+		Failer.until = lambda: self.started(tblsystem)
+		tblsystem.cyclic_call()
+		for th in tblsystem.tthreads:
+			th.join(TestShutdown.TIMEOUT_SEC)
+		self.assertIsNone(Failer.until)
+		self.assert_closed(tblsystem)
+
+	def test_stop_simulation (self):
+		# ループを回さずに止めても閉じる
+		tblsystem = self.new_system(TblSystem.SCHEDULE.SIMULATION)
+		tblsystem.simulate(1.0)
+		tblsystem.stop()
+		self.assert_closed(tblsystem)
+
+if __name__ == "__main__":
+	unittest.main()
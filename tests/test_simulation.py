@@ -0,0 +1,80 @@
+#!  /usr/bin/env python3
+#! -*- coding: utf-8 -*-
+
+# シミュレーションモードで、同じseedなら同じ時刻に同じ処理が起き、時計が次の期限まで飛ぶこと
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from TblSystem import *
+
+class Ticker (BaseTblProcess):
+	# 乱数で決めた秒数だけ眠り、起きた時刻を記録する
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.events = []
+		self.regist_table(self.main_sleep, Ticker.MainHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+			self.i_cycle_msec = cycle_msec
+			self.sleep_hdl = None
+
+	def main_sleep (self, hdl):
+		secs = hdl.i_cycle_msec / 1000.0 * (1 + self.random.random())
+		self.events.append((self.clock.time(), secs))
+		hdl.sleep_hdl = ClockProcess.SleepSecHdl(secs)
+		self.Request(ClockProcess, hdl.sleep_hdl)
+		return RC.OK(self.main_wait)
+	def main_wait (self, hdl):
+		if not hdl.sleep_hdl.is_done():
+			return RC.WAIT(hdl.sleep_hdl)
+		return RC.OK(self.main_sleep)
+
+class TestSimulation (unittest.TestCase):
+	SEC = 10.0
+
+	def setUp (self):
+		self.cwd = os.getcwd()
+		self.tmpdir = tempfile.mkdtemp()
+		os.chdir(self.tmpdir)
+
+	def tearDown (self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.tmpdir, ignore_errors = True)
+
+	def run_ticker (self, seed):
+		tblsystem = TblSystem(3, TblSystem.SCHEDULE.SIMULATION, seed = seed)
+		tblsystem.regist_process(Ticker, 1, 500)
+		tblsystem.establish()
+		begin = tblsystem.clock.time()
+		wall = time.perf_counter()
+		tblsystem.simulate(TestSimulation.SEC)
+		wall = time.perf_counter() - wall
+		tblsystem.stop()
+		self.assertEqual(begin + TestSimulation.SEC, tblsystem.clock.time())
+		# 仮想時計で進むので、実時間では待たない
+		self.assertLess(wall, TestSimulation.SEC)
+		return [(t - begin, secs) for t, secs in tblsystem.threads[1].processes[Ticker].events]
+
+	def test_same_seed (self):
+		self.assertEqual(self.run_ticker(42), self.run_ticker(42))
+
+	def test_other_seed (self):
+		self.assertNotEqual(self.run_ticker(42), self.run_ticker(43))
+
+	def test_jump_to_deadline (self):
+		# 眠った秒数ちょうどで次の処理が起きる
+		events = self.run_ticker(42)
+		self.assertGreater(len(events), 10)
+		for (t, secs), (next_t, _) in zip(events, events[1:]):
+			self.assertAlmostEqual(t + secs, next_t, places = 6)
+
+if __name__ == "__main__":
+	unittest.main()
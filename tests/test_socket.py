@@ -0,0 +1,186 @@
+#!  /usr/bin/env python3
+#! -*- coding: utf-8 -*-
+
+# ループバックで複数のSocketTblSystemをつなぎ、他のノードへの要求が完了すること
+# 応答しないノードへの接続が、他のノードとの通信を止めないこと
+
+import os
+import sys
+import time
+import pickle
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from TblSystem import *
+from TblSocket import *
+
+class Echo (BaseTblProcess):
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.regist_table(self.main_fin, Echo.MainHdl)
+		self.regist_table(self.echo_echo, Echo.EchoHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+
+	def main_fin (self, hdl):
+		return RC.FIN()
+
+	class EchoHdl (BaseHdl):
+		__slots__ = ("i_x", "o_y")
+		def __init__ (self, x):
+			super().__init__()
+			self.i_x = x
+			self.o_y = None
+
+	def echo_echo (self, hdl):
+		hdl.o_y = hdl.i_x * 10
+		return RC.FIN()
+
+class Silent (Echo):
+	# 接続を受け付けないノードで実行する処理
+	pass
+
+class Pinger (BaseTblProcess):
+	N = 200
+	# 応答しないノードへも送るか
+	SILENT = False
+	def __init__ (self, tx_queue):
+		super().__init__(tx_queue)
+		self.done = None
+		self.silent = None
+		self.regist_table(self.main_request, Pinger.MainHdl)
+
+	class MainHdl (BaseHdl):
+		def __init__ (self, cycle_msec):
+			super().__init__()
+			self.hdls = []
+			self.silent = None
+			self.start = None
+
+	def main_request (self, hdl):
+		# 先に応答しないノードへ送り、その接続を待つ間に他のノードへの要求が終わること
+		if self.SILENT:
+			hdl.silent = Echo.EchoHdl(-1)
+			self.Request(Silent, hdl.silent)
+		hdl.start = time.perf_counter()
+		for i in range(Pinger.N):
+			hdl.hdls.append(Echo.EchoHdl(i))
+			self.Request(Echo, hdl.hdls[-1])
+		return RC.OK(self.main_wait)
+	def main_wait (self, hdl):
+		rest = [child for child in hdl.hdls if not child.is_done()]
+		if rest:
+			return RC.WAIT(*rest)
+		self.done = (time.perf_counter() - hdl.start, hdl.hdls)
+		return RC.OK(self.main_waitsilent)
+	def main_waitsilent (self, hdl):
+		if hdl.silent is not None:
+			if not hdl.silent.is_done():
+				return RC.WAIT(hdl.silent)
+			self.silent = hdl.silent.status
+		return RC.FIN()
+
+	def is_finished (self):
+		return self.done is not None and (not self.SILENT or self.silent is not None)
+
+class SilentPinger (Pinger):
+	SILENT = True
+
+class TestSocket (unittest.TestCase):
+	TIMEOUT_SEC = 10.0
+
+	def setUp (self):
+		self.cwd = os.getcwd()
+		self.tmpdir = tempfile.mkdtemp()
+		os.chdir(self.tmpdir)
+		self.connect_sec = SocketTblSystem.CONNECT_SEC
+		SocketTblSystem.CONNECT_SEC = 1.0
+		self.socks = []
+
+	def tearDown (self):
+		SocketTblSystem.CONNECT_SEC = self.connect_sec
+		for sock in self.socks:
+			sock.close()
+		os.chdir(self.cwd)
+		shutil.rmtree(self.tmpdir, ignore_errors = True)
+
+	def silent_address (self):
+		# 受け付けずに待ち行列を埋めたソケット。以降の接続は完了しない
+		listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		listener.bind(("127.0.0.1", 0))
+		listener.listen(0)
+		self.socks.append(listener)
+		address = listener.getsockname()
+		for _ in range(8):
+			sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			sock.setblocking(False)
+			self.socks.append(sock)
+			sock.connect_ex(address)
+		return address
+
+	def run_nodes (self, addresses, silent = None):
+		nodes = dict(addresses)
+		if silent is not None:
+			nodes["c"] = silent
+		a = SocketTblSystem(2, TblSystem.SCHEDULE.EVENT, name = "a", address = addresses["a"], nodes = nodes, growable = True)
+		b = SocketTblSystem(2, TblSystem.SCHEDULE.EVENT, name = "b", address = addresses["b"], nodes = nodes, growable = True)
+		pinger_cls = Pinger if silent is None else SilentPinger
+		for tblsystem in (a, b):
+			tblsystem.regist_process(pinger_cls, 1, 100, node = "a")
+			tblsystem.regist_process(Echo, 1, 100, node = "b")
+			if silent is not None:
+				tblsystem.regist_process(Silent, 1, 100, node = "c")
+		b.establish()
+		# ポート0で待ち受けたときは、割り当てられたアドレスへつなぐ
+		a.nodes["b"] = b.address
+		a.establish()
+		pinger = a.threads[1].processes[pinger_cls]
+		threads = [threading.Thread(target = tblsystem.cyclic_call) for tblsystem in (a, b)]
+		for th in threads:
+			th.start()
+		try:
+			wait_until(pinger.is_finished, TestSocket.TIMEOUT_SEC)
+		finally:
+			a.stop()
+			b.stop()
+			for th in threads:
+				th.join()
+		self.assertIsNotNone(pinger.done, "requests did not finish")
+		elapsed, hdls = pinger.done
+		self.assertTrue(all(hdl.status == TblStatus.FIN and hdl.o_y == hdl.i_x * 10 for hdl in hdls))
+		return elapsed, pinger.silent
+
+	def test_tcp (self):
+		self.run_nodes({"a": ("127.0.0.1", 0), "b": ("127.0.0.1", 0)})
+
+	def test_unix (self):
+		self.run_nodes({"a": os.path.join(self.tmpdir, "a.sock"), "b": os.path.join(self.tmpdir, "b.sock")})
+
+	def test_silent_node (self):
+		elapsed, status = self.run_nodes({"a": ("127.0.0.1", 0), "b": ("127.0.0.1", 0)}, self.silent_address())
+		self.assertLess(elapsed, SocketTblSystem.CONNECT_SEC)
+		self.assertEqual(TblStatus.ERROR, status)
+
+	def test_stale_reply (self):
+		# 切断でERRORにした要求の完了が後から届いても、thread_id0を止めない
+		tblsystem = SocketTblSystem(1, TblSystem.SCHEDULE.EVENT, name = "a", nodes = {"b": ("127.0.0.1", 1)})
+		tblsystem.regist_process(Echo, 0, 100, node = "b")
+		peer = tblsystem.peers["b"]
+		hdl = Echo.EchoHdl(1)
+		tblsystem.routes(0)[Echo].enqueue(RequestInfo(Echo, hdl))
+		tblsystem.disconnect(peer)
+		tblsystem.step()
+		self.assertEqual(TblStatus.ERROR, hdl.status)
+		payload = pickle.dumps(hdl, pickle.HIGHEST_PROTOCOL)
+		self.assertTrue(tblsystem.deliver(peer, SocketTblSystem.KIND.FIN, 0, payload))
+		self.assertTrue(tblsystem.deliver(peer, SocketTblSystem.KIND.ERR, 0, b""))
+		tblsystem.stop()
+
+if __name__ == "__main__":
+	unittest.main()